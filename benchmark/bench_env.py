@@ -0,0 +1,148 @@
+"""
+Micro-benchmark of VariableRecommendEnv on synthetic knowledge graphs (benchmark/synthetic.py).
+At every scale (multiple of the LAST_FM_STAR numbers of users, items and features) it times reset,
+_get_state, the entropy update, step for ask/accept, ask/reject and recommend, and a GraphEncoder
+forward of the state, and reports calls/sec, latency and memory.
+
+python -m benchmark.bench_env --scale 1 10 --episodes 50 --output env_bench.json
+"""
+import argparse
+import json
+import random
+import resource
+import time
+
+import numpy as np
+import torch
+
+from benchmark.synthetic import SyntheticData, DEGREES
+from graph.gcn import GraphEncoder
+from rl.recommend_env.env_variable_question import VariableRecommendEnv
+from utils.utils import LAST_FM_STAR, YELP_STAR, set_random_seed
+
+OPS = ['reset', 'get_state', 'feature_entropy', 'ask_accept', 'ask_reject', 'recommend', 'gcn_forward']
+
+
+def rss_mb():
+    """Current resident set size (Linux), the peak one elsewhere"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def timed(times, op, fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    times[op].append(time.perf_counter() - start)
+    return result
+
+
+def run_episode(env, gcn, times):
+    """One reset, then one of each step kind while the conversation allows it"""
+    state, cand, action_space = timed(times, 'reset', env.reset)
+    timed(times, 'get_state', env._get_state)
+    timed(times, 'feature_entropy', env._update_feature_entropy)
+    with torch.no_grad():
+        timed(times, 'gcn_forward', gcn, [state])
+    offset = env.user_length + env.item_length
+
+    target_features = set(env.kg.G['item'][env.target_item]['belong_to'])
+    accept = [f for f in env.reachable_feature if f in target_features]
+    if accept:
+        state = timed(times, 'ask_accept', env.step, accept[0] + offset, None, mode='train')[0]
+        if state is None:
+            return
+    reject = [f for f in env.reachable_feature if f not in target_features]
+    if reject:
+        state = timed(times, 'ask_reject', env.step, reject[0] + offset, None, mode='train')[0]
+        if state is None:
+            return
+    # a failed recommendation keeps the conversation (and the candidate set) going
+    wrong = [i for i in env.cand_items[:env.rec_num] if i != env.target_item]
+    if wrong:
+        timed(times, 'recommend', env.step, None, [wrong[0] + env.user_length], mode='train')
+
+
+def bench_scale(args, scale):
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    data = SyntheticData(users=args.users, items=args.items, features=args.features,
+                         features_per_item=args.features_per_item, items_per_user=args.items_per_user,
+                         degree=args.degree, zipf_a=args.zipf_a, embed_size=args.embed_size, scale=scale,
+                         seed=args.seed)
+    env = VariableRecommendEnv(data.kg, data.dataset, args.env_data_name, None, seed=args.seed,
+                               cand_feature_num=10, cand_item_num=10, attr_num=data.sizes['feature'],
+                               mode='train', entropy_way=args.entropy_method, shared=data)
+    table = torch.from_numpy(np.asarray(data.embeds['table']))
+    gcn = GraphEncoder(device='cpu', entity=table.size(0), emb_size=table.size(1), kg=data.kg,
+                       embeddings=table, seq=args.seq, gcn=True, hidden_size=args.hidden_size)
+    build_time = time.perf_counter() - start
+
+    set_random_seed(args.seed)
+    times = {op: [] for op in OPS}
+    for _ in range(args.warmup):
+        run_episode(env, gcn, {op: [] for op in OPS})
+    for _ in range(args.episodes):
+        run_episode(env, gcn, times)
+
+    result = {'scale': scale, 'sizes': data.sizes, 'build_time': build_time, 'nbytes': data.nbytes(),
+              'rss_mb': rss_mb(), 'rss_delta_mb': rss_mb() - rss_start, 'ops': {}}
+    for op, samples in times.items():
+        if not samples:
+            continue
+        samples = np.array(samples)
+        result['ops'][op] = {'calls': len(samples), 'per_sec': len(samples) / samples.sum(),
+                             'mean_ms': 1000 * samples.mean(), 'p50_ms': 1000 * np.percentile(samples, 50),
+                             'p99_ms': 1000 * np.percentile(samples, 99)}
+    return result
+
+
+def print_result(result):
+    sizes = result['sizes']
+    print('\nscale {}: {} users, {} items, {} features, built in {:.1f}s, data {:.1f} MB, rss {:.0f} MB (+{:.0f} MB)'.format(
+        result['scale'], sizes['user'], sizes['item'], sizes['feature'], result['build_time'],
+        sum(result['nbytes'].values()) / 2 ** 20, result['rss_mb'], result['rss_delta_mb']))
+    print('{:<16}{:>8}{:>12}{:>12}{:>12}{:>12}'.format('op', 'calls', 'per sec', 'mean ms', 'p50 ms', 'p99 ms'))
+    for op, s in result['ops'].items():
+        print('{:<16}{:>8}{:>12.1f}{:>12.3f}{:>12.3f}{:>12.3f}'.format(
+            op, s['calls'], s['per_sec'], s['mean_ms'], s['p50_ms'], s['p99_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10], help='multiples of users / items / features')
+    parser.add_argument('--users', type=int, default=1801)
+    parser.add_argument('--items', type=int, default=7432)
+    parser.add_argument('--features', type=int, default=8438)
+    parser.add_argument('--features_per_item', type=float, default=13, help='mean item -> feature degree')
+    parser.add_argument('--items_per_user', type=float, default=43, help='mean user -> item interactions')
+    parser.add_argument('--degree', type=str, default='zipf', choices=DEGREES, help='popularity of the neighbors')
+    parser.add_argument('--zipf_a', type=float, default=1.0, help='exponent of the zipf popularity')
+    parser.add_argument('--embed_size', type=int, default=64)
+    parser.add_argument('--hidden_size', type=int, default=100)
+    parser.add_argument('--seq', type=str, default='transformer')
+    parser.add_argument('--env_data_name', type=str, default=LAST_FM_STAR, choices=[LAST_FM_STAR, YELP_STAR],
+                        help='YELP_STAR caps the state at 5000 candidate items')
+    parser.add_argument('--entropy_method', type=str, default='weight_entropy')
+    parser.add_argument('--episodes', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', type=str, default='', help='write the results as json')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    random.seed(args.seed)
+    results = []
+    for scale in args.scale:
+        result = bench_scale(args, scale)
+        print_result(result)
+        results.append(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
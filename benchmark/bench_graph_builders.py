@@ -0,0 +1,166 @@
+"""
+Benchmark BookGraph / MovieGraph against the former builders, which grew the item / feature
+adjacency tuples with += inside the loops and rebuilt the feature index three times.
+Both builders must produce the same G.
+
+python -m benchmark.bench_graph_builders --data_name BOOK MOVIE --repeat 3
+"""
+import argparse
+import json
+import os
+import pickle
+import time
+
+from tqdm import tqdm
+
+from graph.graph_process.book_graph import BookGraph
+from graph.graph_process.movie_graph import MovieGraph
+from utils.utils import BOOK, MOVIE
+
+
+class LegacyBookGraph(object):
+    def __init__(self):
+        os.chdir("../")
+        with open('./datasets/raw_data/book/fea_item/item_feature.pkl', 'rb') as f:
+            self.item_feature = pickle.load(f)
+        with open('./datasets/raw_data/book/fea_item/small_to_large.pkl', 'rb') as f:
+            self.small_to_large = pickle.load(f)
+        self.G = dict()
+        self.__get_user__()
+        self.__get_item__()
+        self.__get_feature__()
+
+    def __get_user__(self):
+        with open('./datasets/raw_data/book/UI_Interaction_data/review_dict_train.json', 'r', encoding='utf-8') as f:
+            ui_train = json.load(f)
+            self.G['user'] = {}
+            for user in tqdm(ui_train):
+                self.G['user'][int(user)] = {}
+                self.G['user'][int(user)]['interact'] = tuple(ui_train[user])
+                self.G['user'][int(user)]['friends'] = tuple(())
+                self.G['user'][int(user)]['like'] = tuple(())
+
+    def __get_item__(self):
+        self.G['item'] = {}
+        self.feature_index = {}
+        i = 0
+        for key in self.small_to_large.keys():
+            if key in self.feature_index:
+                continue
+            else:
+                self.feature_index[key] = i
+                i += 1
+        for item in self.item_feature:
+            self.G['item'][item] = {}
+            fea = []
+            for feature in self.item_feature[item]:
+                fea.append(self.feature_index[feature])
+            self.G['item'][item]['belong_to'] = tuple(set(fea))
+            self.G['item'][item]['interact'] = tuple(())
+            self.G['item'][item]['belong_to_large'] = tuple(())
+        for user in self.G['user']:
+            for item in self.G['user'][user]['interact']:
+                self.G['item'][item]['interact'] += tuple([user])
+
+    def __get_feature__(self):
+        self.G['feature'] = {}
+        for key in self.small_to_large:
+            idx = self.feature_index[key]
+            self.G['feature'][idx] = {}
+            self.G['feature'][idx]['link_to_feature'] = tuple(self.small_to_large[key])
+            self.G['feature'][idx]['like'] = tuple(())
+            self.G['feature'][idx]['belong_to'] = tuple(())
+        for item in self.G['item']:
+            for feature in self.G['item'][item]['belong_to']:
+                self.G['feature'][feature]['belong_to'] += tuple([item])
+
+
+class LegacyMovieGraph(object):
+    def __init__(self):
+        os.chdir("../")
+        with open('./datasets/raw_data/movie/fea_item/item_feature.pkl', 'rb') as f:
+            self.item_feature = pickle.load(f)
+        with open('./datasets/raw_data/movie/fea_item/small_to_large.pkl', 'rb') as f:
+            self.small_to_large = pickle.load(f)
+        self.G = dict()
+        with open('./datasets/raw_data/movie/UI_Interaction_data/review_dict_train.json', 'r',
+                  encoding='utf-8') as f:
+            ui_train = json.load(f)
+            self.G['user'] = {}
+            for user in tqdm(ui_train):
+                self.G['user'][int(user)] = {}
+                self.G['user'][int(user)]['interact'] = tuple(ui_train[user])
+                self.G['user'][int(user)]['friends'] = tuple(())
+                self.G['user'][int(user)]['like'] = tuple(())
+        feature_index = {}
+        i = 0
+        for key in self.small_to_large.keys():
+            if key in feature_index:
+                continue
+            else:
+                feature_index[key] = i
+                i += 1
+        self.G['item'] = {}
+        for item in self.item_feature:
+            self.G['item'][item] = {}
+            fea = []
+            for feature in self.item_feature[item]:
+                if feature not in self.small_to_large:
+                    continue
+                fea.append(feature_index[feature])
+            self.G['item'][item]['belong_to'] = tuple(set(fea))
+            self.G['item'][item]['interact'] = tuple(())
+            self.G['item'][item]['belong_to_large'] = tuple(())
+        for user in self.G['user']:
+            for item in self.G['user'][user]['interact']:
+                self.G['item'][item]['interact'] += tuple([user])
+        self.G['feature'] = {}
+        for key in self.small_to_large:
+            idx = feature_index[key]
+            self.G['feature'][idx] = {}
+            self.G['feature'][idx]['link_to_feature'] = tuple(self.small_to_large[key])
+            self.G['feature'][idx]['like'] = tuple(())
+            self.G['feature'][idx]['belong_to'] = tuple(())
+        for item in self.G['item']:
+            for feature in self.G['item'][item]['belong_to']:
+                self.G['feature'][feature]['belong_to'] += tuple([item])
+
+
+BUILDERS = {
+    BOOK: (LegacyBookGraph, BookGraph),
+    MOVIE: (LegacyMovieGraph, MovieGraph),
+}
+
+
+def time_builder(builder, repeat):
+    """The builders chdir to '../', run them from graph/ like graph_init.py"""
+    root = os.getcwd()
+    times = []
+    kg = None
+    for _ in range(repeat):
+        os.chdir(os.path.join(root, 'graph'))
+        start = time.perf_counter()
+        try:
+            kg = builder()
+        finally:
+            os.chdir(root)
+        times.append(time.perf_counter() - start)
+    return kg, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_name', type=str, nargs='+', default=[BOOK, MOVIE], choices=[BOOK, MOVIE])
+    parser.add_argument('--repeat', type=int, default=3, help='best of repeat runs')
+    args = parser.parse_args()
+    for data_name in args.data_name:
+        legacy, current = BUILDERS[data_name]
+        legacy_kg, legacy_time = time_builder(legacy, args.repeat)
+        kg, current_time = time_builder(current, args.repeat)
+        same = legacy_kg.G == kg.G
+        print('{}: legacy {:.3f}s, current {:.3f}s, speedup {:.1f}x, same G: {}'.format(
+            data_name, legacy_time, current_time, legacy_time / current_time, same))
+
+
+if __name__ == '__main__':
+    main()
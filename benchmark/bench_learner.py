@@ -0,0 +1,168 @@
+"""
+Throughput of the learner: RecAgent / AskAgent.optimize_model on prioritized replay memories filled
+with transitions that a random policy samples from VariableRecommendEnv on a synthetic knowledge
+graph (benchmark/synthetic.py), so the states have the sizes of the real ones. For every batch size,
+seq type and thread count it reports the updates/sec and the time per stage of optimize_model
+(sample, collate, gcn_forward, q_targets, priority_update, backward, state_infer), recorded by the
+PhaseTimer phases of utils/timing.py. On CUDA, kernels run asynchronously and their time is charged
+to the stage that waits for them.
+
+python -m benchmark.bench_learner --batch_size 32 64 128 --seq rnn transformer mean --threads 1 4 --output learner_bench.json
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+
+import torch
+
+from benchmark.synthetic import SyntheticData, DEGREES
+from rl.recommend_env.env_variable_question import VariableRecommendEnv
+from rl.rl_option_critic import build_agents
+from utils.timing import timer
+from utils.utils import LAST_FM_STAR, set_random_seed
+
+STAGES = ['sample', 'collate', 'gcn_forward', 'q_targets', 'priority_update', 'backward', 'state_infer']
+
+
+def sample_transitions(env, num_transitions, max_turn=15):
+    """
+    Random-policy conversations: ask a candidate feature or recommend a candidate item at random
+    :return: ask transitions, rec transitions as pushed by sample_episode
+    """
+    transitions = {'ask': [], 'rec': []}
+    while len(transitions['ask']) + len(transitions['rec']) < num_transitions:
+        state, cand, action_space = env.reset()
+        for _ in range(max_turn):
+            if cand['feature'] and random.random() < 0.5:
+                name, action = 'ask', random.choice(cand['feature'])
+                next_state, next_cand, action_space, reward, done = env.step(action, None, mode='train')
+            else:
+                name, action = 'rec', random.choice(cand['item'])
+                next_state, next_cand, action_space, reward, done = env.step(None, [action], mode='train')
+            if next_state is None:
+                break
+            transitions[name].append((state, torch.tensor(action), next_state if not done else None,
+                                      torch.tensor([reward], dtype=torch.float),
+                                      next_cand['item'], next_cand['feature']))
+            if done:
+                break
+            state, cand = next_state, next_cand
+    return transitions['ask'], transitions['rec']
+
+
+def fill_memory(memory, transitions, size):
+    for i in range(size):
+        memory.push(*transitions[i % len(transitions)])
+
+
+def stage_stats(phases, path):
+    s = phases.get(path)
+    if s is None:
+        return None
+    return {'calls': s['count'], 'total_s': s['total'], 'mean_ms': 1000 * s['mean'],
+            'p50_ms': 1000 * s['p50'], 'p99_ms': 1000 * s['p99']}
+
+
+def bench_config(args, data, env, transitions, batch_size, seq, threads):
+    torch.set_num_threads(threads)
+    agent_args = argparse.Namespace(device=args.device, seq=seq, gcn=True, fix_emb=True, pretrained_emb=0,
+                                    hidden_size=args.hidden_size,
+                                    memory_size=args.memory_size, memory_max_bytes=0, learning_rate=1e-4, l2_norm=1e-6, alpha=1,
+                                    seed=args.seed)
+    set_random_seed(args.seed)
+    ask_agent, rec_agent, _ = build_agents(agent_args, data.kg, env)
+    fill_memory(ask_agent.memory, transitions[0], args.memory_fill)
+    fill_memory(rec_agent.memory, transitions[1], args.memory_fill)
+
+    for _ in range(args.warmup):
+        rec_agent.optimize_model(batch_size, args.gamma, ask_agent)
+        ask_agent.optimize_model(batch_size, args.gamma, rec_agent)
+    timer.reset()
+    start = time.perf_counter()
+    for _ in range(args.updates):
+        with timer.phase('rec'):
+            rec_agent.optimize_model(batch_size, args.gamma, ask_agent)
+        with timer.phase('ask'):
+            ask_agent.optimize_model(batch_size, args.gamma, rec_agent)
+    elapsed = time.perf_counter() - start
+    phases, _ = timer.summary()
+
+    result = {'batch_size': batch_size, 'seq': seq, 'threads': threads,
+              # one learner update optimizes both agents, as optimize_agents
+              'updates_per_sec': args.updates / elapsed, 'agents': {}}
+    for name in ['rec', 'ask']:
+        result['agents'][name] = stage_stats(phases, name)
+        result['agents'][name]['stages'] = {stage: stage_stats(phases, name + '/' + stage) for stage in STAGES}
+    return result
+
+
+def print_result(result):
+    print('\nbatch {} seq {} threads {}: {:.2f} updates/sec'.format(
+        result['batch_size'], result['seq'], result['threads'], result['updates_per_sec']))
+    print('{:<18}'.format('stage') + ''.join('{:>14}'.format(name + ' ms') for name in result['agents']))
+    print('{:<18}'.format('total') + ''.join('{:>14.3f}'.format(a['mean_ms']) for a in result['agents'].values()))
+    for stage in STAGES:
+        cells = []
+        for agent in result['agents'].values():
+            s = agent['stages'][stage]
+            cells.append('{:>14.3f}'.format(s['mean_ms']) if s else '{:>14}'.format('-'))
+        print('{:<18}'.format('  ' + stage) + ''.join(cells))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[32, 64, 128])
+    parser.add_argument('--seq', type=str, nargs='+', default=['rnn', 'transformer', 'mean'],
+                        choices=['rnn', 'transformer', 'mean'])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, torch.get_num_threads()])
+    parser.add_argument('--updates', type=int, default=20, help='timed learner updates per configuration')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--transitions', type=int, default=1000, help='distinct transitions sampled from the env')
+    parser.add_argument('--memory_fill', type=int, default=5000, help='transitions pushed into each replay memory')
+    parser.add_argument('--memory_size', type=int, default=50000)
+    parser.add_argument('--hidden_size', type=int, default=100)
+    parser.add_argument('--gamma', type=float, default=0.999)
+    parser.add_argument('--scale', type=int, default=1, help='multiple of the LAST_FM_STAR sizes of the synthetic KG')
+    parser.add_argument('--degree', type=str, default='zipf', choices=DEGREES)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', type=str, default='', help='write the report as json')
+    args = parser.parse_args()
+    args.device = torch.device('cuda') if torch.cuda.is_available() else 'cpu'
+
+    random.seed(args.seed)
+    data = SyntheticData(degree=args.degree, scale=args.scale, seed=args.seed)
+    env = VariableRecommendEnv(data.kg, data.dataset, LAST_FM_STAR, None, seed=args.seed,
+                               attr_num=data.sizes['feature'], mode='train', shared=data)
+    start = time.perf_counter()
+    transitions = sample_transitions(env, args.transitions)
+    print('Sampled {} ask / {} rec transitions in {:.1f}s'.format(
+        len(transitions[0]), len(transitions[1]), time.perf_counter() - start))
+
+    timer.enabled = True
+    results = []
+    for seq in args.seq:
+        for threads in args.threads:
+            for batch_size in args.batch_size:
+                result = bench_config(args, data, env, transitions, batch_size, seq, threads)
+                print_result(result)
+                results.append(result)
+    if args.output:
+        report = {'commit': git_commit(), 'torch': torch.__version__, 'python': platform.python_version(),
+                  'machine': platform.machine(), 'device': str(args.device),
+                  'args': {k: v for k, v in vars(args).items() if k != 'device'}, 'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
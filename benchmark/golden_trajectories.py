@@ -0,0 +1,237 @@
+"""
+Golden-trajectory equivalence harness for rewrites of VariableRecommendEnv, GraphEncoder and
+ReplayMemoryPER.
+
+record runs seeded conversations with a random policy on the current implementation and saves, per
+step, the action, reward, done, candidate items and their scores, reachable features, entropy, the
+candidates, the state graph and the GraphEncoder output, plus the index / weight / total sequence of
+a replay memory under seeded sample / update rounds. replay feeds the recorded actions to the
+implementations given as module:Class (the current ones by default), compares every field with the
+given tolerances and reports the first divergence; the exit status is 1 if anything diverged.
+
+python -m benchmark.golden_trajectories record --output golden.pt --episodes 10
+python -m benchmark.golden_trajectories replay --golden golden.pt --env_class my.fast_env:FastEnv --rtol 1e-5
+"""
+import argparse
+import importlib
+import random
+import sys
+
+import numpy as np
+import torch
+
+from benchmark.synthetic import SyntheticData
+from utils.utils import LAST_FM_STAR, YELP_STAR, BOOK, MOVIE, set_random_seed, set_episode_seed, \
+    load_kg, load_dataset, embedding_table
+
+DEFAULT_CLASSES = {'env': 'rl.recommend_env.env_variable_question:VariableRecommendEnv',
+                   'encoder': 'graph.gcn:GraphEncoder',
+                   'memory': 'rl.rl_memory:ReplayMemoryPER'}
+SYNTHETIC = 'synthetic'
+
+
+def import_class(path):
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def build(meta, classes):
+    """Env and encoder of the recorded setup, from the given implementations"""
+    set_random_seed(meta['seed'])
+    shared = None
+    if meta['data_name'] == SYNTHETIC:
+        shared = SyntheticData(scale=meta['scale'], seed=meta['seed'])
+        kg, dataset, env_data_name = shared.kg, shared.dataset, LAST_FM_STAR
+    else:
+        kg, dataset, env_data_name = load_kg(meta['data_name']), load_dataset(meta['data_name']), meta['data_name']
+    env = import_class(classes['env'])(kg, dataset, env_data_name, meta['embed'], seed=meta['seed'],
+                                       max_turn=meta['max_turn'], attr_num=dataset.feature.value_len,
+                                       mode='train', shared=shared)
+    embed = embedding_table(env)
+    encoder = import_class(classes['encoder'])(device='cpu', entity=embed.size(0), emb_size=embed.size(1), kg=kg,
+                                               embeddings=embed, seq=meta['seq'], gcn=True,
+                                               hidden_size=meta['hidden_size'])
+    encoder.eval()
+    return env, encoder
+
+
+def snapshot(env, state, cand, encoder):
+    """Everything compared at one step"""
+    # ids as int32 to keep the golden file small
+    record = {'cand_items': np.array(env.cand_items, dtype=np.int32),
+              'cand_item_score': np.array(env.cand_item_score, dtype=np.float64),
+              'reachable_feature': np.array(env.reachable_feature, dtype=np.int32),
+              'attr_ent': np.array(env.attr_ent, dtype=np.float64)}
+    if state is not None:
+        adj = state['adj'].coalesce()
+        record.update({'cand': {'feature': list(cand['feature']), 'item': list(cand['item'])},
+                       'cur_node': list(state['cur_node']),
+                       'neighbors': state['neighbors'].int(),
+                       'adj_indices': adj.indices().int(),
+                       'adj_values': adj.values().clone()})
+        with torch.no_grad():
+            record['encoder'] = encoder([state]).clone()
+    return record
+
+
+def run_episode(env, encoder, meta, episode, actions=None):
+    """
+    :param actions: recorded actions to replay, None to pick them with the seeded random policy
+    :return: list of step records, the first one after reset
+    """
+    set_episode_seed(meta['seed'], episode)
+    policy = random.Random(meta['seed'] * 7919 + episode)
+    state, cand, _ = env.reset()
+    steps = [dict(snapshot(env, state, cand, encoder), user=int(env.user_id), target=int(env.target_item))]
+    for t in range(meta['max_turn']):
+        if actions is not None:
+            if t >= len(actions):
+                break
+            action = actions[t]
+        elif cand['feature'] and policy.random() < 0.5:
+            action = ('ask', int(policy.choice(cand['feature'])))
+        else:
+            action = ('rec', int(policy.choice(cand['item'])))
+        if action[0] == 'ask':
+            state, cand, _, reward, done = env.step(action[1], None, mode='train')
+        else:
+            state, cand, _, reward, done = env.step(None, [action[1]], mode='train')
+        steps.append(dict(snapshot(env, state, cand, encoder), action=action, reward=float(reward), done=int(done)))
+        if state is None or done:
+            break
+    return steps
+
+
+def memory_trace(memory_class, seed, capacity=128, pushes=300, rounds=30, batch_size=32):
+    """Seeded push / sample / update rounds on a small memory (wraps around the capacity)"""
+    set_random_seed(seed)
+    errors_rng = np.random.RandomState(seed)
+    memory = memory_class(capacity)
+    for i in range(pushes):
+        memory.push(i, 0, None, 0, [], [])
+    trace = []
+    for _ in range(rounds):
+        idxs, data, is_weights = memory.sample(batch_size)
+        errors = errors_rng.uniform(-1, 1, batch_size).tolist()
+        memory.update(idxs, errors)
+        trace.append({'idxs': np.array(idxs, dtype=np.int64), 'data': np.array([d.state for d in data]),
+                      'is_weights': np.array(is_weights, dtype=np.float64), 'total': float(memory.tree.total())})
+    return trace
+
+
+def compare(expected, actual, rtol, atol, path=''):
+    """:return: description of the first difference, None if equal within the tolerances"""
+    if isinstance(expected, dict):
+        for key in expected:
+            if key not in actual:
+                return '{}.{} missing'.format(path, key)
+            diff = compare(expected[key], actual[key], rtol, atol, '{}.{}'.format(path, key))
+            if diff:
+                return diff
+        return None
+    if torch.is_tensor(expected):
+        expected = expected.detach().cpu().numpy()
+        actual = actual.detach().cpu().numpy() if torch.is_tensor(actual) else np.asarray(actual)
+    if isinstance(expected, np.ndarray):
+        actual = np.asarray(actual)
+        if expected.shape != actual.shape:
+            return '{}: shape {} != {}'.format(path, expected.shape, actual.shape)
+        if np.issubdtype(expected.dtype, np.floating):
+            close = np.isclose(actual, expected, rtol=rtol, atol=atol)
+        else:
+            close = actual == expected
+        if not close.all():
+            first = tuple(int(i) for i in np.argwhere(~close)[0])
+            return '{}{}: recorded {} got {} ({} of {} differ)'.format(
+                path, list(first), expected[first], actual[first], int((~close).sum()), close.size)
+        return None
+    if isinstance(expected, float):
+        if not np.isclose(actual, expected, rtol=rtol, atol=atol):
+            return '{}: recorded {} got {}'.format(path, expected, actual)
+        return None
+    if expected != actual:
+        return '{}: recorded {} got {}'.format(path, expected, actual)
+    return None
+
+
+def record(args):
+    meta = {'data_name': args.data_name, 'scale': args.scale, 'embed': args.embed, 'seed': args.seed,
+            'max_turn': args.max_turn, 'seq': args.seq, 'hidden_size': args.hidden_size, 'episodes': args.episodes}
+    env, encoder = build(meta, DEFAULT_CLASSES)
+    golden = {'meta': meta, 'encoder_state': encoder.state_dict(), 'episodes': [],
+              'memory': memory_trace(import_class(DEFAULT_CLASSES['memory']), args.seed)}
+    for episode in range(args.episodes):
+        golden['episodes'].append(run_episode(env, encoder, meta, episode))
+    torch.save(golden, args.output)
+    print('Recorded {} episodes ({} steps) at {}'.format(
+        args.episodes, sum(len(e) for e in golden['episodes']), args.output))
+
+
+def replay(args):
+    golden = torch.load(args.golden, weights_only=False)
+    meta = golden['meta']
+    classes = {'env': args.env_class, 'encoder': args.encoder_class, 'memory': args.memory_class}
+    env, encoder = build(meta, classes)
+    encoder.load_state_dict(golden['encoder_state'])
+    diverged = False
+    for episode, expected in enumerate(golden['episodes']):
+        actions = [step['action'] for step in expected[1:]]
+        actual = run_episode(env, encoder, meta, episode, actions)
+        for step, (e, a) in enumerate(zip(expected, actual)):
+            diff = compare(e, a, args.rtol, args.atol)
+            if diff:
+                print('First divergence: episode {} step {} {}'.format(episode, step, diff))
+                diverged = True
+                break
+        else:
+            if len(expected) != len(actual):
+                print('First divergence: episode {} has {} steps, recorded {}'.format(episode, len(actual), len(expected)))
+                diverged = True
+        if diverged:
+            break
+    else:
+        print('env / encoder: {} episodes match'.format(len(golden['episodes'])))
+
+    memory = memory_trace(import_class(args.memory_class), meta['seed'])
+    for i, (e, a) in enumerate(zip(golden['memory'], memory)):
+        diff = compare(e, a, args.rtol, args.atol)
+        if diff:
+            print('First memory divergence: round {} {}'.format(i, diff))
+            diverged = True
+            break
+    else:
+        print('memory: {} rounds match'.format(len(golden['memory'])))
+    return diverged
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    rec = commands.add_parser('record', help='record the golden trajectories of the current implementation')
+    rec.add_argument('--output', type=str, default='golden_trajectories.pt')
+    rec.add_argument('--data_name', type=str, default=SYNTHETIC, choices=[SYNTHETIC, LAST_FM_STAR, YELP_STAR, BOOK, MOVIE])
+    rec.add_argument('--scale', type=int, default=1, help='size multiple of the synthetic KG')
+    rec.add_argument('--embed', type=str, default='transe', help='pretrained embeddings of a real dataset')
+    rec.add_argument('--episodes', type=int, default=10)
+    rec.add_argument('--max_turn', type=int, default=15)
+    rec.add_argument('--seq', type=str, default='transformer')
+    rec.add_argument('--hidden_size', type=int, default=100)
+    rec.add_argument('--seed', type=int, default=1)
+    rep = commands.add_parser('replay', help='replay the recorded actions against other implementations')
+    rep.add_argument('--golden', type=str, default='golden_trajectories.pt')
+    rep.add_argument('--env_class', type=str, default=DEFAULT_CLASSES['env'], help='module:Class')
+    rep.add_argument('--encoder_class', type=str, default=DEFAULT_CLASSES['encoder'], help='module:Class')
+    rep.add_argument('--memory_class', type=str, default=DEFAULT_CLASSES['memory'], help='module:Class')
+    rep.add_argument('--rtol', type=float, default=1e-5)
+    rep.add_argument('--atol', type=float, default=1e-6)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    if args.command == 'record':
+        record(args)
+    elif replay(args):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Synthetic knowledge graphs and datasets for the benchmarks, without the LAST_FM_STAR / YELP files.
+
+SyntheticData(...) holds a CSRGraph (user interact, item belong_to / interact, feature belong_to),
+the dataset entity sizes, the interaction splits and an embedding table, in the layouts loaded by
+train.py, so that VariableRecommendEnv(..., shared=data) and GraphEncoder(..., kg=data.kg) accept it.
+The defaults are the LAST_FM_STAR sizes; scale multiplies the numbers of users, items and features.
+"""
+import numpy as np
+from easydict import EasyDict as edict
+
+from utils.embed_store import table_to_embeds
+from utils.interactions import InteractionView
+from utils.kg_format import CSRGraph, KG_FORMAT_VERSION
+
+DEGREES = ['uniform', 'zipf']
+
+
+def popularity(n, degree, zipf_a, rng):
+    """Probability of every node to be picked as a neighbor, zipf: power law over a random ranking"""
+    if degree == 'uniform':
+        return np.full(n, 1. / n)
+    weights = 1. / np.arange(1, n + 1) ** zipf_a
+    weights = weights[rng.permutation(n)]
+    return weights / weights.sum()
+
+
+def sample_csr(rows, cols, mean_degree, degree, zipf_a, rng):
+    """
+    Random bipartite adjacency: every row gets about mean_degree (at least 1) distinct columns
+    picked by popularity(cols)
+    :return: offsets, indices (sorted per row) as int64 CSR arrays
+    """
+    counts = np.maximum(rng.poisson(mean_degree, rows), 1)
+    heads = np.repeat(np.arange(rows, dtype=np.int64), counts)
+    tails = rng.choice(cols, size=len(heads), p=popularity(cols, degree, zipf_a, rng)).astype(np.int64)
+    return edges_to_csr(heads, tails, rows, cols)
+
+
+def edges_to_csr(heads, tails, rows, cols):
+    """Deduplicated (head, tail) edges grouped by head"""
+    keys = np.unique(heads * cols + tails)
+    heads, tails = keys // cols, keys % cols
+    offsets = np.zeros(rows + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(heads, minlength=rows))
+    return offsets, tails
+
+
+def transpose_csr(offsets, indices, cols):
+    rows = len(offsets) - 1
+    heads = np.repeat(np.arange(rows, dtype=np.int64), np.diff(offsets))
+    return edges_to_csr(indices, heads, cols, rows)
+
+
+class SyntheticData(object):
+    """
+    :param features_per_item: mean item -> feature degree (LAST_FM_STAR: 12.7)
+    :param items_per_user: mean user -> item interactions (LAST_FM_STAR: 42.6)
+    :param degree: 'uniform' or 'zipf' popularity of the features and items picked as neighbors
+    Both interaction splits are the full user -> item interactions.
+    """
+    def __init__(self, users=1801, items=7432, features=8438, features_per_item=13, items_per_user=43,
+                 degree='zipf', zipf_a=1.0, embed_size=64, scale=1, seed=1):
+        rng = np.random.RandomState(seed)
+        users, items, features = users * scale, items * scale, features * scale
+        self.sizes = {'user': users, 'item': items, 'feature': features}
+        item_offsets, item_features = sample_csr(items, features, features_per_item, degree, zipf_a, rng)
+        user_offsets, user_items = sample_csr(users, items, items_per_user, degree, zipf_a, rng)
+        feature_offsets, feature_items = transpose_csr(item_offsets, item_features, features)
+        interact_offsets, interact_users = transpose_csr(user_offsets, user_items, items)
+
+        arrays = {'user.ids': np.arange(users, dtype=np.int64),
+                  'user.interact.offsets': user_offsets, 'user.interact.indices': user_items,
+                  'item.ids': np.arange(items, dtype=np.int64),
+                  'item.belong_to.offsets': item_offsets, 'item.belong_to.indices': item_features,
+                  'item.interact.offsets': interact_offsets, 'item.interact.indices': interact_users,
+                  'feature.ids': np.arange(features, dtype=np.int64),
+                  'feature.belong_to.offsets': feature_offsets, 'feature.belong_to.indices': feature_items}
+        meta = {'version': KG_FORMAT_VERSION, 'extras': False,
+                'entities': {'user': ['interact'], 'item': ['belong_to', 'interact'], 'feature': ['belong_to']}}
+        self.kg = CSRGraph(arrays=arrays, meta=meta)
+        self.dataset = edict({name: edict(id=range(size), value_len=size) for name, size in self.sizes.items()})
+
+        split = InteractionView(np.arange(users, dtype=np.int32), user_offsets, user_items.astype(np.int32))
+        self.splits = {'train': split, 'test': split}
+        # [user, item, feature, padding] rows, as the embedding store
+        table = (0.1 * rng.standard_normal((users + items + features + 1, embed_size))).astype(np.float32)
+        table[-1] = 0
+        self.embeds = table_to_embeds(table, users + items)
+
+    def interactions(self, mode):
+        return self.splits[mode]
+
+    def nbytes(self):
+        """Bytes of the KG arrays, the interactions and the embedding table"""
+        return {'kg': sum(a.nbytes for a in self.kg.arrays.values()),
+                'interactions': sum(a.nbytes for a in (self.splits['train'].users, self.splits['train'].items)),
+                'embeds': self.embeds['table'].nbytes}
@@ -1,6 +1,12 @@
 
 
 from rl.rl_evaluate import rl_evaluate
+from rl.rl_quantize import inference_agents, compare_precisions
+from rl.rl_export import export_decision_graph, check_decision_graph, decision_graph_file
+from rl.rl_bundle import policy_bundle_file, save_policy_bundle, load_policy_bundle, checkpoint_source, \
+    policy_bundle_current
+from utils.profiling import profile_window
+from rl.rl_checkpoint import load_agents
 from rl.rl_memory import ReplayMemoryPER
 from rl.rl_option_critic import set_arguments
 from rl.agent.ask_agent import AskAgent
@@ -36,6 +42,38 @@ def evaluate(args, kg, dataset, filename):
     :param filename: filename
     """
     set_random_seed(args.seed)
+    path = policy_bundle_file(args.data_name, filename, args.load_rl_epoch)
+    source = checkpoint_source(args.data_name, filename, args.load_rl_epoch) if args.policy_bundle else None
+    if args.policy_bundle and policy_bundle_current(path, source):
+        ask_agent, rec_agent, _ = load_policy_bundle(path, device=args.device, seed=args.seed)
+    else:
+        if args.policy_bundle and os.path.isfile(path):
+            print('Policy bundle {} is outdated, rebuilding it from the checkpoint'.format(path))
+        ask_agent, rec_agent = build_eval_agents(args, kg, dataset, filename)
+        if args.policy_bundle:
+            save_policy_bundle(path, args, ask_agent, rec_agent, source=source)
+    if args.export_decision:
+        path = decision_graph_file(args.data_name, filename, args.load_rl_epoch)
+        precision = 'int8' if args.infer_precision == 'int8' else 'fp32'
+        export_decision_graph(ask_agent, rec_agent, path, option_strategy=args.option_strategy, precision=precision)
+        check_decision_graph(args, kg, dataset, torch.jit.load(path), ask_agent, rec_agent,
+                             user_size=args.eval_user_size or 100)
+        return
+    if args.compare_precision:
+        compare_precisions(args, kg, dataset, filename, ask_agent, rec_agent)
+        return
+    if args.infer_precision != 'fp32':
+        ask_agent, rec_agent = inference_agents(ask_agent, rec_agent, args.infer_precision)
+    profiler = profile_window(args, 'Evaluate-' + filename)
+    _ = rl_evaluate(args, kg, dataset, filename, args.load_rl_epoch, ask_agent, rec_agent, profiler=profiler)
+    profiler.close()
+
+
+def build_eval_agents(args, kg, dataset, filename):
+    """
+    Build both training agents on the embeddings of an env and load the checkpoint of args.load_rl_epoch
+    :return: ask_agent, rec_agent
+    """
     # Prepare the Environment
     env = VariableRecommendEnv(kg, dataset,
                                args.data_name, args.embed, seed=args.seed, max_turn=args.max_turn,
@@ -44,8 +82,7 @@ def evaluate(args, kg, dataset, filename):
                                entropy_way=args.entropy_method)
 
     # User&Feature Embedding
-    embed = torch.FloatTensor(
-        np.concatenate((env.ui_embeds, env.feature_emb, np.zeros((1, env.ui_embeds.shape[1]))), axis=0))
+    embed = embedding_table(env)
     # print(embed.size(0), embed.size(1))
     '''
     VALUE NET
@@ -53,7 +90,7 @@ def evaluate(args, kg, dataset, filename):
     value_net = ValueNetwork().to(args.device)
     gcn_net = GraphEncoder(device=args.device, entity=embed.size(0), emb_size=embed.size(1), kg=kg,
                            embeddings=embed, fix_emb=args.fix_emb, seq=args.seq, gcn=args.gcn,
-                           hidden_size=args.hidden_size).to(args.device)
+                           hidden_size=args.hidden_size, pretrained_emb=args.pretrained_emb).to(args.device)
     '''
     ASK AGENT
     '''
@@ -62,7 +99,8 @@ def evaluate(args, kg, dataset, filename):
     # Ask Agent
     ask_agent = AskAgent(device=args.device, memory=ask_memory, action_size=embed.size(1),
                          hidden_size=args.hidden_size, gcn_net=gcn_net, learning_rate=args.learning_rate,
-                         l2_norm=args.l2_norm, PADDING_ID=embed.size(0) - 1, value_net=value_net)
+                         l2_norm=args.l2_norm, PADDING_ID=embed.size(0) - 1, value_net=value_net,
+                         seed=args.seed)
     '''
     REC AGENT
     '''
@@ -71,13 +109,11 @@ def evaluate(args, kg, dataset, filename):
     # Rec Agent
     rec_agent = RecAgent(device=args.device, memory=rec_memory, action_size=embed.size(1),
                          hidden_size=args.hidden_size, gcn_net=gcn_net, learning_rate=args.learning_rate,
-                         l2_norm=args.l2_norm, PADDING_ID=embed.size(0) - 1, value_net=value_net)
+                         l2_norm=args.l2_norm, PADDING_ID=embed.size(0) - 1, value_net=value_net,
+                         seed=args.seed + 1)
     # load parameters
-    print('Loading Model in epoch {}'.format(args.load_rl_epoch))
-    ask_agent.load_model(data_name=args.data_name, filename=filename, epoch_user=args.load_rl_epoch)
-    rec_agent.load_model(data_name=args.data_name, filename=filename, epoch_user=args.load_rl_epoch)
-    value_net.load_value_net(data_name=args.data_name, filename=filename, epoch_user=args.load_rl_epoch)
-    _ = rl_evaluate(args, kg, dataset, filename, args.load_rl_epoch, ask_agent, rec_agent)
+    load_agents(args, filename, ask_agent, rec_agent, value_net, resume=False)
+    return ask_agent, rec_agent
 
 
 if __name__ == '__main__':
@@ -39,17 +39,33 @@ class GraphConvolution(Module):
             return output
 
 
+def _keep_embedding(module, state_dict, prefix, *args):
+    # a fixed pretrained table may be a read-only memory map: load it onto itself (copy_ is a no-op)
+    if prefix + 'weight' in state_dict:
+        state_dict[prefix + 'weight'] = module.weight
+
+
 class GraphEncoder(Module):
     def __init__(self, device, entity, emb_size, kg, embeddings=None, fix_emb=True, seq='rnn', gcn=True,
-                 hidden_size=100, layers=1, rnn_layer=1):
+                 hidden_size=100, layers=1, rnn_layer=1, user_num=None, item_num=None, pretrained_emb=False):
+        """
+        :param pretrained_emb: initialize the embedding from embeddings. A fixed embedding shares their
+            memory (e.g. the memory-mapped embedding store) and is not overwritten by load_state_dict;
+            a trained one gets its own copy. Otherwise embeddings are ignored, as before.
+        """
         super(GraphEncoder, self).__init__()
-        self.embedding = nn.Embedding(entity, emb_size, padding_idx=entity - 1)
-        if embeddings is not None:
+        if embeddings is not None and pretrained_emb:
             print("pre-trained embeddings")
-            self.embedding.from_pretrained(embeddings, freeze=fix_emb)
+            self.embedding = nn.Embedding.from_pretrained(embeddings if fix_emb else embeddings.clone(),
+                                                          freeze=fix_emb, padding_idx=entity - 1)
+            if fix_emb:
+                self.embedding.register_load_state_dict_pre_hook(_keep_embedding)
+        else:
+            self.embedding = nn.Embedding(entity, emb_size, padding_idx=entity - 1)
         self.layers = layers
-        self.user_num = len(kg.G['user'])
-        self.item_num = len(kg.G['item'])
+        # without kg (inference bundles) the sizes are given
+        self.user_num = len(kg.G['user']) if kg is not None else user_num
+        self.item_num = len(kg.G['item']) if kg is not None else item_num
         self.PADDING_ID = entity - 1
         self.device = device
         self.seq = seq
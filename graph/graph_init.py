@@ -1,4 +1,5 @@
 import argparse
+from contextlib import contextmanager
 from utils.utils import *
 from graph.graph_process.lastfm_star_data_process import LastFmStarDataset
 from graph.graph_process.lastfm_graph import LastFmGraph
@@ -10,6 +11,9 @@ from graph.graph_process.movie_graph import MovieGraph
 from graph.graph_process.movie_data_process import MovieDataset
 from graph.graph_process.folkscope_graph import FolkscopeGraph
 from graph.graph_process.folkscope_data_process import FolkscopeDataset
+from graph.graph_process import graph_builder, json_stream
+from utils import kg_format, embed_store
+from utils.build_cache import BuildCache, PROJECT_ROOT, project_path
 DatasetDict = {
         LAST_FM_STAR: LastFmStarDataset,
         YELP_STAR: YelpDataset,
@@ -26,42 +30,114 @@ GraphDict = {
 }
 
 
+@contextmanager
+def working_dir(path):
+    """Run a builder reading relative paths in path, then restore the working directory of the caller"""
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def build_from_raw(data_name, cache):
+    """raw files -> dataset.pkl -> kg"""
+    raw_dir = RAW_DATA_DIR[data_name]
+    processed_dir = PROCESSED_DATA_DIR[data_name]
+    built = {}
+
+    def build_dataset():
+        print('Load', data_name, 'from file...')
+        print(raw_dir)
+        if not os.path.isdir(raw_dir):
+            os.makedirs(raw_dir)
+        built['dataset'] = DatasetDict[data_name](raw_dir)
+        save_dataset(data_name, built['dataset'])
+        print('Save', data_name, 'dataset successfully!')
+
+    def build_kg():
+        # Generate graph instance for 'data_name', from the dataset just built when there is one
+        print('Create', data_name, 'graph from data_name...')
+        dataset = built['dataset'] if 'dataset' in built else load_dataset(data_name)
+        kg = GraphDict[data_name](dataset)
+        save_kg(data_name, kg)
+        print('Save', data_name, 'graph successfully!')
+
+    cache.run('dataset', inputs=[raw_dir + '/Graph_generate_data'], code=[DatasetDict[data_name], json_stream],
+              outputs=[processed_dir + '/dataset.pkl'], build=build_dataset)
+    cache.run('kg', inputs=[processed_dir + '/dataset.pkl'], code=[GraphDict[data_name], graph_builder, kg_format],
+              outputs=[processed_dir + '/kg/meta.json'], build=build_kg)
+
+
+def build_from_kg(data_name, cache):
+    """BOOK / MOVIE: raw files -> kg -> dataset.pkl"""
+    processed_dir = PROCESSED_DATA_DIR[data_name]
+
+    def build_kg():
+        # the graph builders chdir('../') from graph/ and read relative to the project root
+        with working_dir(os.path.join(PROJECT_ROOT, 'graph')):
+            kg = GraphDict[data_name]()
+            save_kg(data_name, kg)
+
+    def build_dataset():
+        with working_dir(PROJECT_ROOT):
+            dataset = DatasetDict[data_name]()
+            save_dataset(data_name, dataset)
+
+    cache.run('kg', inputs=[RAW_DATA_DIR[data_name]], code=[GraphDict[data_name], graph_builder, kg_format],
+              outputs=[processed_dir + '/kg/meta.json'], build=build_kg)
+    cache.run('dataset', inputs=[processed_dir + '/kg'], code=[DatasetDict[data_name], kg_format],
+              outputs=[processed_dir + '/dataset.pkl'], build=build_dataset)
+
+
+def build_embed_stores(data_name, cache, dtype):
+    """embeds/<embed>.pkl -> memory-mapped embedding store embeds/<embed>/"""
+    embed_dir = PROCESSED_DATA_DIR[data_name] + '/embeds'
+    if not os.path.isdir(project_path(embed_dir)):
+        return
+    for file in sorted(os.listdir(project_path(embed_dir))):
+        if not file.endswith('.pkl'):
+            continue
+        embed = file[:-len('.pkl')]
+        cache.run('embed:' + embed, inputs=[embed_dir + '/' + file], code=[embed_store, kg_format],
+                  outputs=[embed_store_path(PROCESSED_DATA_DIR[data_name], embed) + '/meta.json'],
+                  build=lambda: build_embed_store(data_name, embed, dtype), params={'dtype': dtype})
+
+
+def build_embed_store(data_name, embed, dtype):
+    with working_dir(PROJECT_ROOT):
+        convert_embed(data_name, embed, dtype=dtype)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_name', type=str, default=LAST_FM_STAR, choices=[LAST_FM_STAR, YELP_STAR, BOOK, MOVIE, FOLKSCOPE],
                         help='One of {LAST_FM_STAR, YELP_STAR, BOOK, MOVIE, FOLKSCOPE}.')
+    parser.add_argument('--convert_kg', action='store_true',
+                        help='only convert an existing kg.pkl to the memory-mapped graph format')
+    parser.add_argument('--convert_embed', type=str, default='',
+                        help='only convert embeds/<convert_embed>.pkl to the memory-mapped embedding store')
+    parser.add_argument('--embed_dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='dtype of the embedding store')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild every stage even if its inputs and code are unchanged')
     args = parser.parse_args()
-    if args.data_name == 'BOOK':
-        kg = BookGraph()
-        with open('./datasets/processed_data/book/kg.pkl', 'wb') as f:
-            pickle.dump(kg, f)
-        dataset = DatasetDict[args.data_name]()
-        save_dataset(args.data_name, dataset)
-        return
-    elif args.data_name == 'MOVIE':
-        kg = MovieGraph()
-        with open('./datasets/processed_data/movie/kg.pkl', 'wb') as f:
-            pickle.dump(kg, f)
-        dataset = DatasetDict[args.data_name]()
-        save_dataset(args.data_name, dataset)
+    if args.convert_kg or args.convert_embed:
+        if args.convert_kg:
+            convert_kg(args.data_name)
+        if args.convert_embed:
+            convert_embed(args.data_name, args.convert_embed, dtype=args.embed_dtype)
         return
 
-    print('Load', args.data_name, 'from file...')
-    print(RAW_DATA_DIR[args.data_name])
-    if not os.path.isdir(RAW_DATA_DIR[args.data_name]):
-        os.makedirs(RAW_DATA_DIR[args.data_name])
-    dataset = DatasetDict[args.data_name](RAW_DATA_DIR[args.data_name])
-    save_dataset(args.data_name, dataset)
-    print('Save', args.data_name, 'dataset successfully!')
-
-    # Generate graph instance for 'data_name'
-    print('Create', args.data_name, 'graph from data_name...')
-    dataset = load_dataset(args.data_name)
-    kg = GraphDict[args.data_name](dataset)
-    save_kg(args.data_name, kg)
-    print('Save', args.data_name, 'graph successfully!')
+    cache = BuildCache(PROCESSED_DATA_DIR[args.data_name], force=args.force)
+    if args.data_name in [BOOK, MOVIE]:
+        build_from_kg(args.data_name, cache)
+    else:
+        build_from_raw(args.data_name, cache)
+    build_embed_stores(args.data_name, cache, args.embed_dtype)
+    cache.summary()
 
 
 if __name__ == '__main__':
     main()
-
@@ -1,12 +1,12 @@
 import pickle
+from utils.utils import load_kg, BOOK
 from easydict import EasyDict
 # import os
 # os.chdir("../")
 
 class BookDataset(object):
     def __init__(self):
-        with open('./datasets/processed_data/book/kg.pkl','rb') as f:
-            kg=pickle.load(f)
+        kg=load_kg(BOOK)
         entity_id=list(kg.G['user'].keys())
         m=EasyDict(id=entity_id, value_len=max(entity_id)+1)
         setattr(self,'user',m)
@@ -0,0 +1,101 @@
+from itertools import chain
+
+import numpy as np
+
+from utils.kg_format import KG_FORMAT_VERSION
+
+
+def relation_edges(relation):
+    """
+    :param relation: relation with heads / tails edge arrays (streamed datasets), or with
+                     data[head_id] = tail ids (datasets pickled before)
+    :return: heads, tails as int64 edge arrays
+    """
+    if 'heads' in relation:
+        return np.asarray(relation.heads, dtype=np.int64), np.asarray(relation.tails, dtype=np.int64)
+    data = relation.data
+    lengths = np.fromiter((len(te_ids) for te_ids in data), dtype=np.int64, count=len(data))
+    heads = np.repeat(np.arange(len(data), dtype=np.int64), lengths)
+    tails = np.fromiter(chain.from_iterable(data), dtype=np.int64, count=int(lengths.sum()))
+    return heads, tails
+
+
+def unique_edges(nodes, neighbors):
+    """Deduplicate (node, neighbor) pairs, sorted by node then neighbor"""
+    if len(nodes) == 0:
+        return nodes, neighbors
+    width = int(neighbors.max()) + 1
+    keys = np.unique(nodes * width + neighbors)
+    return keys // width, keys % width
+
+
+def edges_to_csr(nodes, neighbors, size):
+    """
+    :return: offsets [size+1], indices: the sorted, deduplicated neighbors of node i are
+             indices[offsets[i]:offsets[i+1]]
+    """
+    if len(nodes) and (nodes.min() < 0 or nodes.max() >= size):
+        raise KeyError('node id out of range [0, {})'.format(size))
+    nodes, neighbors = unique_edges(nodes, neighbors)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(nodes, minlength=size))
+    return offsets, neighbors
+
+
+def build_graph_arrays(dataset):
+    """
+    Build the KG of a dataset (YelpDataset, LastFmStarDataset, FolkscopeDataset, ...) as CSR arrays:
+    the edges of every relation are collected as (head, tail) arrays, symmetrized, then deduplicated
+    and sorted with numpy. Same adjacency as the former per-edge dict builder.
+    :return: arguments of CSRGraph (arrays, meta, extras)
+    """
+    data_relations, data_relations_name, link_entity_type = dataset.get_relation()
+    print('load entities...')
+    sizes = {}
+    for entity in data_relations:
+        sizes[entity] = getattr(dataset, entity).value_len
+        print('load entity:{:s}  : Total {:d} nodes.'.format(entity, sizes[entity]))
+    print('ALL total {:d} nodes.'.format(sum(sizes.values())))
+    print('===============END==============')
+
+    edges = {}  # (entity, relation) -> [(nodes, neighbors)]
+    for relation in data_relations_name:
+        print('Load knowledge {}...'.format(relation))
+        heads, tails = relation_edges(getattr(dataset, relation))
+        e_head_type, e_tail_type = link_entity_type[relation]
+        # both directions, like _add_edge
+        edges.setdefault((e_head_type, relation), []).append((heads, tails))
+        edges.setdefault((e_tail_type, relation), []).append((tails, heads))
+        print('Total {:d} {:s} edges.'.format(2 * len(unique_edges(heads, tails)[0]), relation))
+    print('===============END==============')
+
+    arrays = {}
+    meta = {'version': KG_FORMAT_VERSION, 'entities': {}, 'extras': False}
+    for entity, size in sizes.items():
+        relations = list(data_relations[entity].keys())
+        arrays[entity + '.ids'] = np.arange(size, dtype=np.int64)
+        for r in relations:
+            parts = edges.get((entity, r), [])
+            nodes = np.concatenate([p[0] for p in parts]) if parts else np.zeros(0, dtype=np.int64)
+            neighbors = np.concatenate([p[1] for p in parts]) if parts else np.zeros(0, dtype=np.int64)
+            offsets, indices = edges_to_csr(nodes, neighbors, size)
+            arrays['{}.{}.offsets'.format(entity, r)] = offsets
+            arrays['{}.{}.indices'.format(entity, r)] = indices
+        meta['entities'][entity] = relations
+    return {'arrays': arrays, 'meta': meta, 'extras': {}}
+
+
+def build_feature_index(small_to_large):
+    """Feature name -> feature id, in the key order of small_to_large"""
+    return {key: i for i, key in enumerate(small_to_large.keys())}
+
+
+def group_edges(heads, tails, keys):
+    """
+    Group an edge list by head in one pass, keeping the edge order
+    :return: {head: tuple(tails)} for every head in keys
+    """
+    groups = {key: [] for key in keys}
+    for head, tail in zip(heads, tails):
+        groups[head].append(tail)
+    return {key: tuple(value) for key, value in groups.items()}
@@ -0,0 +1,91 @@
+import json
+import re
+from array import array
+
+import numpy as np
+from easydict import EasyDict as edict
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DELIMITERS = ' \t\n\r,:]}'
+
+
+def iter_json_items(path, chunk_size=1 << 20):
+    """
+    Yield the (key, value) pairs of a top-level JSON object, reading the file incrementally.
+    Memory is bounded by chunk_size plus the largest single value, whatever the file size.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buf, pos, eof = '', 0, False
+
+        def more():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        def next_char():
+            nonlocal pos
+            while True:
+                pos = _WHITESPACE.match(buf, pos).end()
+                if pos < len(buf):
+                    return buf[pos]
+                if eof:
+                    raise ValueError('Unexpected end of {}'.format(path))
+                more()
+
+        def decode():
+            nonlocal pos
+            while True:
+                next_char()
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # a number cut by the end of the buffer continues in the next chunk
+                    if eof or (end < len(buf) and buf[end] in _DELIMITERS):
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                more()
+
+        more()
+        if next_char() != '{':
+            raise ValueError('{} is not a JSON object'.format(path))
+        pos += 1
+        if next_char() == '}':
+            return
+        while True:
+            key = decode()
+            if next_char() != ':':
+                raise ValueError('Expected ":" in {}'.format(path))
+            pos += 1
+            yield key, decode()
+            c = next_char()
+            pos += 1
+            if c == '}':
+                return
+            if c != ',':
+                raise ValueError('Expected "," or "}}" in {}'.format(path))
+
+
+class EdgeList(object):
+    """Compact (head, tail) edge buffer of one relation, filled while streaming the raw files
+
+    """
+    def __init__(self):
+        self.heads = array('q')
+        self.tails = array('q')
+
+    def add(self, head_id, tail_ids):
+        self.heads.extend([head_id] * len(tail_ids))
+        self.tails.extend(tail_ids)
+
+    def __len__(self):
+        return len(self.tails)
+
+    def to_relation(self):
+        """Relation with heads / tails edge arrays, consumed by graph_builder"""
+        return edict(heads=np.frombuffer(self.heads, dtype=np.int64),
+                     tails=np.frombuffer(self.tails, dtype=np.int64))
@@ -1,8 +1,9 @@
-import json
 import os
 
 from easydict import EasyDict as edict
 
+from graph.graph_process.json_stream import iter_json_items, EdgeList
+
 
 class LastFmStarDataset(object):
     def __init__(self, data_dir):
@@ -47,18 +48,29 @@ class LastFmStarDataset(object):
         return fm_relation, relation_name, fm_relation_link_entity_type
 
     def load_entities(self):
+        """
+        Stream the entity files, collecting on the way the edges of the relations stored in the same
+        file, so that every raw file is parsed once
+        """
+        self.edges = edict({name: EdgeList() for name in ['interact', 'friends', 'like', 'belong_to']})
         entity_files = edict(
             user='user_dict.json',
             item='item_dict.json',
             feature='original_tag_map.json',
         )
         for entity_name in entity_files:
-            with open(os.path.join(self.data_dir, entity_files[entity_name]), encoding='utf-8') as f:
-                mydict = json.load(f)
-            if entity_name == 'feature':
-                entity_id = list(mydict.values())
-            else:
-                entity_id = list(map(int, list(mydict.keys())))
+            entity_id = []
+            for key, value in iter_json_items(os.path.join(self.data_dir, entity_files[entity_name])):
+                if entity_name == 'feature':
+                    entity_id.append(value)
+                    continue
+                head_id = int(key)
+                entity_id.append(head_id)
+                if entity_name == 'user':
+                    self.edges.friends.add(head_id, value['friends'])
+                    self.edges.like.add(head_id, value['like'])
+                else:
+                    self.edges.belong_to.add(head_id, value['feature_index'])
             setattr(self, entity_name, edict(id=entity_id, value_len=max(entity_id) + 1))
             print('Load', entity_name, 'of size', len(entity_id))
             print(entity_name, 'of max id is', max(entity_id))
@@ -66,43 +78,11 @@ class LastFmStarDataset(object):
     def load_relations(self):
         """
         relation: head entity---> tail entity
-        --
+        Stream the remaining relation file and keep every relation as (heads, tails) edge arrays
         """
-        LastFm_relations = edict(
-            interact=('user_item.json', self.user, self.item),  # (filename, head_entity, tail_entity)
-            friends=('user_dict.json', self.user, self.user),
-            like=('user_dict.json', self.user, self.feature),
-            belong_to=('item_dict.json', self.item, self.feature),
-        )
-        for name in LastFm_relations:
-            #  Save tail_entity
-            relation = edict(
-                data=[],
-            )
-            knowledge = [list([]) for i in range(LastFm_relations[name][1].value_len)]
-            # load relation files
-            with open(os.path.join(self.data_dir, LastFm_relations[name][0]), encoding='utf-8') as f:
-                mydict = json.load(f)
-            if name in ['interact']:
-                for key, value in mydict.items():
-                    head_id = int(key)
-                    tail_ids = value
-                    knowledge[head_id] = tail_ids
-            elif name in ['friends', 'like']:
-                for key in mydict.keys():
-                    head_str = key
-                    head_id = int(key)
-                    tail_ids = mydict[head_str][name]
-                    knowledge[head_id] = tail_ids
-            elif name in ['belong_to']:
-                for key in mydict.keys():
-                    head_str = key
-                    head_id = int(key)
-                    tail_ids = mydict[head_str]['feature_index']
-                    knowledge[head_id] = tail_ids
-            relation.data = knowledge
-            setattr(self, name, relation)
-            tuple_num = 0
-            for i in knowledge:
-                tuple_num += len(i)
-            print('Load', name, 'of size', tuple_num)
+        for key, value in iter_json_items(os.path.join(self.data_dir, 'user_item.json')):
+            self.edges.interact.add(int(key), value)
+        for name, edges in self.edges.items():
+            setattr(self, name, edges.to_relation())
+            print('Load', name, 'of size', len(edges))
+        del self.edges
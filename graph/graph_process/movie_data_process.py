@@ -1,11 +1,11 @@
 import pickle
+from utils.utils import load_kg, MOVIE
 from easydict import EasyDict
 # import os
 # os.chdir("../")
 class MovieDataset(object):
     def __init__(self):
-        with open('./datasets/processed_data/movie/kg.pkl', 'rb') as f:
-            kg=pickle.load(f)
+        kg=load_kg(MOVIE)
         entity_id=list(kg.G['user'].keys())
         m=EasyDict(id=entity_id, value_len=max(entity_id)+1)
         setattr(self,'user',m)
@@ -4,10 +4,18 @@ from tqdm import tqdm
 import pickle
 import json
 
+from graph.graph_process.graph_builder import build_feature_index, group_edges
+
+
 class MovieGraph(object):
     def __init__(self):
         self.G = dict()
         self.__get_user__()
+        with open('./datasets/raw_data/movie/fea_item/item_feature.pkl', 'rb') as f:
+            self.item_feature = pickle.load(f)
+        with open('./datasets/raw_data/movie/fea_item/small_to_large.pkl', 'rb') as f:
+            self.small_to_large = pickle.load(f)
+        self.feature_index = build_feature_index(self.small_to_large)
         self.__get_item__()
         self.__get_feature__()
 
@@ -26,69 +34,36 @@ class MovieGraph(object):
                 self.G['user'][int(user)]['like'] = tuple(())
 
     def __get_item__(self):
-        with open('./datasets/raw_data/movie/fea_item/item_feature.pkl', 'rb') as f:
-            item_feature = pickle.load(f)
-        with open('./datasets/raw_data/movie/fea_item/small_to_large.pkl', 'rb') as f:
-            small_to_large = pickle.load(f)
-        feature_index = {}
-        i = 0
-        for key in small_to_large.keys():
-            if key in feature_index:
-                continue
-            else:
-                feature_index[key] = i
-                i += 1
         self.G['item'] = {}
-        feature_index = {}
-        i = 0
-        for key in small_to_large.keys():
-            if key in feature_index:
-                continue
-            else:
-                feature_index[key] = i
-                i += 1
-        for item in item_feature:
+        for item in self.item_feature:
             self.G['item'][item] = {}
-            fea = []
-            for feature in item_feature[item]:
-                if feature not in small_to_large:
-                    continue
-                fea.append(feature_index[feature])
+            fea = [self.feature_index[feature] for feature in self.item_feature[item]
+                   if feature in self.small_to_large]
             self.G['item'][item]['belong_to'] = tuple(set(fea))
             self.G['item'][item]['interact'] = tuple(())
             self.G['item'][item]['belong_to_large'] = tuple(())
+        # item <- user edges, grouped by item
+        items, users = [], []
         for user in self.G['user']:
             for item in self.G['user'][user]['interact']:
-                self.G['item'][item]['interact'] += tuple([user])
+                items.append(item)
+                users.append(user)
+        for item, item_users in group_edges(items, users, self.G['item']).items():
+            self.G['item'][item]['interact'] = item_users
 
     def __get_feature__(self):
-        with open('./datasets/raw_data/movie/fea_item/item_feature.pkl', 'rb') as f:
-            item_feature = pickle.load(f)
-        with open('./datasets/raw_data/movie/fea_item/small_to_large.pkl', 'rb') as f:
-            small_to_large = pickle.load(f)
-        feature_index = {}
-        i = 0
-        for key in small_to_large.keys():
-            if key in feature_index:
-                continue
-            else:
-                feature_index[key] = i
-                i += 1
         self.G['feature'] = {}
-        feature_index = {}
-        i = 0
-        for key in small_to_large.keys():
-            if key in feature_index:
-                continue
-            else:
-                feature_index[key] = i
-                i += 1
-        for key in small_to_large:
-            idx = feature_index[key]
+        for key in self.small_to_large:
+            idx = self.feature_index[key]
             self.G['feature'][idx] = {}
-            self.G['feature'][idx]['link_to_feature'] = tuple(small_to_large[key])
+            self.G['feature'][idx]['link_to_feature'] = tuple(self.small_to_large[key])
             self.G['feature'][idx]['like'] = tuple(())
             self.G['feature'][idx]['belong_to'] = tuple(())
+        # feature <- item edges, grouped by feature
+        features, items = [], []
         for item in self.G['item']:
             for feature in self.G['item'][item]['belong_to']:
-                self.G['feature'][feature]['belong_to'] += tuple([item])
+                features.append(feature)
+                items.append(item)
+        for feature, feature_items in group_edges(features, items, self.G['feature']).items():
+            self.G['feature'][feature]['belong_to'] = feature_items
@@ -10,10 +10,13 @@ from rl.network.network_advantage import AdvantageNetwork
 from rl.network.network_termination import TerminationNetwork
 from rl.recommend_env.env_variable_question import VariableRecommendEnv
 from utils.utils import *
+from utils.event_log import get_logger
+from utils.timing import timer
 from graph.gcn import StateTransitionProb
 import warnings
 
 warnings.filterwarnings("ignore")
+log = get_logger('agent')
 
 RecommendEnv = {
     LAST_FM_STAR:  VariableRecommendEnv,
@@ -32,8 +35,10 @@ Transition = namedtuple('Transition',
 
 class AskAgent(object):
     def __init__(self, device, memory, action_size, hidden_size, gcn_net, learning_rate, l2_norm,
-                 PADDING_ID, value_net, EPS_END=0.1, tau=0.01, alpha=1):
+                 PADDING_ID, value_net, EPS_END=0.1, tau=0.01, alpha=1, seed=None):
         self.EPS_END = EPS_END
+        # Dedicated exploration RNG, independent of the global random state
+        self.rng = random.Random(seed)
         self.device = device
         self.alpha = alpha
         # GCN+Transformer Embedding
@@ -72,7 +77,7 @@ class AskAgent(object):
         state_emb = self.gcn_net([state])
         cand_features = torch.LongTensor([cand_features]).to(self.device)
         cand_emb = self.gcn_net.embedding(cand_features)
-        sample = random.random()
+        sample = self.rng.random()
         eps_threshold = self.EPS_END
         '''
         Greedy Soft Policy
@@ -83,9 +88,9 @@ class AskAgent(object):
                 chosen_feature = cand_features[0][actions_value.argmax().item()]
                 return chosen_feature
         else:
-            shuffled_cand = features_space
-            random.shuffle(shuffled_cand)
-            return torch.tensor(shuffled_cand[0], device=self.device, dtype=torch.long)
+            # sample an index directly instead of shuffling the whole action space
+            random_action = features_space[self.rng.randrange(len(features_space))]
+            return torch.tensor(random_action, device=self.device, dtype=torch.long)
 
     def update_target_model(self):
         # soft assign
@@ -98,89 +103,96 @@ class AskAgent(object):
 
         self.update_target_model()
 
-        idxs, transitions, is_weights = self.memory.sample(BATCH_SIZE)
-        batch = Transition(*zip(*transitions))
-        non_final_mask = torch.tensor(tuple(map(lambda s: s is not None, batch.next_state)), device=self.device, dtype=torch.uint8)
-
-        n_states = []
-        n_cand_features = []
-        n_cand_items = []
-        for s, ci, cf in zip(batch.next_state, batch.next_cand_items, batch.next_cand_features):
-            if s is not None:
-                n_states.append(s)
-                n_cand_items.append(ci)
-                n_cand_features.append(cf)
+        with timer.phase('sample'):
+            idxs, transitions, is_weights = self.memory.sample(BATCH_SIZE)
+        with timer.phase('collate'):
+            batch = Transition(*zip(*transitions))
+            non_final_mask = torch.tensor(tuple(map(lambda s: s is not None, batch.next_state)), device=self.device, dtype=torch.uint8)
+
+            n_states = []
+            n_cand_features = []
+            n_cand_items = []
+            for s, ci, cf in zip(batch.next_state, batch.next_cand_items, batch.next_cand_features):
+                if s is not None:
+                    n_states.append(s)
+                    n_cand_items.append(ci)
+                    n_cand_features.append(cf)
         if not n_states:
             return 0, 0
 
         '''
         Critic Loss. Termination Loss.
         '''
-        next_state_emb_batch = self.gcn_net(n_states)
-        state_emb_batch = self.gcn_net(list(batch.state))
+        with timer.phase('gcn_forward'):
+            next_state_emb_batch = self.gcn_net(n_states)
+            state_emb_batch = self.gcn_net(list(batch.state))
         
-        q_value = self.value_net(state_emb_batch)
-        q_value_next = self.value_net(next_state_emb_batch)
+        with timer.phase('q_targets'):
+            q_value = self.value_net(state_emb_batch)
+            q_value_next = self.value_net(next_state_emb_batch)
         
-        q_now_features, q_next_features = self.calculate_q_score(BATCH_SIZE, batch, next_state_emb_batch, n_cand_features, state_emb_batch)
-        _, q_next_items = self.calculate_q_score(BATCH_SIZE, batch, next_state_emb_batch, n_cand_items, state_emb_batch, rec_agent)
+            q_now_features, q_next_features = self.calculate_q_score(BATCH_SIZE, batch, next_state_emb_batch, n_cand_features, state_emb_batch)
+            _, q_next_items = self.calculate_q_score(BATCH_SIZE, batch, next_state_emb_batch, n_cand_items, state_emb_batch, rec_agent)
 
-        next_termination = self.termination_net(next_state_emb_batch)
-        termination = self.termination_net(state_emb_batch)
+            next_termination = self.termination_net(next_state_emb_batch)
+            termination = self.termination_net(state_emb_batch)
 
-        reward_batch = torch.FloatTensor(np.array(batch.reward).astype(float).reshape(-1, 1)).squeeze().to(self.device)
+            reward_batch = torch.FloatTensor(np.array(batch.reward).astype(float).reshape(-1, 1)).squeeze().to(self.device)
 
-        q_cat = torch.cat((q_next_features.unsqueeze(0), q_next_items.unsqueeze(0)), dim=0)
-        q_softmax_score = torch.softmax(q_cat, dim=0)
-        q_softmax = torch.sum(torch.multiply(q_softmax_score, q_cat), dim=0)
+            q_cat = torch.cat((q_next_features.unsqueeze(0), q_next_items.unsqueeze(0)), dim=0)
+            q_softmax_score = torch.softmax(q_cat, dim=0)
+            q_softmax = torch.sum(torch.multiply(q_softmax_score, q_cat), dim=0)
 
-        q_max, _ = torch.max(torch.cat((q_next_features.unsqueeze(0), q_next_items.unsqueeze(0))), dim=0)
+            q_max, _ = torch.max(torch.cat((q_next_features.unsqueeze(0), q_next_items.unsqueeze(0))), dim=0)
         
-        q_now_target = reward_batch
-        q_estim = q_max
-        # q_estim = q_value
-        # q_estim = q_softmax
-        q_now_target[non_final_mask] += GAMMA * ((1-next_termination) * q_next_features[non_final_mask]
-                                                 + next_termination * q_estim[non_final_mask])
-        # q_now_target = q_now_features + self.alpha * (q_now_target - q_now_features)
+            q_now_target = reward_batch
+            q_estim = q_max
+            # q_estim = q_value
+            # q_estim = q_softmax
+            q_now_target[non_final_mask] += GAMMA * ((1-next_termination) * q_next_features[non_final_mask]
+                                                     + next_termination * q_estim[non_final_mask])
+            # q_now_target = q_now_features + self.alpha * (q_now_target - q_now_features)
 
         # prioritized experience replay
-        errors = (q_now_features - q_now_target).detach().cpu().squeeze().tolist()
-        self.memory.update(idxs, errors)
+        with timer.phase('priority_update'):
+            errors = (q_now_features - q_now_target).detach().cpu().squeeze().tolist()
+            self.memory.update(idxs, errors)
 
         # Critic loss
-        critic_loss = (torch.FloatTensor(is_weights).to(self.device) * self.loss_func(q_now_features, q_now_target.detach())).mean()
-        # termination loss
-        termination_loss = next_termination * (q_next_features[non_final_mask].detach() - q_value_next.detach() - term_reg)
-        termination_loss = (torch.FloatTensor(is_weights).to(self.device)[non_final_mask] * termination_loss).mean()
+        with timer.phase('backward'):
+            critic_loss = (torch.FloatTensor(is_weights).to(self.device) * self.loss_func(q_now_features, q_now_target.detach())).mean()
+            # termination loss
+            termination_loss = next_termination * (q_next_features[non_final_mask].detach() - q_value_next.detach() - term_reg)
+            termination_loss = (torch.FloatTensor(is_weights).to(self.device)[non_final_mask] * termination_loss).mean()
         
-        # update
-        self.optimizer.zero_grad()
-        self.optimizer_termination.zero_grad()
+            # update
+            self.optimizer.zero_grad()
+            self.optimizer_termination.zero_grad()
 
-        critic_loss.backward()
-        termination_loss.backward()
+            critic_loss.backward()
+            termination_loss.backward()
 
-        self.optimizer.step()
-        self.optimizer_termination.step()
+            self.optimizer.step()
+            self.optimizer_termination.step()
 
         # state transition loss
-        states = []
-        actions = []
-        rewards = []
-        for s, a, r in zip(batch.state, batch.action, batch.reward):
-            if s is not None:
-                states.append(s)
-                actions.append([a])
-                if r <= 0:
-                    rewards.append(torch.FloatTensor([0]))
-                else:
-                    rewards.append(torch.FloatTensor([1]))
-        infer_reward = self.state_inferrer(states, torch.LongTensor(actions))
-        transition_loss = (self.loss_func(infer_reward, torch.stack(rewards).to(self.device))).mean()
-        self.optimizer_state.zero_grad()
-        transition_loss.backward()
-        self.optimizer_state.step()
+        with timer.phase('state_infer'):
+            states = []
+            actions = []
+            rewards = []
+            for s, a, r in zip(batch.state, batch.action, batch.reward):
+                if s is not None:
+                    states.append(s)
+                    actions.append([a])
+                    if r <= 0:
+                        rewards.append(torch.FloatTensor([0]))
+                    else:
+                        rewards.append(torch.FloatTensor([1]))
+            infer_reward = self.state_inferrer(states, torch.LongTensor(actions))
+            transition_loss = (self.loss_func(infer_reward, torch.stack(rewards).to(self.device))).mean()
+            self.optimizer_state.zero_grad()
+            transition_loss.backward()
+            self.optimizer_state.step()
 
         return critic_loss.data.item() + termination_loss.data.item(), transition_loss.data.item()
 
@@ -206,7 +218,8 @@ class AskAgent(object):
             q_next = torch.zeros((BATCH_SIZE), device=self.device)
             q_next[non_final_mask] = torch.FloatTensor(ask_Q).to(self.device)
 
-            print("Q now:{}, Q next:{}, V next:{}".format(q_now[0], q_next[0], next_state_value[0]))
+            if log.debug_enabled:
+                log.debug('q_values', 'Q now:{}, Q next:{}, V next:{}', q_now[0], q_next[0], next_state_value[0])
             return q_now, q_next.detach()
         else:
             action_batch = torch.LongTensor(np.array(batch.action).astype(int).reshape(-1, 1)).to(rec_agent.device)
@@ -230,7 +243,8 @@ class AskAgent(object):
             q_next = torch.zeros((BATCH_SIZE), device=rec_agent.device)
             q_next[non_final_mask] = torch.FloatTensor(rec_Q).to(rec_agent.device)
 
-            print("Q now:{}, Q next:{}, V next:{}".format(q_now[0], q_next[0], next_state_value[0]))
+            if log.debug_enabled:
+                log.debug('q_values', 'Q now:{}, Q next:{}, V next:{}', q_now[0], q_next[0], next_state_value[0])
             return q_now, q_next.detach()
 
     def save_model(self, data_name, filename, epoch_user):
@@ -248,6 +262,30 @@ class AskAgent(object):
         self.termination_net.load_state_dict(model_dict['termination'])
         self.state_inferrer.load_state_dict(model_dict['state'])
 
+    def training_state_dict(self):
+        """
+        Networks (without the gcn / value nets shared by both agents), optimizers and exploration RNG,
+        saved by rl.rl_checkpoint
+        """
+        return {'policy': self.policy_net.state_dict(),
+                'target': self.target_net.state_dict(),
+                'termination': self.termination_net.state_dict(),
+                'state': self.state_inferrer.state_dict(),
+                'optimizer': self.optimizer.state_dict(),
+                'optimizer_termination': self.optimizer_termination.state_dict(),
+                'optimizer_state': self.optimizer_state.state_dict(),
+                'rng': self.rng.getstate()}
+
+    def load_training_state_dict(self, state_dict):
+        self.policy_net.load_state_dict(state_dict['policy'])
+        self.target_net.load_state_dict(state_dict['target'])
+        self.termination_net.load_state_dict(state_dict['termination'])
+        self.state_inferrer.load_state_dict(state_dict['state'])
+        self.optimizer.load_state_dict(state_dict['optimizer'])
+        self.optimizer_termination.load_state_dict(state_dict['optimizer_termination'])
+        self.optimizer_state.load_state_dict(state_dict['optimizer_state'])
+        self.rng.setstate(state_dict['rng'])
+
     def padding(self, cand):
         pad_size = max([len(c) for c in cand])
         padded_cand = []
@@ -1,14 +1,21 @@
-import json
 from utils.utils import *
+from utils.interactions import load_interactions
+from utils.event_log import get_logger
+from utils.timing import timer
 from torch import nn
 
 from tkinter import _flatten
 from collections import Counter
 
+log = get_logger('env')
 
 class VariableRecommendEnv(object):
     def __init__(self, kg, dataset, data_name, embed, seed=1, max_turn=15, cand_feature_num=10, cand_item_num=10, attr_num=20,
-                 mode='train', entropy_way='weight entropy'):
+                 mode='train', entropy_way='weight entropy', shared=None):
+        """
+        :param shared: optional SharedData (utils.shared_data), interactions and embeddings are then
+                       attached from shared memory instead of being loaded from the json / pkl files
+        """
         self.data_name = data_name
         self.mode = mode
         self.seed = seed
@@ -56,7 +63,10 @@ class VariableRecommendEnv(object):
         # self.conver_his = []  # conversation_history
         self.attr_ent = []  # attribute entropy
 
-        self.ui_dict = self.__load_rl_data__(data_name, mode=mode)  # np.array [ u i weight]
+        if shared is not None:
+            self.ui_dict = shared.interactions(mode)
+        else:
+            self.ui_dict = self.__load_rl_data__(data_name, mode=mode)  # user_str -> item ids
         self.user_weight_dict = dict()
         self.user_items_dict = dict()
 
@@ -73,10 +83,16 @@ class VariableRecommendEnv(object):
         #     'feature_emb': feature_emb
         # }
         # load TransE Embedding
-        embeds = load_embed(data_name, embed)
+        if shared is not None and shared.embeds:
+            embeds = shared.embeds
+        else:
+            embeds = load_embed(data_name, embed)
+        # contiguous [user, item, feature, padding] rows when loaded from the embedding store
+        self.embed_table = None
         if embeds:
             self.ui_embeds = embeds['ui_emb']
             self.feature_emb = embeds['feature_emb']
+            self.embed_table = embeds.get('table')
         else:
             self.ui_embeds = nn.Embedding(self.user_length + self.item_length, 64).weight.data.numpy()
             self.feature_emb = nn.Embedding(self.feature_length, 64).weight.data.numpy()
@@ -106,39 +122,26 @@ class VariableRecommendEnv(object):
         self.attr_count_dict = dict()  # This dict is used to calculate entropy
 
     def __load_rl_data__(self, data_name, mode):
+        """
+        :return: InteractionView of the split, memory-mapped from the int32 cache of the json file
+        """
         if mode == 'train':
             # load the interaction records between User and Item
-            with open(os.path.join(RAW_DATA_DIR[data_name], 'UI_Interaction_data/review_dict_train.json'),
-                      encoding='utf-8') as f:
-                print('train_data: load RL train datasets')
-                mydict = json.load(f)
+            print('train_data: load RL train datasets')
         elif mode == 'test':
-            with open(os.path.join(RAW_DATA_DIR[data_name], 'UI_Interaction_data/review_dict_test.json'),
-                      encoding='utf-8') as f:
-            # with open(os.path.join(RAW_DATA_DIR[data_name], 'UI_Interaction_data/review_dict_valid.json'),
-            #           encoding='utf-8') as f:
-                print('test_data: load RL test datasets')
-                mydict = json.load(f)
-        return mydict
+            print('test_data: load RL test datasets')
+        return load_interactions(data_name, mode)
 
     def __user_dict_init__(self):
         """Calculate the weight of the number of interactions per user
         """
-        ui_nums = 0
-        for items in self.ui_dict.values():
-            ui_nums += len(items)
-        for user_str in self.ui_dict.keys():
-            user_id = int(user_str)
-            self.user_weight_dict[user_id] = len(self.ui_dict[user_str]) / ui_nums
+        lengths = self.ui_dict.lengths()
+        ui_nums = int(lengths.sum())
+        self.user_weight_dict = dict(zip(self.ui_dict.users.tolist(), (lengths / ui_nums).tolist()))
         print('user_dict init successfully!')
 
     def __test_tuple_generate__(self):
-        ui_list = []
-        for user_str, items in self.ui_dict.items():
-            user_id = int(user_str)
-            for item_id in items:
-                ui_list.append([user_id, item_id])
-        self.ui_array = np.array(ui_list)
+        self.ui_array = self.ui_dict.pairs().astype(np.int64)
         np.random.shuffle(self.ui_array)
 
     def reset(self, embed=None):
@@ -161,7 +164,9 @@ class VariableRecommendEnv(object):
 
         # init user's profile
         # print('-----------reset state vector------------')
-        print('\nuser_id:{}\ntarget_item:{}\ntarget_feature:{}'.format(self.user_id, self.target_item, self.kg.G['item'][self.target_item]['belong_to']))
+        if log.debug_enabled:
+            log.debug('reset', '\nuser_id:{}\ntarget_item:{}\ntarget_feature:{}', self.user_id, self.target_item,
+                      self.kg.G['item'][self.target_item]['belong_to'], user=self.user_id, item=self.target_item)
         self.reachable_feature = []  # user reachable feature in cur_step
         self.user_acc_feature = []  # user accepted feature which asked by agent
         self.user_rej_feature = []  # user rejected feature which asked by agent
@@ -176,22 +181,28 @@ class VariableRecommendEnv(object):
         user_like_random_fea = random.choice(self.kg.G['item'][self.target_item]['belong_to'])
         self.user_acc_feature.append(user_like_random_fea)  # update user acc_fea
         self.cur_node_set.append(user_like_random_fea)
-        self._update_cand_items(user_like_random_fea, acc_rej=True)
-        self._updata_reachable_feature()  # self.reachable_feature = []
+        with timer.phase('update_cand_items'):
+            self._update_cand_items(user_like_random_fea, acc_rej=True)
+        with timer.phase('update_reachable_feature'):
+            self._updata_reachable_feature()  # self.reachable_feature = []
         # # self.conver_his[self.cur_conver_step] = self.history_dict['acc']
 
-        print('=== init user prefer feature: {}'.format(self.cur_node_set))
-        self._update_feature_entropy()  # update entropy
-        print('reset_reachable_feature num: {}'.format(len(self.reachable_feature)))
+        log.debug('init_feature', '=== init user prefer feature: {}', self.cur_node_set)
+        with timer.phase('feature_entropy'):
+            self._update_feature_entropy()  # update entropy
+        log.debug('reset_reachable', 'reset_reachable_feature num: {}', len(self.reachable_feature))
 
         # Sort reachable features according to the entropy of features
-        reach_fea_score = self._feature_score()
-        max_ind_list = (-1 * np.array(reach_fea_score)).argsort()[:self.cand_feature_num]
-        max_fea_id = [self.reachable_feature[i] for i in max_ind_list]
-        [self.reachable_feature.remove(v) for v in max_fea_id]
-        [self.reachable_feature.insert(0, v) for v in max_fea_id[::-1]]
+        with timer.phase('feature_score'):
+            reach_fea_score = self._feature_score()
+            max_ind_list = (-1 * np.array(reach_fea_score)).argsort()[:self.cand_feature_num]
+            max_fea_id = [self.reachable_feature[i] for i in max_ind_list]
+            [self.reachable_feature.remove(v) for v in max_fea_id]
+            [self.reachable_feature.insert(0, v) for v in max_fea_id[::-1]]
 
-        return self._get_state(), self._get_cand(), self._get_action_space()
+        with timer.phase('get_state'):
+            state = self._get_state()
+        return state, self._get_cand(), self._get_action_space()
 
     def _get_cand(self):
         if self.random_sample_feature:
@@ -262,18 +273,20 @@ class VariableRecommendEnv(object):
 
     def step(self, attribute, items, mode="train", infer=None):
         if infer is None:
-            print('- - - - -turn:{}'.format(self.cur_conver_turn), 'step:{}- - - - -'.format(self.cur_conver_step))
+            log.debug('step', '- - - - -turn:{} step:{}- - - - -', self.cur_conver_turn, self.cur_conver_step)
         else:
-            print('* * * * *turn:{}'.format(self.cur_conver_turn), 'infer Step:{}* * * * *'.format(self.cur_conver_step))
+            log.debug('infer_step', '* * * * *turn:{} infer Step:{}* * * * *', self.cur_conver_turn, self.cur_conver_step)
 
         # ASK
         if attribute is not None:
             asked_feature = self._map_to_old_id(attribute)
-            print('==> Action: ask features {}, max entropy feature {}'.format(asked_feature,
-                                                                              self.reachable_feature[:self.cand_feature_num]))
+            if log.debug_enabled:
+                log.debug('ask', '==> Action: ask features {}, max entropy feature {}', asked_feature,
+                          self.reachable_feature[:self.cand_feature_num], feature=asked_feature)
             # update user's profile:  user_acc_feature & user_rej_feature
             reward, done, acc_rej = self._ask_update(asked_feature, mode=mode, infer=infer)
-            self._update_cand_items(asked_feature, acc_rej)  # update cand_items
+            with timer.phase('update_cand_items'):
+                self._update_cand_items(asked_feature, acc_rej)  # update cand_items
         # RECOMMEND
         else:
 
@@ -292,33 +305,40 @@ class VariableRecommendEnv(object):
                     recom_items.append(self._map_to_old_id(item))
                     if len(recom_items) == self.rec_num:
                         break
-            reward, done = self._recommend_update(recom_items, mode=mode, infer=infer)
+            with timer.phase('recommend_update'):
+                reward, done = self._recommend_update(recom_items, mode=mode, infer=infer)
             if done:
                 done = len(item_queue)
             # ========================================
 
             if reward > 0:
-                print('-->Recommend successfully!')
+                log.debug('recommend_result', '-->Recommend successfully!', reward=reward)
             else:
-                print('-->Recommend fail !')
+                log.debug('recommend_result', '-->Recommend fail !', reward=reward)
 
-        self._updata_reachable_feature()  # update user's profile: reachable_feature
+        with timer.phase('update_reachable_feature'):
+            self._updata_reachable_feature()  # update user's profile: reachable_feature
 
-        print('reachable_feature num: {}'.format(len(self.reachable_feature)))
-        print('cand_item num: {}'.format(len(self.cand_items)))
+        if log.debug_enabled:
+            log.debug('step_result', 'reachable_feature num: {}\ncand_item num: {}', len(self.reachable_feature),
+                      len(self.cand_items), reachable_feature=len(self.reachable_feature), cand_item=len(self.cand_items))
 
-        self._update_feature_entropy()
+        with timer.phase('feature_entropy'):
+            self._update_feature_entropy()
         if len(self.reachable_feature) != 0:  # if reachable_feature == 0 :cand_item= 1
-            reach_fea_score = self._feature_score()
-            max_ind_list = (-1 * np.array(reach_fea_score)).argsort()[:self.cand_feature_num]
-            max_fea_id = [self.reachable_feature[i] for i in max_ind_list]
-            [self.reachable_feature.remove(v) for v in max_fea_id]
-            [self.reachable_feature.insert(0, v) for v in max_fea_id[::-1]]
+            with timer.phase('feature_score'):
+                reach_fea_score = self._feature_score()
+                max_ind_list = (-1 * np.array(reach_fea_score)).argsort()[:self.cand_feature_num]
+                max_fea_id = [self.reachable_feature[i] for i in max_ind_list]
+                [self.reachable_feature.remove(v) for v in max_fea_id]
+                [self.reachable_feature.insert(0, v) for v in max_fea_id[::-1]]
 
         self.cur_conver_step += 1
         if len(self.cand_items) == 0:
             return None, None, None, reward, 1
-        return self._get_state(), self._get_cand(), self._get_action_space(), reward, done
+        with timer.phase('get_state'):
+            state = self._get_state()
+        return state, self._get_cand(), self._get_action_space(), reward, done
 
     def _updata_reachable_feature(self):
         next_reachable_feature = []
@@ -403,7 +423,7 @@ class VariableRecommendEnv(object):
 
     def _update_cand_items(self, asked_feature, acc_rej):
         if acc_rej:  # accept feature
-            print(' ask acc: update cand_items')
+            log.debug('ask_acc', ' ask acc: update cand_items')
             feature_items = self.kg.G['feature'][asked_feature]['belong_to']
             self.cand_items = set(self.cand_items) & set(feature_items)  # itersection
             self.cand_items = list(self.cand_items)
@@ -412,7 +432,7 @@ class VariableRecommendEnv(object):
             feature_items = self.kg.G['feature'][asked_feature]['belong_to']
             self.cand_items = set(self.cand_items) - set(feature_items)  # sub
             self.cand_items = list(self.cand_items)
-            print('XXX ask rej: update cand_items')
+            log.debug('ask_rej', 'XXX ask rej: update cand_items')
 
         # select topk candidate items to recommend
         cand_item_score = self._item_score()
@@ -424,8 +444,9 @@ class VariableRecommendEnv(object):
             self.cand_items, self.cand_item_score = zip(*sort_tuple)
 
     def _recommend_update(self, recom_items, mode="train", infer=None):
-        print('-->action: recommend items: ', recom_items)
-        print(set(recom_items) - set(self.cand_items[: self.rec_num]))
+        if log.debug_enabled:
+            log.debug('recommend', '-->action: recommend items: {}\n{}', recom_items,
+                      set(recom_items) - set(self.cand_items[: self.rec_num]), items=recom_items)
         self.cand_items = list(self.cand_items)
         self.cand_item_score = list(self.cand_item_score)
         if mode == 'test' and infer is not None:
@@ -0,0 +1,249 @@
+import gc
+import time
+import queue
+
+import torch
+import torch.multiprocessing as mp
+
+from rl.rl_memory import Transition, pack_transitions, decode_transitions
+from rl.rl_option_critic import build_agents, new_epoch_stats, optimize_agents, sample_episode, save_epoch_metric, \
+    save_memory_metric, option_critic_pipeline, replay_memories
+from rl.rl_evaluate import rl_evaluate, Evaluator, start_async_evaluator
+from rl.rl_checkpoint import CheckpointManager, load_agents
+from rl.recommend_env.env_variable_question import VariableRecommendEnv
+from utils.utils import *
+from utils.shared_data import publish_shared_data, attach_shared_data
+from utils.timing import timer
+from utils.profiling import profile_window
+
+
+class TransitionBuffer(object):
+    """Actor-side stand-in for ReplayMemoryPER: collect the transitions of one episode
+
+    """
+    def __init__(self):
+        self.transitions = []
+
+    def push(self, *args):
+        self.transitions.append(Transition(*args))
+
+    def drain(self):
+        transitions = self.transitions
+        self.transitions = []
+        return transitions
+
+    def __len__(self):
+        return len(self.transitions)
+
+
+def policy_modules(ask_agent, rec_agent):
+    """The modules an actor needs to sample episodes"""
+    return {'gcn': ask_agent.gcn_net,
+            'value': ask_agent.value_net,
+            'ask_policy': ask_agent.policy_net,
+            'ask_termination': ask_agent.termination_net,
+            'rec_policy': rec_agent.policy_net,
+            'rec_termination': rec_agent.termination_net}
+
+
+def share_policy(ask_agent, rec_agent):
+    """Copy the actor modules' weights into shared memory"""
+    return {name: {k: v.detach().cpu().clone().share_memory_() for k, v in module.state_dict().items()}
+            for name, module in policy_modules(ask_agent, rec_agent).items()}
+
+
+def publish_policy(shared_policy, ask_agent, rec_agent, lock, version):
+    with lock:
+        for name, module in policy_modules(ask_agent, rec_agent).items():
+            for k, v in module.state_dict().items():
+                shared_policy[name][k].copy_(v.detach())
+        version.value += 1
+
+
+def sync_policy(shared_policy, ask_agent, rec_agent, lock):
+    with lock:
+        for name, module in policy_modules(ask_agent, rec_agent).items():
+            module.load_state_dict(shared_policy[name])
+
+
+def actor_seed(args, actor_id):
+    """
+    Seed of an actor, distinct across actors and across the epochs a run is resumed from. Every agent set
+    uses two seeds (ask agent: seed, rec agent: seed + 1), the learner args.seed and args.seed + 1
+    """
+    return args.seed + 2 * (args.load_rl_epoch * args.num_actors + actor_id + 1)
+
+
+def actor_worker(actor_id, args, kg, dataset, shared_policy, lock, version, transition_queue, stop_event,
+                 shared_path=None, decay_step=0):
+    """
+    Sample episodes with a periodically synced copy of the agents and send their transitions to the learner
+    :param shared_path: KG / embeddings / interactions published by publish_shared_data, attached zero-copy
+    :param decay_step: exploration step to start from (resumed runs)
+    """
+    torch.set_num_threads(1)
+    seed = actor_seed(args, actor_id)
+    set_random_seed(seed)
+    shared = None
+    if shared_path is not None:
+        shared = attach_shared_data(shared_path)
+        kg = shared.kg
+    env = VariableRecommendEnv(kg, dataset,
+                               args.data_name, args.embed, seed=seed, max_turn=args.max_turn,
+                               cand_feature_num=args.cand_feature_num, cand_item_num=args.cand_item_num,
+                               attr_num=args.attr_num, mode='train',
+                               entropy_way=args.entropy_method, shared=shared)
+    ask_agent, rec_agent, _ = build_agents(args, kg, env, seed=seed)
+    ask_agent.memory = TransitionBuffer()
+    rec_agent.memory = TransitionBuffer()
+    local_version = -1
+    while not stop_event.is_set():
+        if version.value != local_version:
+            local_version = version.value
+            sync_policy(shared_policy, ask_agent, rec_agent, lock)
+        stats = new_epoch_stats()
+        start_step = decay_step
+        with torch.no_grad():
+            decay_step = sample_episode(args, env, ask_agent, rec_agent, decay_step, stats)
+        # numpy arrays, not tensors: every tensor put on the queue would hold its own shared memory segment
+        # in the learner's replay memory
+        episode = (pack_transitions(ask_agent.memory.drain()), pack_transitions(rec_agent.memory.drain()), stats,
+                   decay_step - start_step)
+        # a full queue blocks the actor until the learner catches up
+        while not stop_event.is_set():
+            try:
+                transition_queue.put(episode, timeout=1)
+                break
+            except queue.Full:
+                continue
+
+
+def merge_epoch_stats(stats, episode_stats):
+    for key, value in episode_stats.items():
+        if isinstance(value, list):
+            stats[key].extend(value)
+        else:
+            stats[key] += value
+
+
+def actor_learner_pipeline(args, kg, dataset, filename):
+    """
+    Actor-learner training: args.num_actors processes sample episodes, this process consumes
+    their transitions from the prioritized replay and optimizes the agents continuously.
+    An epoch ends after args.sample_times episodes have been received.
+    """
+    if str(args.device).startswith('cuda'):
+        print('Actor-learner training is CPU only, falling back to option_critic_pipeline')
+        return option_critic_pipeline(args, kg, dataset, filename)
+    set_random_seed(args.seed)
+    env = VariableRecommendEnv(kg, dataset,
+                               args.data_name, args.embed, seed=args.seed, max_turn=args.max_turn,
+                               cand_feature_num=args.cand_feature_num, cand_item_num=args.cand_item_num,
+                               attr_num=args.attr_num, mode='train',
+                               entropy_way=args.entropy_method)
+    ask_agent, rec_agent, value_net = build_agents(args, kg, env)
+    updates = 0
+    num_transitions = 0
+    # exploration steps of all actors together
+    decay_step = 0
+    # load parameters
+    if args.load_rl_epoch != 0:
+        bundle = load_agents(args, filename, ask_agent, rec_agent, value_net)
+        if bundle is not None:
+            updates = bundle['extra'].get('updates', 0)
+            num_transitions = bundle['extra'].get('num_transitions', 0)
+            decay_step = bundle['extra'].get('decay_step', 0)
+    checkpoints = CheckpointManager(args.data_name, filename, keep=args.checkpoint_keep)
+
+    async_evaluator = start_async_evaluator(args, kg, dataset, filename, ask_agent, rec_agent)
+    shared_path = None
+    if args.shared_data:
+        shared_path = publish_shared_data(args.data_name, kg, args.embed,
+                                          cleanup=not args.shared_data_keep)
+
+    # the actors inherit kg / dataset through fork, freeze them so that gc does not touch (and copy) their pages
+    gc.freeze()
+    ctx = mp.get_context('fork')
+    shared_policy = share_policy(ask_agent, rec_agent)
+    lock = ctx.Lock()
+    version = ctx.Value('i', 0)
+    stop_event = ctx.Event()
+    transition_queue = ctx.Queue(maxsize=4 * args.num_actors)
+    actors = []
+    for actor_id in range(args.num_actors):
+        actor = ctx.Process(target=actor_worker,
+                            args=(actor_id, args, kg, dataset, shared_policy, lock, version, transition_queue,
+                                  stop_event, shared_path, decay_step // args.num_actors),
+                            daemon=True)
+        actor.start()
+        actors.append(actor)
+    print('Start {} actors'.format(args.num_actors))
+
+    # the test env is built at the first evaluation, then reused
+    evaluator = None
+    # episodes are sampled by the actors, the learner can only profile optimize steps
+    profiler = profile_window(args, 'Train-' + filename)
+    try:
+        for epoch in range(1 + args.load_rl_epoch, args.max_epoch + 1):
+            start = time.time()
+            print("\nEpoch: {}, Total: {}".format(epoch, args.max_epoch))
+            stats = new_epoch_stats()
+            timer.reset()
+            episodes = 0
+            while episodes < args.sample_times:
+                # replay-ratio throttling: only optimize while updates lag behind the received transitions
+                can_update = len(ask_agent.memory) >= args.batch_size or len(rec_agent.memory) >= args.batch_size
+                if can_update and updates < args.replay_ratio * num_transitions:
+                    block, timeout = False, None
+                else:
+                    block, timeout = True, 1
+                try:
+                    ask_transitions, rec_transitions, episode_stats, steps = transition_queue.get(block=block,
+                                                                                                   timeout=timeout)
+                except queue.Empty:
+                    episode_stats = None
+                if episode_stats is not None:
+                    for memory, packed in [(ask_agent.memory, ask_transitions), (rec_agent.memory, rec_transitions)]:
+                        n = len(packed['state_index'])
+                        for transition in decode_transitions(packed, n):
+                            memory.push(*transition)
+                        num_transitions += n
+                    merge_epoch_stats(stats, episode_stats)
+                    decay_step += steps
+                    episodes += 1
+                    continue
+
+                if can_update and updates < args.replay_ratio * num_transitions:
+                    with timer.phase('optimize'), profiler.unit('optimize'):
+                        optimize_agents(args, ask_agent, rec_agent, updates % 2, stats)
+                    updates += 1
+                    if updates % args.sync_interval == 0:
+                        publish_policy(shared_policy, ask_agent, rec_agent, lock, version)
+
+            print('Learner updates: {}, transitions: {}'.format(updates, num_transitions))
+            save_epoch_metric(args, filename, epoch, stats, time.time() - start)
+            save_memory_metric(args, filename, epoch, ask_agent, rec_agent)
+            if epoch % args.save_epoch_num == 0:
+                checkpoints.save(epoch, ask_agent, rec_agent, value_net,
+                                 extra={'updates': updates, 'num_transitions': num_transitions,
+                                        'decay_step': decay_step},
+                                 memories=replay_memories(args, ask_agent, rec_agent))
+            if epoch % args.eval_epoch_num == 0:
+                if async_evaluator is not None:
+                    async_evaluator.submit(epoch, ask_agent, rec_agent)
+                else:
+                    if evaluator is None:
+                        evaluator = Evaluator(args, kg, dataset)
+                    _ = rl_evaluate(args, kg, dataset, filename, epoch, ask_agent, rec_agent, evaluator=evaluator)
+    finally:
+        profiler.close()
+        checkpoints.close()
+        if async_evaluator is not None:
+            async_evaluator.close()
+        stop_event.set()
+        for actor in actors:
+            actor.join(timeout=10)
+            if actor.is_alive():
+                actor.terminate()
+        # the actors are gone, hand the objects frozen before the fork back to gc
+        gc.unfreeze()
@@ -0,0 +1,158 @@
+import os
+import random
+import time
+
+import torch
+
+from graph.gcn import GraphEncoder, StateTransitionProb
+from rl.network.network_advantage import AdvantageNetwork
+from rl.network.network_termination import TerminationNetwork
+from rl.network.network_value import ValueNetwork
+from rl.rl_checkpoint import cpu_copy, checkpoint_file
+from utils.utils import CHECKPOINT_DIR
+from utils.interactions import split_fingerprint
+
+# Bumped on incompatible changes of the policy bundle layout
+POLICY_BUNDLE_VERSION = 1
+
+
+def policy_bundle_file(data_name, filename, epoch):
+    return os.path.join(CHECKPOINT_DIR[data_name], 'model', 'policy-{}-epoch-{}.pt'.format(filename, epoch))
+
+
+def checkpoint_source(data_name, filename, epoch):
+    """
+    Version of the checkpoint a policy bundle is built from: size / mtime of the checkpoint bundle,
+    or of the per-network files of older runs
+    :return: {file name: fingerprint}, None for a missing file
+    """
+    path = checkpoint_file(data_name, filename, epoch)
+    if os.path.isfile(path):
+        paths = [path]
+    else:
+        paths = [os.path.join(CHECKPOINT_DIR[data_name], 'model', '{}-{}-epoch-{}.pkl'.format(agent, filename, epoch))
+                 for agent in ['ask', 'rec', 'value']]
+    return {os.path.basename(p): split_fingerprint(p) if os.path.isfile(p) else None for p in paths}
+
+
+def policy_bundle_current(path, source):
+    """
+    True if the policy bundle at path was built from the checkpoint with this checkpoint_source,
+    or if no checkpoint file is left to rebuild it from (bundle shipped alone)
+    """
+    if not os.path.isfile(path):
+        return False
+    if all(fingerprint is None for fingerprint in source.values()):
+        return True
+    bundle = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    return bundle.get('version') == POLICY_BUNDLE_VERSION and bundle['config'].get('source') == source
+
+
+class InferenceAgent(object):
+    """
+    Agent of a policy bundle for evaluation and serving: the networks used by rl_evaluate only,
+    without target net, optimizers or replay memory
+
+    """
+    def __init__(self, device, gcn_net, value_net, policy_net, termination_net, state_inferrer, PADDING_ID,
+                 EPS_END=0.1, seed=None):
+        self.device = device
+        self.gcn_net = gcn_net
+        self.value_net = value_net
+        self.policy_net = policy_net
+        self.termination_net = termination_net
+        self.state_inferrer = state_inferrer
+        self.PADDING_ID = PADDING_ID
+        self.EPS_END = EPS_END
+        self.rng = random.Random(seed)
+
+    def select_action(self, state, cands, action_space, is_test=False):
+        """Same choice as AskAgent / RecAgent.select_action"""
+        state_emb = self.gcn_net([state])
+        cands = torch.LongTensor([cands]).to(self.device)
+        cand_emb = self.gcn_net.embedding(cands)
+        sample = self.rng.random()
+        if is_test or sample > self.EPS_END:
+            with torch.no_grad():
+                actions_value = self.policy_net(state_emb, cand_emb)
+                return cands[0][actions_value.argmax().item()]
+        random_action = action_space[self.rng.randrange(len(action_space))]
+        return torch.tensor(random_action, device=self.device, dtype=torch.long)
+
+
+def _inferrer_state(agent):
+    # the gcn of the state inferrer is the shared encoder, saved once
+    return {k: v for k, v in agent.state_inferrer.state_dict().items() if not k.startswith('gcn.')}
+
+
+def save_policy_bundle(path, args, ask_agent, rec_agent, source=None):
+    """
+    Write the inference networks of both agents (shared encoder with its embedding table, value net,
+    policies, termination nets, state inferrers) and their config to a single file, loaded
+    memory-mapped by load_policy_bundle
+    :param source: checkpoint_source of the checkpoint the agents were loaded from, stored in the config
+    """
+    gcn_net = ask_agent.gcn_net
+    config = {'entity': gcn_net.embedding.num_embeddings, 'emb_size': gcn_net.embedding.embedding_dim,
+              'hidden_size': args.hidden_size, 'seq': gcn_net.seq, 'gcn': bool(gcn_net.gcn),
+              'layers': gcn_net.layers, 'user_num': gcn_net.user_num, 'item_num': gcn_net.item_num,
+              'data_name': args.data_name, 'embed': args.embed, 'option_strategy': args.option_strategy,
+              'source': source}
+    bundle = cpu_copy({'version': POLICY_BUNDLE_VERSION,
+                       'config': config,
+                       'gcn': gcn_net.state_dict(),
+                       'value': ask_agent.value_net.state_dict(),
+                       'ask': {'policy': ask_agent.policy_net.state_dict(),
+                               'termination': ask_agent.termination_net.state_dict(),
+                               'state': _inferrer_state(ask_agent)},
+                       'rec': {'policy': rec_agent.policy_net.state_dict(),
+                               'termination': rec_agent.termination_net.state_dict(),
+                               'state': _inferrer_state(rec_agent)}})
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_file = path + '.tmp'
+    torch.save(bundle, tmp_file)
+    os.replace(tmp_file, path)
+    print('Policy bundle saved at {}'.format(path))
+
+
+def load_policy_bundle(path, device='cpu', seed=None):
+    """
+    Build the inference agents of a policy bundle. The modules are created on the meta device and take
+    the tensors of the memory-mapped file (the embedding table is paged in on use), so loading neither
+    initializes nor copies parameters on CPU.
+    :return: ask_agent, rec_agent (InferenceAgent, eval mode), config
+    """
+    start = time.time()
+    bundle = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    if bundle.get('version') != POLICY_BUNDLE_VERSION:
+        raise ValueError('{} has policy bundle version {}, expected {}'.format(
+            path, bundle.get('version'), POLICY_BUNDLE_VERSION))
+    config = bundle['config']
+    with torch.device('meta'):
+        gcn_net = GraphEncoder(device=device, entity=config['entity'], emb_size=config['emb_size'], kg=None,
+                               seq=config['seq'], gcn=config['gcn'], hidden_size=config['hidden_size'],
+                               layers=config['layers'], user_num=config['user_num'], item_num=config['item_num'])
+        value_net = ValueNetwork(config['hidden_size'])
+    gcn_net.load_state_dict(bundle['gcn'], assign=True)
+    value_net.load_state_dict(bundle['value'], assign=True)
+    gcn_net.to(device).eval()
+    value_net.to(device).eval()
+
+    agents = []
+    # seeded as build_agents: seed for the ask agent, seed + 1 for the rec agent
+    for i, name in enumerate(['ask', 'rec']):
+        with torch.device('meta'):
+            policy_net = AdvantageNetwork(config['emb_size'], config['hidden_size'])
+            termination_net = TerminationNetwork(config['hidden_size'])
+            state_inferrer = StateTransitionProb(gcn=None, state_emb_size=config['hidden_size'],
+                                                 cand_emb_size=config['emb_size'], device=device)
+        policy_net.load_state_dict(bundle[name]['policy'], assign=True)
+        termination_net.load_state_dict(bundle[name]['termination'], assign=True)
+        state_inferrer.load_state_dict(bundle[name]['state'], assign=True)
+        state_inferrer.gcn = gcn_net
+        agents.append(InferenceAgent(device, gcn_net, value_net, policy_net.to(device).eval(),
+                                     termination_net.to(device).eval(), state_inferrer.to(device).eval(),
+                                     PADDING_ID=config['entity'] - 1, seed=None if seed is None else seed + i))
+    print('Policy bundle load at {} ({:.3f}s)'.format(path, time.time() - start))
+    return agents[0], agents[1], config
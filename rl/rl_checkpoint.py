@@ -0,0 +1,198 @@
+import copy
+import os
+import queue
+import re
+import shutil
+import threading
+
+import torch
+
+from utils.utils import CHECKPOINT_DIR, get_rng_states, set_rng_states
+from rl.rl_memory import save_memory_snapshot
+
+# Bumped on incompatible changes of the bundle layout
+CHECKPOINT_VERSION = 1
+
+
+def cpu_copy(obj):
+    """Detached CPU copy of a (nested) state dict, safe to write while training goes on"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        result = type(obj)((k, cpu_copy(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            result._metadata = copy.deepcopy(obj._metadata)
+        return result
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def checkpoint_file(data_name, filename, epoch):
+    return os.path.join(CHECKPOINT_DIR[data_name], 'model', 'checkpoint-{}-epoch-{}.pt'.format(filename, epoch))
+
+
+def replay_dir(data_name, filename, epoch):
+    """Directory of the replay memories saved with a bundle, one memory-mapped sub-directory per agent"""
+    return os.path.join(CHECKPOINT_DIR[data_name], 'model', 'replay-{}-epoch-{}'.format(filename, epoch))
+
+
+def list_checkpoints(data_name, filename):
+    """
+    :return: [(epoch, path)] of the bundles of a run, oldest first
+    """
+    model_dir = os.path.join(CHECKPOINT_DIR[data_name], 'model')
+    if not os.path.isdir(model_dir):
+        return []
+    pattern = re.compile(r'^checkpoint-{}-epoch-(\d+)\.pt$'.format(re.escape(filename)))
+    checkpoints = []
+    for name in os.listdir(model_dir):
+        match = pattern.match(name)
+        if match:
+            checkpoints.append((int(match.group(1)), os.path.join(model_dir, name)))
+    return sorted(checkpoints)
+
+
+def load_checkpoint(data_name, filename, epoch=None, map_location='cpu'):
+    """
+    Load a checkpoint bundle with a single read
+    :param epoch: epoch of the bundle, the latest one if None
+    :return: bundle dict, None if there is no such bundle
+    """
+    if epoch is None:
+        checkpoints = list_checkpoints(data_name, filename)
+        if not checkpoints:
+            return None
+        path = checkpoints[-1][1]
+    else:
+        path = checkpoint_file(data_name, filename, epoch)
+        if not os.path.isfile(path):
+            return None
+    bundle = torch.load(path, map_location=map_location)
+    if bundle.get('version') != CHECKPOINT_VERSION:
+        raise ValueError('{} has checkpoint version {}, expected {}'.format(
+            path, bundle.get('version'), CHECKPOINT_VERSION))
+    bundle['replay_dir'] = replay_dir(data_name, filename, bundle['epoch'])
+    print('Checkpoint load at {}'.format(path))
+    return bundle
+
+
+def restore_checkpoint(bundle, ask_agent, rec_agent, value_net, resume=True):
+    """
+    Restore networks and optimizers of a bundle, and if resume the random states and the replay memories
+    :return: epoch of the bundle
+    """
+    ask_agent.gcn_net.load_state_dict(bundle['gcn'])
+    value_net.load_state_dict(bundle['value'])
+    ask_agent.load_training_state_dict(bundle['ask'])
+    rec_agent.load_training_state_dict(bundle['rec'])
+    if resume:
+        set_rng_states(bundle['rng'])
+        memories = {'ask': ask_agent.memory, 'rec': rec_agent.memory}
+        for name in bundle.get('replay', []):
+            path = os.path.join(bundle['replay_dir'], name)
+            memories[name].load(path)
+            print('Replay memory {} load at {} ({} transitions)'.format(name, path, len(memories[name])))
+    return bundle['epoch']
+
+
+class CheckpointManager(object):
+    """
+    Write one checkpoint bundle per save (shared gcn / value nets, both agents with their optimizers,
+    epoch and random states) from a background thread. The state is copied on the training thread,
+    the file is written to a temporary name and renamed, so a bundle on disk is always complete.
+    Only the last keep bundles of the run are retained (keep=0 retains all).
+    Replay memories passed to save() are written first as memory-mapped arrays next to the bundle.
+
+    """
+    def __init__(self, data_name, filename, keep=0):
+        self.data_name = data_name
+        self.filename = filename
+        self.keep = keep
+        # one bundle written, one waiting: a slower disk blocks save() instead of piling up copies
+        self.bundles = queue.Queue(maxsize=1)
+        self.error = None
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def save(self, epoch, ask_agent, rec_agent, value_net, extra=None, memories=None):
+        """
+        :param extra: additional json-like training state stored in the bundle (decay_step, ...)
+        :param memories: {'ask': ReplayMemoryPER, 'rec': ReplayMemoryPER} to save for a full resume
+        """
+        if self.error is not None:
+            raise self.error
+        memories = memories or {}
+        snapshots = {name: memory.snapshot() for name, memory in memories.items()}
+        bundle = cpu_copy({'version': CHECKPOINT_VERSION,
+                           'epoch': epoch,
+                           'gcn': ask_agent.gcn_net.state_dict(),
+                           'value': value_net.state_dict(),
+                           'ask': ask_agent.training_state_dict(),
+                           'rec': rec_agent.training_state_dict(),
+                           'rng': get_rng_states(),
+                           'extra': extra or {},
+                           'replay': sorted(memories.keys())})
+        self.bundles.put((bundle, snapshots))
+
+    def _write_loop(self):
+        while True:
+            item = self.bundles.get()
+            try:
+                if item is None:
+                    break
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.bundles.task_done()
+
+    def _write(self, bundle, snapshots):
+        path = checkpoint_file(self.data_name, self.filename, bundle['epoch'])
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # the replay memories are complete before the bundle that refers to them appears
+        for name, snapshot in snapshots.items():
+            save_memory_snapshot(os.path.join(replay_dir(self.data_name, self.filename, bundle['epoch']), name),
+                                 snapshot)
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            torch.save(bundle, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+        print('Checkpoint saved at {}'.format(path))
+        if self.keep > 0:
+            for old_epoch, old_path in list_checkpoints(self.data_name, self.filename)[:-self.keep]:
+                os.remove(old_path)
+                shutil.rmtree(replay_dir(self.data_name, self.filename, old_epoch), ignore_errors=True)
+
+    def wait(self):
+        """Block until every saved bundle is on disk"""
+        self.bundles.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.bundles.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+
+def load_agents(args, filename, ask_agent, rec_agent, value_net, resume=True):
+    """
+    Load the agents of epoch args.load_rl_epoch from its checkpoint bundle, or from the per-network
+    files written by save_model / save_value_net before bundles existed
+    :param resume: also restore the random states and replay memories saved with the bundle
+    :return: the bundle, None for per-network files
+    """
+    print('Loading Model in epoch {}'.format(args.load_rl_epoch))
+    bundle = load_checkpoint(args.data_name, filename, args.load_rl_epoch, map_location=args.device)
+    if bundle is not None:
+        restore_checkpoint(bundle, ask_agent, rec_agent, value_net, resume=resume)
+        return bundle
+    ask_agent.load_model(data_name=args.data_name, filename=filename, epoch_user=args.load_rl_epoch)
+    rec_agent.load_model(data_name=args.data_name, filename=filename, epoch_user=args.load_rl_epoch)
+    value_net.load_value_net(data_name=args.data_name, filename=filename, epoch_user=args.load_rl_epoch)
+    return None
@@ -1,16 +1,24 @@
 import copy
+from contextlib import nullcontext
+import multiprocessing
+import queue
 import statistics
 import time
-from itertools import count
+from itertools import count, chain
 import math
 
 import numpy as np
 import torch
 
 from utils.utils import *
+from utils.event_log import get_logger
+from utils.timing import timer
+from utils.shared_data import publish_shared_data, attach_shared_data
 from rl.recommend_env.env_variable_question import VariableRecommendEnv
 from tqdm import tqdm
 
+log = get_logger('evaluate')
+
 def choose_option(ask_agent, rec_agent, state, cand, option_strategy=0):
     if cand["feature"] == [] or len(cand["item"]) < 10:
         return 0  # Recommend
@@ -45,7 +53,7 @@ def choose_option(ask_agent, rec_agent, state, cand, option_strategy=0):
             rec_Q = np.array(rec_score).dot(rec_prop)
         else:
             rec_Q = max(rec_score)
-        print("\n**CHOOSE OPTION** ASK VALUE:{}, REC VALUE:{}\n".format(ask_Q, rec_Q))
+        log.debug('choose_option', '\n**CHOOSE OPTION** ASK VALUE:{}, REC VALUE:{}\n', ask_Q, rec_Q)
         if ask_Q > rec_Q:
             return 1
         else:
@@ -61,21 +69,24 @@ def infer_features(ask_agent, args, infer_env, infer_state, infer_cand, infer_ac
         if infer_env.cur_conver_step > args.max_ask_step:
             break
         # Select Action
-        chosen_feature = ask_agent.select_action(infer_state, infer_cand["feature"],
-                                                 infer_action_space["feature"], is_test=True)
+        with timer.phase('select_action'):
+            chosen_feature = ask_agent.select_action(infer_state, infer_cand["feature"],
+                                                     infer_action_space["feature"], is_test=True)
         chosen_features.append(chosen_feature)
         infer_reward = ask_agent.state_inferrer([infer_state], torch.LongTensor([[chosen_feature]]))
-        infer_next_state, infer_next_cand, infer_action_space, reward, done = infer_env.step(
-            attribute=chosen_feature.item(),
-            items=None,
-            mode="test",
-            infer=infer_reward)
+        with timer.phase('step'):
+            infer_next_state, infer_next_cand, infer_action_space, reward, done = infer_env.step(
+                attribute=chosen_feature.item(),
+                items=None,
+                mode="test",
+                infer=infer_reward)
         if infer_next_state is None:
             break
         # Whether Termination
-        infer_next_state_emb = ask_agent.gcn_net([infer_next_state])
-        term_score = ask_agent.termination_net(infer_next_state_emb).item()
-        print("Termination Score:", term_score)
+        with timer.phase('termination'):
+            infer_next_state_emb = ask_agent.gcn_net([infer_next_state])
+            term_score = ask_agent.termination_net(infer_next_state_emb).item()
+        log.debug('termination', 'Termination Score: {}', term_score)
         if term_score >= 0.5:
             termination = True
         if infer_next_cand["feature"] == []:
@@ -99,22 +110,25 @@ def infer_items(rec_agent, args, infer_env, infer_state, infer_cand, infer_actio
             break
 
         # Select Action
-        chosen_item = rec_agent.select_action(infer_state, infer_cand["item"],
-                                              infer_action_space["item"], is_test=True)
+        with timer.phase('select_action'):
+            chosen_item = rec_agent.select_action(infer_state, infer_cand["item"],
+                                                  infer_action_space["item"], is_test=True)
         chosen_items.append(chosen_item.item())
         infer_reward = rec_agent.state_inferrer([infer_state], torch.LongTensor([[chosen_item]]))
-        infer_next_state, infer_next_cand, infer_action_space, reward, done = infer_env.step(
-            attribute=None,
-            items=chosen_items,
-            mode="test",
-            infer=infer_reward)
+        with timer.phase('step'):
+            infer_next_state, infer_next_cand, infer_action_space, reward, done = infer_env.step(
+                attribute=None,
+                items=chosen_items,
+                mode="test",
+                infer=infer_reward)
         if infer_next_state is None:
             break
         # Whether Termination
-        infer_next_state_emb = rec_agent.gcn_net([infer_next_state])
+        with timer.phase('termination'):
+            infer_next_state_emb = rec_agent.gcn_net([infer_next_state])
 
-        term_score = rec_agent.termination_net(infer_next_state_emb).item()
-        print("Termination Score:", term_score)
+            term_score = rec_agent.termination_net(infer_next_state_emb).item()
+        log.debug('termination', 'Termination Score: {}', term_score)
         if term_score >= 0.5:
             termination = True
         if infer_next_cand["feature"] == []:
@@ -128,125 +142,314 @@ def infer_items(rec_agent, args, infer_env, infer_state, infer_cand, infer_actio
     return chosen_items
 
 
-@torch.no_grad()
-def rl_evaluate(args, kg, dataset, filename, epoch, ask_agent=None, rec_agent=None):
-    tt = time.time()
-    start = tt
-
-    # Environment
-    env = VariableRecommendEnv(kg, dataset, args.data_name, args.embed, seed=args.seed, max_turn=args.max_turn,
-                               cand_feature_num=args.cand_feature_num, cand_item_num=args.cand_item_num, attr_num=args.attr_num,
-                               mode='test', entropy_way=args.entropy_method)
-    set_random_seed(args.seed)
-    # Statistic initial
-    AvgT_list = []
-    Suc_Turn_list = []
-    rec_step_list = []
-    ask_step_list = []
-    HDCG_item = 0.
-    HDCG_attribute_list = []
-
-    # Training/Test Size
-    total_user_size = env.ui_array.shape[0]
-    print('User size in UI_test: ', total_user_size)
-    test_filename = 'Evaluate-epoch-{}-'.format(epoch) + filename
-    detail_filename = 'Detail-' + filename
-    if args.eval_user_size == 0:
-        user_size = total_user_size
-    else:
-        user_size = args.eval_user_size
-    print('The select Test size : ', user_size)
-    if args.block_print:
-        blockPrint()
-    for user in tqdm(range(user_size)):
-        # blockPrint()
-        print('\n================Episode:{}===================='.format(user))
+def evaluate_episode(args, env, ask_agent, rec_agent, user):
+    """
+    Run a single test conversation for the user-item tuple env.ui_array[user]
+    :param user: index of the test tuple
+    :return: per-episode statistics, merged by merge_episode_stats
+    """
+    # per-tuple seed: the episode does not depend on which worker runs it or in which order
+    set_episode_seed(args.seed, user)
+    env.test_num = user
+    stats = {'AvgT': [], 'Suc_Turn': [], 'rec_step': [], 'ask_step': [], 'HDCG_item': [], 'HDCG_attribute': []}
+    log.debug('episode', '\n================Episode:{}====================', user)
+    with timer.phase('reset'):
         state, cand, action_space = env.reset()
-        done = 0
-        for t in range(1, 16):  # Turn
-            chosen_features = []
-            chosen_items = []
-            '''
-            Over Option : Select Ask / Rec
-            '''
-            env.cur_conver_step = 1
-            if done:
-                break
-            print("Candidate: ", cand)
+    done = 0
+    for t in range(1, 16):  # Turn
+        chosen_features = []
+        chosen_items = []
+        '''
+        Over Option : Select Ask / Rec
+        '''
+        env.cur_conver_step = 1
+        if done:
+            break
+        log.debug('candidate', 'Candidate: {}', cand)
+        with timer.phase('choose_option'):
             option = choose_option(ask_agent, rec_agent, state, cand, args.option_strategy)
 
-            '''
-            Intra Option choose: Select features / items
-            '''
-            # ASK
-            if option == 1:
-                print("\n————————Turn: ", t, "  Option: ASK————————")
-                ask_score = []
-                # infer step
-                infer_env = copy.deepcopy(env)
-                infer_state = copy.deepcopy(state)
-                infer_cand = copy.deepcopy(cand)
-                infer_action_space = copy.deepcopy(action_space)
+        '''
+        Intra Option choose: Select features / items
+        '''
+        # ASK
+        if option == 1:
+            log.debug('turn', '\n————————Turn:  {}   Option: ASK————————', t, turn=t, option='ask')
+            ask_score = []
+            # infer step
+            infer_env = copy.deepcopy(env)
+            infer_state = copy.deepcopy(state)
+            infer_cand = copy.deepcopy(cand)
+            infer_action_space = copy.deepcopy(action_space)
+            with timer.phase('infer'):
                 chosen_features = infer_features(ask_agent, args,
                                                  infer_env, infer_state, infer_cand, infer_action_space)
-                # interactive step
-                for chosen_feature in chosen_features:
+            # interactive step
+            for chosen_feature in chosen_features:
 
-                    # Env Interaction
+                # Env Interaction
+                with timer.phase('step'):
                     next_state, next_cand, action_space, reward, done = env.step(chosen_feature.item(), None)
-                    ask_score.append(reward)
+                ask_score.append(reward)
 
-                    state = next_state
-                    cand = next_cand
+                state = next_state
+                cand = next_cand
 
-                    if done:
-                        AvgT_list.append(t)
-                        break
+                if done:
+                    stats['AvgT'].append(t)
+                    break
+
+            # calculate HDCG Attribute
+            for i in range(len(ask_score)):
+                if ask_score[i] > 0:
+                    stats['HDCG_attribute'].append(
+                        (1 / math.log(t + 2, 2) + (1 / math.log(t + 1, 2) - 1 / math.log(t + 2, 2)) /
+                         math.log(i + 2, 2)))
+
+        # RECOMMEND
+        elif option == 0:
+            log.debug('turn', '\n————————Turn:  {}   Option: REC————————', t, turn=t, option='rec')
+
+            # Infer Step
+            infer_env = copy.deepcopy(env)
+            infer_state = copy.deepcopy(state)
+            infer_cand = copy.deepcopy(cand)
+            infer_action_space = copy.deepcopy(action_space)
+
+            with timer.phase('infer'):
+                chosen_items = infer_items(rec_agent, args,
+                                           infer_env, infer_state, infer_cand, infer_action_space)
 
-                # calculate HDCG Attribute
-                for i in range(len(ask_score)):
-                    if ask_score[i] > 0:
-                        HDCG_attribute_list.append(
-                            (1 / math.log(t + 2, 2) + (1 / math.log(t + 1, 2) - 1 / math.log(t + 2, 2)) /
-                             math.log(i + 2, 2)))
+            # Env Interaction
+            with timer.phase('step'):
+                next_state, next_cand, action_space, reward, done = env.step(None, chosen_items, mode="test")
+            state = next_state
+            cand = next_cand
+            if done:
+                if reward == env.reward_dict["rec_acc"]:  # recommend successfully
+                    stats['Suc_Turn'].append(t)
+                    stats['HDCG_item'].append(
+                        1 / math.log(t + 2, 2) + (1 / math.log(t + 1, 2) - 1 / math.log(t + 2, 2)) /
+                        math.log(done + 1, 2))
 
-            # RECOMMEND
-            elif option == 0:
-                print("\n————————Turn: ", t, "  Option: REC————————")
+                stats['AvgT'].append(t)
 
-                # Infer Step
-                infer_env = copy.deepcopy(env)
-                infer_state = copy.deepcopy(state)
-                infer_cand = copy.deepcopy(cand)
-                infer_action_space = copy.deepcopy(action_space)
+        if not done and t == env.max_turn:
+            stats['AvgT'].append(t)
 
-                chosen_items = infer_items(rec_agent, args,
-                                           infer_env, infer_state, infer_cand, infer_action_space)
+        if option == 1:
+            stats['ask_step'].append(len(chosen_features))
+        else:
+            stats['rec_step'].append(len(chosen_items))
+
+        env.cur_conver_turn += 1
+    return stats
+
+
+def merge_episode_stats(episode_stats):
+    """
+    Merge per-episode statistics in user order, so that the result does not depend on sharding
+    :param episode_stats: list of (user, stats)
+    """
+    merged = {'AvgT': [], 'Suc_Turn': [], 'rec_step': [], 'ask_step': [], 'HDCG_item': 0., 'HDCG_attribute': []}
+    for _, stats in sorted(episode_stats, key=lambda x: x[0]):
+        for key in ['AvgT', 'Suc_Turn', 'rec_step', 'ask_step', 'HDCG_attribute']:
+            merged[key].extend(stats[key])
+        for hdcg in stats['HDCG_item']:
+            merged['HDCG_item'] = merged['HDCG_item'] + hdcg
+    return merged
+
+
+# Worker context, inherited from the parent process through fork
+_eval_context = {}
+
+
+def _init_eval_worker():
+    torch.set_num_threads(1)
+
+
+@torch.no_grad()
+def _evaluate_shard(users):
+    ctx = _eval_context
+    return [(user, evaluate_episode(ctx['args'], ctx['env'], ctx['ask_agent'], ctx['rec_agent'], user))
+            for user in users]
+
+
+def parallel_evaluate_episodes(args, env, ask_agent, rec_agent, user_size):
+    """
+    Shard the test tuples over args.eval_workers processes. The workers share the env and
+    the (read-only) agents with the parent through fork.
+    """
+    _eval_context.update(args=args, env=env, ask_agent=ask_agent, rec_agent=rec_agent)
+    shards = [list(range(user_size))[i::args.eval_workers] for i in range(args.eval_workers)]
+    ctx = multiprocessing.get_context('fork')
+    try:
+        with ctx.Pool(args.eval_workers, initializer=_init_eval_worker) as pool:
+            episode_stats = list(chain.from_iterable(pool.map(_evaluate_shard, shards)))
+    finally:
+        _eval_context.clear()
+    return episode_stats
+
+
+class Evaluator(object):
+    """
+    Test environment built once and reused by every periodic evaluation: the shuffled test tuples,
+    the embeddings and the env caches are prepared at construction, reset() only rewinds and reseeds.
+
+    """
+    @torch.no_grad()
+    def __init__(self, args, kg, dataset):
+        self.args = args
+        self.eval_workers = getattr(args, 'eval_workers', 1)
+        if self.eval_workers > 1 and str(args.device).startswith('cuda'):
+            print('Parallel evaluation is CPU only, falling back to serial evaluation')
+            self.eval_workers = 1
+        # the workers attach the published KG / embeddings instead of sharing pickled copies
+        shared = None
+        if self.eval_workers > 1 and getattr(args, 'shared_data', 0):
+            shared = attach_shared_data(publish_shared_data(args.data_name, kg, args.embed,
+                                                             cleanup=not getattr(args, 'shared_data_keep', 0)))
+            kg = shared.kg
+
+        # Environment
+        self.env = VariableRecommendEnv(kg, dataset, args.data_name, args.embed, seed=args.seed, max_turn=args.max_turn,
+                                        cand_feature_num=args.cand_feature_num, cand_item_num=args.cand_item_num,
+                                        attr_num=args.attr_num, mode='test', entropy_way=args.entropy_method,
+                                        shared=shared)
+        self.total_user_size = self.env.ui_array.shape[0]
+
+    def reset(self):
+        """Rewind to the first test tuple, with the random state of a freshly built env"""
+        self.env.test_num = 0
+        set_random_seed(self.args.seed)
+
+    def run_episodes(self, ask_agent, rec_agent, user_size, profiler=None):
+        """
+        :param profiler: ProfileWindow over the episodes (serial evaluation only)
+        :return: list of (user, episode stats) for the first user_size test tuples
+        """
+        args = self.args
+        if self.eval_workers > 1:
+            print('Evaluate with {} workers'.format(self.eval_workers))
+            return parallel_evaluate_episodes(args, self.env, ask_agent, rec_agent, user_size)
+        episode_stats = []
+        for user in tqdm(range(user_size)):
+            with timer.phase('episode'), (profiler.unit('episode') if profiler is not None else nullcontext()):
+                episode_stats.append((user, evaluate_episode(args, self.env, ask_agent, rec_agent, user)))
+        return episode_stats
+
+
+def eval_modules(ask_agent, rec_agent):
+    """The modules used by an evaluation, snapshotted for AsyncEvaluator"""
+    return {'gcn': ask_agent.gcn_net,
+            'value': ask_agent.value_net,
+            'ask_policy': ask_agent.policy_net,
+            'ask_termination': ask_agent.termination_net,
+            'ask_state': ask_agent.state_inferrer,
+            'rec_policy': rec_agent.policy_net,
+            'rec_termination': rec_agent.termination_net,
+            'rec_state': rec_agent.state_inferrer}
+
+
+def _async_eval_worker(args, kg, dataset, filename, ask_agent, rec_agent, snapshot_queue):
+    # the agents are the copies inherited through fork, loaded with each snapshot
+    torch.set_num_threads(1)
+    evaluator = Evaluator(args, kg, dataset)
+    modules = eval_modules(ask_agent, rec_agent)
+    while True:
+        item = snapshot_queue.get()
+        if item is None:
+            break
+        epoch, snapshot = item
+        for name, module in modules.items():
+            module.load_state_dict(snapshot[name])
+        rl_evaluate(args, kg, dataset, filename, epoch, ask_agent, rec_agent, evaluator=evaluator)
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluate snapshots of the agents in a background process while training continues; the process
+    writes the same test logs as rl_evaluate. At most max_pending snapshots wait for evaluation, when
+    evaluation falls behind the oldest waiting one is dropped (max_pending=0 queues them all).
+
+    """
+    def __init__(self, args, kg, dataset, filename, ask_agent, rec_agent, max_pending=1):
+        self.max_pending = max_pending
+        # a daemon process cannot start an evaluation pool
+        args = copy.copy(args)
+        args.eval_workers = 1
+        ctx = multiprocessing.get_context('fork')
+        self.snapshot_queue = ctx.Queue()
+        self.process = ctx.Process(target=_async_eval_worker,
+                                   args=(args, kg, dataset, filename, ask_agent, rec_agent, self.snapshot_queue),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, epoch, ask_agent, rec_agent):
+        while self.max_pending and self.snapshot_queue.qsize() >= self.max_pending:
+            try:
+                dropped_epoch, _ = self.snapshot_queue.get_nowait()
+            except queue.Empty:
+                break
+            print('Evaluation is behind, drop the snapshot of epoch {}'.format(dropped_epoch))
+        snapshot = {name: {k: v.detach().cpu().clone() for k, v in module.state_dict().items()}
+                    for name, module in eval_modules(ask_agent, rec_agent).items()}
+        self.snapshot_queue.put((epoch, snapshot))
+
+    def close(self):
+        """Wait for the submitted evaluations"""
+        self.snapshot_queue.put(None)
+        self.process.join()
 
-                # Env Interaction
-                next_state, next_cand, action_space, reward, done = env.step(None, chosen_items, mode="test")
-                state = next_state
-                cand = next_cand
-                if done:
-                    if reward == env.reward_dict["rec_acc"]:  # recommend successfully
-                        Suc_Turn_list.append(t)
-                        HDCG_item = HDCG_item + (
-                                1 / math.log(t + 2, 2) + (1 / math.log(t + 1, 2) - 1 / math.log(t + 2, 2)) /
-                                math.log(done + 1, 2))
 
-                    AvgT_list.append(t)
+def start_async_evaluator(args, kg, dataset, filename, ask_agent, rec_agent):
+    """
+    :return: AsyncEvaluator if args.async_eval, else None (evaluate in the training process)
+    """
+    if not getattr(args, 'async_eval', 0):
+        return None
+    if str(args.device).startswith('cuda'):
+        print('Asynchronous evaluation is CPU only, evaluating in the training process')
+        return None
+    return AsyncEvaluator(args, kg, dataset, filename, ask_agent, rec_agent, max_pending=args.async_eval_pending)
 
-            if not done and t == env.max_turn:
-                AvgT_list.append(t)
 
-            if option == 1:
-                ask_step_list.append(len(chosen_features))
-            else:
-                rec_step_list.append(len(chosen_items))
+@torch.no_grad()
+def rl_evaluate(args, kg, dataset, filename, epoch, ask_agent=None, rec_agent=None, evaluator=None, profiler=None):
+    """
+    :param evaluator: Evaluator reused across calls, built for this call only if None
+    :param profiler: ProfileWindow over the evaluated episodes
+    """
+    tt = time.time()
+    start = tt
+
+    if evaluator is None:
+        evaluator = Evaluator(args, kg, dataset)
+    evaluator.reset()
+
+    # Training/Test Size
+    total_user_size = evaluator.total_user_size
+    print('User size in UI_test: ', total_user_size)
+    test_filename = 'Evaluate-epoch-{}-'.format(epoch) + filename
+    detail_filename = 'Detail-' + filename
+    if args.eval_user_size == 0:
+        user_size = total_user_size
+    else:
+        user_size = args.eval_user_size
+    print('The select Test size : ', user_size)
+
+    # evaluation phases only (the training breakdown of the epoch is already saved)
+    timer.reset()
+    episode_stats = evaluator.run_episodes(ask_agent, rec_agent, user_size, profiler=profiler)
 
-            env.cur_conver_turn += 1
+    stats = merge_episode_stats(episode_stats)
+    AvgT_list = stats['AvgT']
+    Suc_Turn_list = stats['Suc_Turn']
+    rec_step_list = stats['rec_step']
+    ask_step_list = stats['ask_step']
+    HDCG_item = stats['HDCG_item']
+    HDCG_attribute_list = stats['HDCG_attribute']
 
-    enablePrint()  # Enable print function
     print(len(AvgT_list), len(rec_step_list), len(ask_step_list))
     stl = np.array(Suc_Turn_list)
     AvgT = statistics.mean(AvgT_list)
@@ -276,6 +479,10 @@ def rl_evaluate(args, kg, dataset, filename, epoch, ask_agent=None, rec_agent=No
     # Single Epoch file
     save_rl_mtric(dataset=args.data_name, filename=test_filename, epoch=epoch, results=results,
                   spend_time=time.time() - start, mode='test')  # save rl SR
+    if timer.enabled:
+        timing = timer.format_summary()
+        print('\n'.join(timing))
+        save_rl_timing(args.data_name, test_filename, epoch, timing)
 
     PATH = CHECKPOINT_DIR[args.data_name] + '/log/' + detail_filename + '.txt'
     with open(PATH, 'a') as f:
@@ -0,0 +1,300 @@
+import copy
+import os
+import time
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+from utils.utils import CHECKPOINT_DIR, set_episode_seed
+from rl.rl_evaluate import choose_option, Evaluator
+from rl.rl_quantize import inference_agents
+
+
+def decision_graph_file(data_name, filename, epoch):
+    return os.path.join(CHECKPOINT_DIR[data_name], 'model', 'decision-{}-epoch-{}.pt'.format(filename, epoch))
+
+
+def _frozen(module):
+    module = copy.deepcopy(module).eval()
+    for p in module.parameters():
+        p.requires_grad_(False)
+    return module
+
+
+class _SparseConv(nn.Module):
+    """GraphConvolution over the edges of a batch of state graphs (block-diagonal adjacency)"""
+    def __init__(self, conv):
+        super(_SparseConv, self).__init__()
+        self.weight = nn.Parameter(conv.weight.detach().clone(), requires_grad=False)
+        bias = conv.bias if conv.bias is not None else torch.zeros(conv.out_features)
+        self.bias = nn.Parameter(bias.detach().clone(), requires_grad=False)
+
+    def forward(self, x: Tensor, rows: Tensor, cols: Tensor, values: Tensor) -> Tensor:
+        support = torch.mm(x, self.weight)
+        output = torch.zeros_like(support).index_add_(0, rows, support.index_select(0, cols) * values.unsqueeze(1))
+        return output + self.bias
+
+
+class _GCNNodes(nn.Module):
+    def __init__(self, gnns):
+        super(_GCNNodes, self).__init__()
+        self.convs = nn.ModuleList([_SparseConv(conv) for conv in gnns])
+
+    def forward(self, x: Tensor, rows: Tensor, cols: Tensor, values: Tensor) -> Tensor:
+        for conv in self.convs:
+            x = conv(x, rows, cols, values)
+        return x
+
+
+class _DenseNodes(nn.Module):
+    def __init__(self, fc2):
+        super(_DenseNodes, self).__init__()
+        self.fc2 = _frozen(fc2)
+
+    def forward(self, x: Tensor, rows: Tensor, cols: Tensor, values: Tensor) -> Tensor:
+        return F.relu(self.fc2(x))
+
+
+def _masked_mean(nodes: Tensor, mask: Tensor) -> Tensor:
+    mask = mask.unsqueeze(2).to(nodes.dtype)
+    return (nodes * mask).sum(1) / mask.sum(1).clamp(min=1.)
+
+
+class _TransformerSeq(nn.Module):
+    """
+    GraphEncoder feeds [N x L x d] to a sequence-first transformer: for one state every cur_node is a
+    sequence of length 1, which is kept here so that a state does not depend on the rest of the batch
+    """
+    def __init__(self, transformer):
+        super(_TransformerSeq, self).__init__()
+        self.transformer = _frozen(transformer)
+
+    def forward(self, nodes: Tensor, mask: Tensor) -> Tensor:
+        b, l, d = nodes.size(0), nodes.size(1), nodes.size(2)
+        output = self.transformer(nodes.reshape(1, b * l, d)).reshape(b, l, d)
+        return _masked_mean(output, mask)
+
+
+class _RNNSeq(nn.Module):
+    def __init__(self, rnn):
+        super(_RNNSeq, self).__init__()
+        self.rnn = _frozen(rnn)
+
+    def forward(self, nodes: Tensor, mask: Tensor) -> Tensor:
+        lengths = mask.sum(1)
+        outputs = []
+        for b in range(nodes.size(0)):
+            _, h = self.rnn(nodes[b:b + 1, :int(lengths[b])])
+            outputs.append(h[-1])
+        return torch.cat(outputs, dim=0)
+
+
+class _MeanSeq(nn.Module):
+    def forward(self, nodes: Tensor, mask: Tensor) -> Tensor:
+        return _masked_mean(nodes, mask)
+
+
+class _Advantage(nn.Module):
+    """AdvantageNetwork scores of every candidate: [B x H] states, [B x K x D] candidates -> [B x K]"""
+    def __init__(self, policy_net):
+        super(_Advantage, self).__init__()
+        self.advantage = _frozen(policy_net.advantage)
+        self.out_advantage = _frozen(policy_net.out_advantage)
+
+    def forward(self, state: Tensor, cand_emb: Tensor) -> Tensor:
+        x = state.unsqueeze(1).expand(-1, cand_emb.size(1), -1)
+        return self.out_advantage(F.relu(self.advantage(torch.cat((x, cand_emb), dim=2)))).squeeze(2)
+
+
+class _Termination(nn.Module):
+    def __init__(self, termination_net):
+        super(_Termination, self).__init__()
+        self.hidden = _frozen(termination_net.hidden_size)
+        self.output = _frozen(termination_net.output)
+
+    def forward(self, state: Tensor) -> Tensor:
+        return torch.sigmoid(self.output(torch.tanh(self.hidden(state)))).squeeze(1)
+
+
+class _Value(nn.Module):
+    def __init__(self, value_net):
+        super(_Value, self).__init__()
+        self.linear = _frozen(value_net.linear)
+        self.value = _frozen(value_net.value)
+
+    def forward(self, state: Tensor) -> Tensor:
+        return self.value(F.relu(self.linear(state))).squeeze(1)
+
+
+class DecisionGraph(nn.Module):
+    """
+    One decision of the evaluation loop for a batch of states in a single call, scriptable:
+    GraphEncoder, then choose_option (value + advantage of every candidate feature / item, softmax
+    weighted or max), the argmax action of the chosen option and its termination probability.
+
+    Inputs (B states, M nodes in total, E edges):
+        neighbors [M] entity ids of the concatenated state graphs, edge_index [2 x E] / edge_weight [E]
+        adjacency entries indexed in the concatenation, node_offsets [B] first node of every state,
+        cur_node_lengths [B], feature_cands [B x F] / item_cands [B x K] padded candidates with their
+        boolean masks. batch_decision_inputs builds them from env states.
+    Outputs: ask_q [B], rec_q [B], option [B] (1: ask, 0: recommend), action [B] (feature or item id),
+        termination [B]
+
+    """
+    def __init__(self, ask_agent, rec_agent, option_strategy=0, min_items=10):
+        super(DecisionGraph, self).__init__()
+        gcn_net = ask_agent.gcn_net
+        self.option_strategy = option_strategy
+        # choose_option recommends when there is no feature or fewer items to choose from
+        self.min_items = min_items
+        self.embedding = _frozen(gcn_net.embedding)
+        self.nodes = _GCNNodes(gcn_net.gnns) if gcn_net.gcn else _DenseNodes(gcn_net.fc2)
+        if gcn_net.seq == 'transformer':
+            self.seq = _TransformerSeq(gcn_net.transformer)
+        elif gcn_net.seq == 'rnn':
+            self.seq = _RNNSeq(gcn_net.rnn)
+        else:
+            self.seq = _MeanSeq()
+        self.fc1 = _frozen(gcn_net.fc1)
+        self.value = _Value(ask_agent.value_net)
+        self.ask_policy = _Advantage(ask_agent.policy_net)
+        self.rec_policy = _Advantage(rec_agent.policy_net)
+        self.ask_termination = _Termination(ask_agent.termination_net)
+        self.rec_termination = _Termination(rec_agent.termination_net)
+        self.eval()
+
+    def encode(self, neighbors: Tensor, edge_index: Tensor, edge_weight: Tensor, node_offsets: Tensor,
+               cur_node_lengths: Tensor) -> Tensor:
+        """:return: state embeddings [B x H], as GraphEncoder for every state alone"""
+        x = self.nodes(self.embedding(neighbors), edge_index[0], edge_index[1], edge_weight)
+        length = max(int(cur_node_lengths.max()), 1)
+        positions = torch.arange(length, device=neighbors.device)
+        mask = positions.unsqueeze(0) < cur_node_lengths.unsqueeze(1)  # [B x L]
+        index = (node_offsets.unsqueeze(1) + positions.unsqueeze(0)).clamp(max=x.size(0) - 1)
+        nodes = x[index] * mask.unsqueeze(2).to(x.dtype)
+        return F.relu(self.fc1(self.seq(nodes, mask)))
+
+    def _option_value(self, scores: Tensor, mask: Tensor) -> Tensor:
+        if self.option_strategy == 0:
+            prop = torch.softmax(scores.masked_fill(~mask, -1e30), dim=1)
+            return (scores.masked_fill(~mask, 0.) * prop).sum(1)
+        return scores.masked_fill(~mask, float('-inf')).max(1)[0]
+
+    def forward(self, neighbors: Tensor, edge_index: Tensor, edge_weight: Tensor, node_offsets: Tensor,
+                cur_node_lengths: Tensor, feature_cands: Tensor, feature_mask: Tensor, item_cands: Tensor,
+                item_mask: Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]:
+        state = self.encode(neighbors, edge_index, edge_weight, node_offsets, cur_node_lengths)
+        value = self.value(state)
+        ask_advantage = self.ask_policy(state, self.embedding(feature_cands))
+        rec_advantage = self.rec_policy(state, self.embedding(item_cands))
+        ask_q = self._option_value(value.unsqueeze(1) + ask_advantage, feature_mask)
+        rec_q = self._option_value(value.unsqueeze(1) + rec_advantage, item_mask)
+        ask = (ask_q > rec_q) & feature_mask.any(1) & (item_mask.sum(1) >= self.min_items)
+
+        feature = feature_cands.gather(1, ask_advantage.masked_fill(~feature_mask, float('-inf')).argmax(1, keepdim=True))
+        item = item_cands.gather(1, rec_advantage.masked_fill(~item_mask, float('-inf')).argmax(1, keepdim=True))
+        action = torch.where(ask, feature.squeeze(1), item.squeeze(1))
+
+        termination = torch.where(ask, self.ask_termination(state), self.rec_termination(state))
+        return ask_q, rec_q, ask.long(), action, termination
+
+
+def _pad(rows, padding_id):
+    width = max(max((len(r) for r in rows), default=0), 1)
+    cands = np.full((len(rows), width), padding_id, dtype=np.int64)
+    mask = np.zeros((len(rows), width), dtype=bool)
+    for b, r in enumerate(rows):
+        cands[b, :len(r)] = r
+        mask[b, :len(r)] = True
+    return torch.from_numpy(cands), torch.from_numpy(mask)
+
+
+def batch_decision_inputs(states, cands, padding_id):
+    """
+    DecisionGraph inputs of env states and their candidates
+    :param cands: [{'feature': [...], 'item': [...]}] as returned by the env
+    :return: tuple of tensors, in the order of DecisionGraph.forward
+    """
+    neighbors, edge_index, edge_weight, node_offsets, cur_node_lengths = [], [], [], [], []
+    offset = 0
+    for state in states:
+        adj = state['adj']
+        neighbors.append(state['neighbors'])
+        edge_index.append(adj._indices() + offset)
+        edge_weight.append(adj._values())
+        node_offsets.append(offset)
+        cur_node_lengths.append(len(state['cur_node']))
+        offset += len(state['neighbors'])
+    feature_cands, feature_mask = _pad([c['feature'] for c in cands], padding_id)
+    item_cands, item_mask = _pad([c['item'] for c in cands], padding_id)
+    return (torch.cat(neighbors), torch.cat(edge_index, dim=1), torch.cat(edge_weight),
+            torch.LongTensor(node_offsets), torch.LongTensor(cur_node_lengths),
+            feature_cands, feature_mask, item_cands, item_mask)
+
+
+def export_decision_graph(ask_agent, rec_agent, path, option_strategy=0, precision='fp32'):
+    """
+    Script the DecisionGraph of the agents and save it, loadable with torch.jit.load alone
+    :param precision: fp32, or int8 to dynamically quantize its linear layers
+    :return: the scripted graph
+    """
+    graph = DecisionGraph(ask_agent, rec_agent, option_strategy=option_strategy)
+    if precision == 'int8':
+        seq = graph.seq
+        graph = torch.quantization.quantize_dynamic(graph, {nn.Linear}, dtype=torch.qint8)
+        # the scripted transformer layer reads the weights of its linear layers directly, keep it float
+        graph.seq = seq
+    scripted = torch.jit.script(graph.cpu())
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    torch.jit.save(scripted, path)
+    print('Decision graph saved at {}'.format(path))
+    return scripted
+
+
+@torch.no_grad()
+def check_decision_graph(args, kg, dataset, graph, ask_agent, rec_agent, user_size=100):
+    """
+    Compare the decisions of a (loaded) DecisionGraph with the python path of rl_evaluate, on the first
+    states of the first user_size test tuples, and the latency of the two
+    :return: option agreement, action agreement, max termination difference
+    """
+    ask, rec = inference_agents(ask_agent, rec_agent, 'fp32')
+    env = Evaluator(args, kg, dataset).env
+    states, cands = [], []
+    options, actions, terminations = [], [], []
+    python_time = 0.
+    for user in range(min(user_size, env.ui_array.shape[0])):
+        set_episode_seed(args.seed, user)
+        env.test_num = user
+        state, cand, action_space = env.reset()
+        start = time.perf_counter()
+        option = choose_option(ask, rec, state, cand, args.option_strategy)
+        agent = ask if option == 1 else rec
+        cand_list = cand['feature'] if option == 1 else cand['item']
+        space = action_space['feature'] if option == 1 else action_space['item']
+        actions.append(agent.select_action(state, cand_list, space, is_test=True).item())
+        terminations.append(agent.termination_net(agent.gcn_net([state])).item())
+        python_time += time.perf_counter() - start
+        options.append(option)
+        states.append(state)
+        cands.append(cand)
+
+    inputs = batch_decision_inputs(states, cands, ask_agent.PADDING_ID)
+    start = time.perf_counter()
+    _, _, graph_options, graph_actions, graph_terminations = graph(*inputs)
+    graph_time = time.perf_counter() - start
+
+    option_agreement = float(np.mean(graph_options.numpy() == np.array(options)))
+    action_agreement = float(np.mean(graph_actions.numpy() == np.array(actions)))
+    termination_diff = float(np.max(np.abs(graph_terminations.numpy() - np.array(terminations))))
+    print('Decision graph on {} states: option agreement {:.4f}, action agreement {:.4f}, '
+          'max termination difference {:.2e}'.format(len(states), option_agreement, action_agreement,
+                                                      termination_diff))
+    print('Per decision: python {:.3f}ms, decision graph {:.3f}ms (batch of {})'.format(
+        1000 * python_time / len(states), 1000 * graph_time / len(states), len(states)))
+    return option_agreement, action_agreement, termination_diff
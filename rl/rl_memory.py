@@ -1,17 +1,64 @@
 from collections import namedtuple
+import sys
 from utils.utils import *
+from utils.kg_format import save_arrays, load_arrays
 from rl.rl_sumtree import SumTree
 
 Transition = namedtuple('Transition',
                         ('state', 'action', 'next_state', 'reward', 'next_cand_items', 'next_cand_features'))
 
 
+def _tensor_nbytes(tensor):
+    if not torch.is_tensor(tensor):
+        return 0
+    if tensor.is_sparse:
+        return _tensor_nbytes(tensor._indices()) + _tensor_nbytes(tensor._values())
+    return tensor.element_size() * tensor.nelement()
+
+
+def _list_nbytes(values):
+    if not isinstance(values, (list, tuple)):
+        return 0
+    return sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values)
+
+
+def state_nbytes(state):
+    """
+    Bytes held by an env state: neighbors and sparse adj tensors, cur_node list and the dict itself.
+    0 for anything but a state dict (placeholder transitions of tests and benchmarks)
+    """
+    if not isinstance(state, dict):
+        return 0
+    return (sys.getsizeof(state) + _list_nbytes(state['cur_node']) +
+            _tensor_nbytes(state['neighbors']) + _tensor_nbytes(state['adj']))
+
+
+def transition_nbytes(transition):
+    """
+    Bytes held by a transition without its states, which are shared with the neighbouring transitions.
+    Only tensor and list fields are counted
+    """
+    return (sys.getsizeof(transition) + _tensor_nbytes(transition.action) + _tensor_nbytes(transition.reward) +
+            _list_nbytes(transition.next_cand_items) + _list_nbytes(transition.next_cand_features))
+
+
+def _histogram(counts, bins=10):
+    if not len(counts):
+        return []
+    hist, edges = np.histogram(counts, bins=bins)
+    return [(int(np.ceil(lo)), int(np.floor(hi)), int(n)) for lo, hi, n in zip(edges[:-1], edges[1:], hist)]
+
+
 class ReplayMemoryPER(object):
     """Prioritized Experience Replay
 
+    The bytes of the stored transitions are tracked on push / overwrite, every state dict counted once
+    however many transitions refer to it (the next_state of a step is the state of the following one).
+    With max_bytes, the oldest transitions are evicted while the memory is over this budget.
+
     """
     # stored as ( s, a, r, s_ ) in SumTree
-    def __init__(self, capacity, a=0.6, e=0.01):
+    def __init__(self, capacity, a=0.6, e=0.01, max_bytes=0):
         self.tree = SumTree(capacity)
         self.capacity = capacity
         self.prio_max = 0.1
@@ -19,11 +66,89 @@ class ReplayMemoryPER(object):
         self.e = e
         self.beta = 0.4
         self.beta_increment_per_sampling = 0.001
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.evicted = 0
+        self._sizes = np.zeros(capacity, dtype=np.int64)
+        self._state_refs = {}  # id(state) -> [references, bytes]
 
     def push(self, *args):
         data = Transition(*args)
         p = (np.abs(self.prio_max) + self.e) ** self.a  # proportional priority
+        slot = self.tree.write
+        self._release(slot)
         self.tree.add(p, data)
+        self._account(slot, data)
+        while self.max_bytes and self.nbytes > self.max_bytes and self.tree.n_entries > 1:
+            self._evict_oldest()
+
+    def _account(self, slot, data):
+        size = transition_nbytes(data)
+        self._sizes[slot] = size
+        self.nbytes += size
+        for state in (data.state, data.next_state):
+            if not isinstance(state, dict):
+                continue
+            ref = self._state_refs.get(id(state))
+            if ref is None:
+                ref = self._state_refs[id(state)] = [0, state_nbytes(state)]
+                self.nbytes += ref[1]
+            ref[0] += 1
+
+    def _release(self, slot):
+        """Forget the bytes of the transition stored in slot, and of its states no other transition refers to"""
+        data = self.tree.data[slot]
+        if not isinstance(data, Transition):
+            return
+        self.nbytes -= self._sizes[slot]
+        self._sizes[slot] = 0
+        for state in (data.state, data.next_state):
+            if not isinstance(state, dict):
+                continue
+            ref = self._state_refs[id(state)]
+            ref[0] -= 1
+            if ref[0] == 0:
+                del self._state_refs[id(state)]
+                self.nbytes -= ref[1]
+
+    def _evict_oldest(self):
+        """Drop the oldest transition: zero priority, so it is never sampled, and out of the live window"""
+        slot = self.live_slots()[0]
+        self._release(slot)
+        self.tree.update(slot + self.capacity - 1, 0)
+        self.tree.data[slot] = 0
+        self.tree.n_entries -= 1
+        self.evicted += 1
+
+    def live_slots(self):
+        """Slots of the stored transitions, oldest first (a contiguous window ending before tree.write)"""
+        tree = self.tree
+        start = tree.write - tree.n_entries
+        return [(start + k) % self.capacity for k in range(tree.n_entries)]
+
+    def memory_stats(self, bins=10):
+        """
+        Memory accounting of the stored transitions
+        :return: {'entries', 'bytes', 'bytes_per_transition', 'tree_bytes', 'estimated_full_bytes', 'evicted',
+                  'neighbors_hist', 'edges_hist'}, the histograms as (low, high, count) bins over the distinct states
+        """
+        neighbors, edges = [], []
+        seen = set()
+        for slot in self.live_slots():
+            data = self.tree.data[slot]
+            for state in (data.state, data.next_state):
+                if not isinstance(state, dict) or id(state) in seen:
+                    continue
+                seen.add(id(state))
+                neighbors.append(state['neighbors'].nelement())
+                edges.append(state['adj']._nnz())
+        entries = self.tree.n_entries
+        per_transition = self.nbytes / entries if entries else 0.
+        tree_bytes = self.tree.tree.nbytes + self.tree.data.nbytes + self._sizes.nbytes
+        return {'entries': entries, 'bytes': int(self.nbytes), 'bytes_per_transition': per_transition,
+                'tree_bytes': tree_bytes, 'estimated_full_bytes': int(per_transition * self.capacity) + tree_bytes,
+                'evicted': self.evicted, 'neighbors_hist': _histogram(neighbors, bins),
+                'edges_hist': _histogram(edges, bins)}
 
     def sample(self, batch_size):
         batch_data = []
@@ -57,3 +182,174 @@ class ReplayMemoryPER(object):
 
     def __len__(self):
         return self.tree.n_entries
+
+    def snapshot(self):
+        """
+        Cheap copy of the buffer state (transitions are shared, never modified after push), encoded
+        and written later by save_memory_snapshot, possibly from another thread
+        """
+        tree = self.tree
+        slots = self.live_slots()
+        return {'tree': tree.tree.copy(),
+                'slots': np.array(slots, dtype=np.int64),
+                'data': [tree.data[slot] for slot in slots],
+                'meta': {'capacity': self.capacity, 'write': tree.write, 'n_entries': tree.n_entries,
+                         'prio_max': float(self.prio_max), 'a': self.a, 'e': self.e, 'beta': float(self.beta),
+                         'beta_increment_per_sampling': self.beta_increment_per_sampling}}
+
+    def save(self, path):
+        save_memory_snapshot(path, self.snapshot())
+
+    def load(self, path):
+        """Restore transitions, SumTree priorities and the PER schedule from memory-mapped arrays"""
+        arrays, meta = load_arrays(path)
+        if meta['capacity'] != self.capacity:
+            raise ValueError('{} holds a replay memory of capacity {}, expected {}'.format(
+                path, meta['capacity'], self.capacity))
+        self.tree.tree[:] = arrays['tree']
+        self.tree.write = meta['write']
+        self.tree.n_entries = meta['n_entries']
+        self.tree.data[:] = 0
+        self.nbytes = 0
+        self._sizes[:] = 0
+        self._state_refs = {}
+        # snapshots without slots were written before eviction, with the transitions in slot order
+        slots = arrays['slots'] if 'slots' in arrays else range(meta['n_entries'])
+        for slot, transition in zip(slots, decode_transitions(arrays, meta['n_entries'])):
+            self.tree.data[slot] = transition
+            self._account(slot, transition)
+        self.prio_max = meta['prio_max']
+        self.a = meta['a']
+        self.e = meta['e']
+        self.beta = meta['beta']
+        self.beta_increment_per_sampling = meta['beta_increment_per_sampling']
+
+
+def format_memory_stats(name, stats):
+    """Log lines of ReplayMemoryPER.memory_stats()"""
+    lines = ['{} memory: {} transitions, {:.1f} MB, {:.1f} KB / transition, sum tree {:.1f} MB, '
+             'full capacity ~{:.1f} MB, evicted {}'.format(
+                 name, stats['entries'], stats['bytes'] / 2 ** 20, stats['bytes_per_transition'] / 2 ** 10,
+                 stats['tree_bytes'] / 2 ** 20, stats['estimated_full_bytes'] / 2 ** 20, stats['evicted'])]
+    for key in ['neighbors', 'edges']:
+        bins = ', '.join('{}-{}: {}'.format(lo, hi, n) for lo, hi, n in stats[key + '_hist'])
+        lines.append('  {} per state: {}'.format(key, bins))
+    return lines
+
+
+# Transitions are stored column-wise: every field is a ragged column (values + offsets) of flat arrays.
+# States are stored once in a state table (the next_state of a step is the state of the following one),
+# transitions refer to them by index (-1: no next state)
+_STATE_COLUMNS = [('cur_node', np.int64), ('neighbors', np.int64), ('adj_indices', np.int64), ('adj_values', np.float32)]
+_TABLE_COLUMNS = [('state.' + name, dtype) for name, dtype in _STATE_COLUMNS]
+_COLUMNS = [('action', np.int64), ('action.shape', np.int64), ('reward', np.float32), ('reward.shape', np.int64),
+            ('next_cand_items', np.int64), ('next_cand_features', np.int64)]
+# snapshots written before the state table held both states of every transition
+_LEGACY_COLUMNS = ([('s.' + name, dtype) for name, dtype in _STATE_COLUMNS] +
+                   [('n.' + name, dtype) for name, dtype in _STATE_COLUMNS] + _COLUMNS)
+
+
+def _encode_state(state):
+    adj = state['adj']
+    return [np.asarray(state['cur_node']), state['neighbors'].numpy(),
+            adj._indices().numpy().reshape(-1), adj._values().numpy()]
+
+
+def _decode_state(rows):
+    cur_node, neighbors, adj_indices, adj_values = rows
+    size = len(neighbors)
+    return {'cur_node': cur_node.tolist(),
+            'neighbors': torch.from_numpy(np.array(neighbors)),
+            'adj': torch.sparse_coo_tensor(torch.from_numpy(np.array(adj_indices).reshape(2, -1)),
+                                           torch.from_numpy(np.array(adj_values)), torch.Size([size, size]))}
+
+
+def _ragged(rows, columns):
+    arrays = {}
+    for name, dtype in columns:
+        offsets = np.zeros(len(rows[name]) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(r) for r in rows[name]])
+        values = np.concatenate(rows[name]).astype(dtype) if rows[name] else np.zeros(0, dtype=dtype)
+        arrays[name + '.values'] = values
+        arrays[name + '.offsets'] = offsets
+    return arrays
+
+
+def _row(columns, i):
+    return {name: values[offsets[i]:offsets[i + 1]] for name, (values, offsets) in columns.items()}
+
+
+def pack_transitions(transitions):
+    """
+    Encode transitions as flat numpy arrays (no tensors), every shared state once
+    :return: dict of arrays, read back by decode_transitions
+    """
+    rows = {name: [] for name, _ in _COLUMNS}
+    table = {name: [] for name, _ in _TABLE_COLUMNS}
+    state_ids = {}  # id(state) -> row of the state table
+
+    def state_index(state):
+        if state is None:
+            return -1
+        if id(state) not in state_ids:
+            state_ids[id(state)] = len(state_ids)
+            for (name, _), value in zip(_TABLE_COLUMNS, _encode_state(state)):
+                table[name].append(value)
+        return state_ids[id(state)]
+
+    n = len(transitions)
+    indices = np.zeros(n, dtype=np.int64)
+    next_indices = np.zeros(n, dtype=np.int64)
+    for i, t in enumerate(transitions):
+        indices[i] = state_index(t.state)
+        next_indices[i] = state_index(t.next_state)
+        action = t.action.detach().cpu().numpy()
+        reward = t.reward.detach().cpu().numpy()
+        fields = [action.reshape(-1), np.array(action.shape), reward.reshape(-1), np.array(reward.shape),
+                  np.asarray(t.next_cand_items).reshape(-1), np.asarray(t.next_cand_features).reshape(-1)]
+        for (name, _), value in zip(_COLUMNS, fields):
+            rows[name].append(value)
+    arrays = {'state_index': indices, 'next_state_index': next_indices}
+    arrays.update(_ragged(table, _TABLE_COLUMNS))
+    arrays.update(_ragged(rows, _COLUMNS))
+    return arrays
+
+
+def save_memory_snapshot(path, snapshot):
+    """Write a ReplayMemoryPER snapshot as .npy arrays, memory-mapped on load (no pickling)"""
+    arrays = pack_transitions(snapshot['data'])
+    arrays.update(tree=snapshot['tree'], slots=snapshot['slots'])
+    save_arrays(path, arrays, snapshot['meta'])
+
+
+def decode_transitions(arrays, n_entries):
+    """Transitions of a snapshot or pack_transitions, the states shared between transitions restored as shared objects"""
+    if 'state_index' not in arrays:
+        yield from _decode_legacy_transitions(arrays, n_entries)
+        return
+    table = {name: (arrays[name + '.values'], arrays[name + '.offsets']) for name, _ in _TABLE_COLUMNS}
+    states = [_decode_state([row[name] for name, _ in _TABLE_COLUMNS])
+              for row in (_row(table, k) for k in range(len(arrays['state.cur_node.offsets']) - 1))]
+    columns = {name: (arrays[name + '.values'], arrays[name + '.offsets']) for name, _ in _COLUMNS}
+    for i in range(n_entries):
+        row = _row(columns, i)
+        next_index = int(arrays['next_state_index'][i])
+        action = torch.from_numpy(np.array(row['action']).reshape(tuple(row['action.shape'])))
+        reward = torch.from_numpy(np.array(row['reward']).reshape(tuple(row['reward.shape'])))
+        yield Transition(states[int(arrays['state_index'][i])], action,
+                         states[next_index] if next_index >= 0 else None, reward,
+                         row['next_cand_items'].tolist(), row['next_cand_features'].tolist())
+
+
+def _decode_legacy_transitions(arrays, n_entries):
+    columns = {name: (arrays[name + '.values'], arrays[name + '.offsets']) for name, _ in _LEGACY_COLUMNS}
+    for i in range(n_entries):
+        row = _row(columns, i)
+        state = _decode_state([row['s.' + name] for name, _ in _STATE_COLUMNS])
+        next_state = None
+        if arrays['has_next'][i]:
+            next_state = _decode_state([row['n.' + name] for name, _ in _STATE_COLUMNS])
+        action = torch.from_numpy(np.array(row['action']).reshape(tuple(row['action.shape'])))
+        reward = torch.from_numpy(np.array(row['reward']).reshape(tuple(row['reward.shape'])))
+        yield Transition(state, action, next_state, reward,
+                         row['next_cand_items'].tolist(), row['next_cand_features'].tolist())
@@ -9,15 +9,20 @@ import statistics
 
 from rl.agent.ask_agent import AskAgent
 from rl.agent.rec_agent import RecAgent
-from rl.rl_memory import ReplayMemoryPER
+from rl.rl_memory import ReplayMemoryPER, format_memory_stats
 from rl.network.network_value import ValueNetwork
 from utils.utils import *
+from utils.event_log import get_logger, configure_logging, LEVELS
+from utils.timing import timer
+from utils.profiling import profile_window, PROFILERS, PROFILE_UNITS
 from rl.recommend_env.env_variable_question import VariableRecommendEnv
-from rl.rl_evaluate import rl_evaluate
+from rl.rl_evaluate import rl_evaluate, Evaluator, start_async_evaluator
+from rl.rl_checkpoint import CheckpointManager, load_agents
 from graph.gcn import GraphEncoder
 import warnings
 
 warnings.filterwarnings("ignore")
+log = get_logger('train')
 
 Transition = namedtuple('Transition',
                         ('state', 'action', 'next_state', 'reward', 'next_cand'))
@@ -57,7 +62,7 @@ def choose_option(ask_agent, rec_agent, state, cand, option_strategy=0, decay_st
             rec_Q = np.array(rec_score).dot(rec_prop)
         else:
             rec_Q = max(rec_score)
-        print("\n**CHOOSE OPTION** ASK VALUE:{}, REC VALUE:{}\n".format(ask_Q, rec_Q))
+        log.debug('choose_option', '\n**CHOOSE OPTION** ASK VALUE:{}, REC VALUE:{}\n', ask_Q, rec_Q)
         
         EPS_START=0.9
         EPS_END=0.1
@@ -66,7 +71,7 @@ def choose_option(ask_agent, rec_agent, state, cand, option_strategy=0, decay_st
                         math.exp(-1. * decay_step * EPS_DECAY)
         soft_random = random.random()
         # print(decay_step)
-        print("eps_threshold:{}".format(eps_threshold))
+        log.debug('eps_threshold', 'eps_threshold:{}', eps_threshold)
         if soft_random > eps_threshold:
             if ask_Q > rec_Q:
                 return 1
@@ -84,19 +89,16 @@ def calculate_hdcg_attribute(t, i):
     return 1 / math.log(t + 2, 2) + (1 / math.log(t + 1, 2) - 1 / math.log(t + 2, 2)) / math.log(i + 2, 2)
 
 
-def option_critic_pipeline(args, kg, dataset, filename):
-    
-    # Prepare the Environment
-    set_random_seed(args.seed)
-    env = VariableRecommendEnv(kg, dataset,
-                               args.data_name, args.embed, seed=args.seed, max_turn=args.max_turn,
-                               cand_feature_num=args.cand_feature_num, cand_item_num=args.cand_item_num,
-                               attr_num=args.attr_num, mode='train',
-                               entropy_way=args.entropy_method)
-
+def build_agents(args, kg, env, seed=None):
+    """
+    Build the shared GCN/value networks and both agents on top of the env embeddings
+    :return: ask_agent, rec_agent, value_net
+    """
     # User&Feature Embedding
-    embed = torch.FloatTensor(np.concatenate((env.ui_embeds, env.feature_emb, np.zeros((1, env.ui_embeds.shape[1]))), axis=0))
+    embed = embedding_table(env)
     # print(embed.size(0), embed.size(1))
+    # the ask agent explores with seed, the rec agent with seed + 1
+    seed = args.seed if seed is None else seed
     '''
     VALUE NET
     '''
@@ -106,218 +108,295 @@ def option_critic_pipeline(args, kg, dataset, filename):
     '''
     gcn_net = GraphEncoder(device=args.device, entity=embed.size(0), emb_size=embed.size(1), kg=kg,
                            embeddings=embed, fix_emb=args.fix_emb, seq=args.seq, gcn=args.gcn,
-                           hidden_size=args.hidden_size).to(args.device)
+                           hidden_size=args.hidden_size, pretrained_emb=args.pretrained_emb).to(args.device)
     '''
     ASK AGENT
     '''
     
     # Ask Memory
-    ask_memory = ReplayMemoryPER(args.memory_size)  # 50000
+    ask_memory = ReplayMemoryPER(args.memory_size, max_bytes=args.memory_max_bytes)  # 50000
     # Ask Agent
     ask_agent = AskAgent(device=args.device, memory=ask_memory, action_size=embed.size(1),
                          hidden_size=args.hidden_size, gcn_net=gcn_net, learning_rate=args.learning_rate,
-                         l2_norm=args.l2_norm, PADDING_ID=embed.size(0) - 1, value_net=value_net, alpha=args.alpha)
+                         l2_norm=args.l2_norm, PADDING_ID=embed.size(0) - 1, value_net=value_net, alpha=args.alpha,
+                         seed=seed)
     '''
     REC AGENT
     '''
     
     # Rec Memory
-    rec_memory = ReplayMemoryPER(args.memory_size)  # 50000
+    rec_memory = ReplayMemoryPER(args.memory_size, max_bytes=args.memory_max_bytes)  # 50000
     # Rec Agent
     rec_agent = RecAgent(device=args.device, memory=rec_memory, action_size=embed.size(1),
                          hidden_size=args.hidden_size, gcn_net=gcn_net, learning_rate=args.learning_rate,
-                         l2_norm=args.l2_norm, PADDING_ID=embed.size(0) - 1, value_net=value_net, alpha=args.alpha)
-    # load parameters
-    if args.load_rl_epoch != 0:
-        print('Loading Model in epoch {}'.format(args.load_rl_epoch))
-        ask_agent.load_model(data_name=args.data_name, filename=filename, epoch_user=args.load_rl_epoch)
-        rec_agent.load_model(data_name=args.data_name, filename=filename, epoch_user=args.load_rl_epoch)
-        value_net.load_value_net(data_name=args.data_name, filename=filename, epoch_user=args.load_rl_epoch)
+                         l2_norm=args.l2_norm, PADDING_ID=embed.size(0) - 1, value_net=value_net, alpha=args.alpha,
+                         seed=seed + 1)
+    return ask_agent, rec_agent, value_net
+
+
+def new_epoch_stats():
+    return {'AvgT': [], 'Suc_Turn': [], 'rec_step': [], 'ask_step': [], 'HDCG_attribute': [],
+            'HDCG_item': 0., 'total_reward': 0.,
+            'rec_loss': [], 'ask_loss': [], 'rec_state_infer_loss': [], 'ask_state_infer_loss': []}
+
+
+def optimize_agents(args, ask_agent, rec_agent, option, stats):
+    """
+    One learner update of both agents, the agent of the chosen option first
+    """
+    if option == 1:
+        agents = [('ask', ask_agent, rec_agent), ('rec', rec_agent, ask_agent)]
+    else:
+        agents = [('rec', rec_agent, ask_agent), ('ask', ask_agent, rec_agent)]
+    for name, agent, other_agent in agents:
+        with timer.phase(name + '_optimize_model'):
+            loss, loss_state = agent.optimize_model(args.batch_size, args.gamma, other_agent, args.term_reg)
+        if loss is not None:
+            stats[name + '_loss'].append(loss)
+            stats[name + '_state_infer_loss'].append(loss_state)
+
+
+def sample_episode(args, env, ask_agent, rec_agent, decay_step, stats, optimize=None):
+    """
+    Sample one conversation and push its transitions into the agents' memories
+    :param stats: epoch statistics, updated in place
+    :param optimize: called with the chosen option after every turn (None: sampling only)
+    :return: decay_step
+    """
+    with timer.phase('reset'):
+        state, cand, action_space = env.reset()
+    epi_reward = 0
+    done = 0
+    for t in range(1, args.max_turn+1):  # Turn
+        '''
+        Over Option: Select Ask / Rec
+        '''
+        env.cur_conver_step = 1
+        if done:
+            break
+        decay_step += 1
+        with timer.phase('choose_option'):
+            option = choose_option(ask_agent, rec_agent, state, cand, args.option_strategy, decay_step)
+
+        '''
+        Intra Option: Select features / items
+        '''
+        # ASK
+        if option == 1:
+            log.debug('turn', '\n————————Turn:  {}   Option: ASK————————', t, turn=t, option='ask')
+            termination = False
+            ask_score = []
+            while not termination and not done:
+                # Select Action
+                with timer.phase('select_action'):
+                    chosen_feature = ask_agent.select_action(state, cand["feature"], action_space["feature"])
+                # Env Interaction
+                with timer.phase('step'):
+                    next_state, next_cand, action_space, reward, done = env.step(chosen_feature.item(), None, mode="train")
+                # Reward Collection
+                epi_reward += reward
+                ask_score.append(reward)
+
+                # Whether Termination
+                with timer.phase('termination'):
+                    next_state_emb = ask_agent.gcn_net([next_state])
+                    term_score = ask_agent.termination_net(next_state_emb).item()
+                log.debug('termination', 'Termination Score: {}', term_score)
+                if term_score >= 0.5 or next_cand["feature"] == [] or env.cur_conver_step > args.max_ask_step:
+                    termination = True
+
+                # reward
+                if (termination or done) and t == env.max_turn:
+                    reward += env.reward_dict["quit"]
+                reward_ = torch.tensor([reward], device=args.device, dtype=torch.float)
+
+                # Push memory
+                ask_agent.memory.push(state, chosen_feature.cpu(), next_state, reward_.cpu(),
+                                      next_cand["item"], next_cand["feature"])
+                timer.count('ask_transitions')
+                state = next_state
+                cand = next_cand
+
+                # After Done
+                if done or (termination and t == env.max_turn):
+                    stats['AvgT'].append(t)
+                    stats['total_reward'] += epi_reward
+                    break
+
+            # calculate HDCG Attribute
+            for i in range(len(ask_score)):
+                if ask_score[i] > 0:
+                    stats['HDCG_attribute'].append(calculate_hdcg_attribute(t, i))
+
+        # RECOMMEND
+        elif option == 0:
+            log.debug('turn', '\n————————Turn:  {}   Option: REC————————', t, turn=t, option='rec')
+            termination = False
+            items = []
+            while not termination and not done:
+                # Select Action
+                with timer.phase('select_action'):
+                    chosen_item = rec_agent.select_action(state, cand["item"], action_space["item"])
+                items.append(chosen_item.item())
+
+                # Env Interaction
+                with timer.phase('step'):
+                    next_state, next_cand, action_space, reward, done = env.step(None, items, mode="train")
+
+                # Reward Collection
+                epi_reward += reward
+
+                # Whether Termination
+                with timer.phase('termination'):
+                    next_state_emb = rec_agent.gcn_net([next_state])
+                    term_score = rec_agent.termination_net(next_state_emb).item()
+                log.debug('termination', 'Termination Score: {}', term_score)
+                if term_score >= 0.5 or env.cur_conver_step > args.max_rec_step:
+                    termination = True
+
+                # reward
+                if (termination or done) and t == env.max_turn and reward < 0:
+                    reward += env.reward_dict["quit"]
+                reward_ = torch.tensor([reward], device=args.device, dtype=torch.float)
+
+                # Push memory
+                if done:
+                    next_state = None
+                rec_agent.memory.push(state, torch.tensor(chosen_item).cpu(), next_state, reward_.cpu(),
+                                      next_cand["item"], next_cand["feature"])
+                timer.count('rec_transitions')
+                state = next_state
+                cand = next_cand
+
+                # After Done
+                if done or (termination and t == args.max_turn):
+                    # every episode update the target model to be same with model
+                    if reward == env.reward_dict["rec_acc"]:  # recommend successfully
+                        stats['Suc_Turn'].append(t)
+                        stats['HDCG_item'] += calculate_hdcg_item(t, done)
+
+                    stats['AvgT'].append(t)
+                    stats['total_reward'] += epi_reward
+                    break
+
+        # Optimize
+        if optimize is not None:
+            with timer.phase('optimize'):
+                optimize(option)
+
+        if option == 1:
+            stats['ask_step'].append(env.cur_conver_step - 1)
+        else:
+            stats['rec_step'].append(env.cur_conver_step - 1)
+
+        env.cur_conver_turn += 1
+    return decay_step
+
+
+def save_epoch_metric(args, filename, epoch, stats, spend_time):
+    """
+    Print the epoch statistics and save them to the training log
+    """
+    # Analysis
+    stl = np.array(stats['Suc_Turn'])
+    SR5 = len(stl[stl <= 5]) / args.sample_times
+    SR10 = len(stl[stl <= 10]) / args.sample_times
+    SR15 = len(stl[stl <= 15]) / args.sample_times
+    Avg_REC_Turn = len(stats['rec_step']) / args.sample_times
+    Avg_ASK_Turn = len(stats['ask_step']) / args.sample_times
+    Avg_Turn = statistics.mean(stats['AvgT'])
+    Avg_REC_Step = statistics.mean(stats['rec_step'])
+    Avg_ASK_Step = statistics.mean(stats['ask_step'])
+    HDCG_item = stats['HDCG_item']
+    HDCG_attribute = statistics.mean(stats['HDCG_attribute']) if len(stats['HDCG_attribute']) else 0
+    print('\nSample Times:{}'.format(args.sample_times))
+    print('Recommend loss : {}'.format(statistics.mean(stats['rec_loss']) if len(stats['rec_loss']) else 0))
+    print('Recommend State Infer loss : {}'.format(statistics.mean(stats['rec_state_infer_loss']) if len(stats['rec_state_infer_loss']) else 0))
+    print('Ask loss : {}'.format(statistics.mean(stats['ask_loss']) if len(stats['ask_loss']) else 0))
+    print('Ask State Infer loss : {}'.format(statistics.mean(stats['ask_state_infer_loss']) if len(stats['ask_state_infer_loss']) else 0))
+    print('SR5:{}\nSR10:{}\nSR15:{}\nHDCG_item:{}\nHDCG_attribute:{}\nrewards:{}\n'.format(
+        SR5, SR10, SR15, HDCG_item / args.sample_times, HDCG_attribute, stats['total_reward'] / args.sample_times))
+    print('Avg_Turn:{}\nAvg_REC_Turn:{}\nAvg_ASK_Turn:{}\nAvg_REC_STEP:{}\nAvg_ASK_STEP:{}'.format(
+        Avg_Turn, Avg_REC_Turn, Avg_ASK_Turn, Avg_REC_Step, Avg_ASK_Step))
+
+    results = [SR5, SR10, SR15, Avg_Turn, Avg_REC_Turn, Avg_ASK_Turn, Avg_REC_Step, Avg_ASK_Step, HDCG_item / args.sample_times]
+    save_rl_mtric(args.data_name, 'Train-' + filename, epoch, results, spend_time, mode='train')
+    if timer.enabled:
+        timing = timer.format_summary()
+        print('\n'.join(timing))
+        save_rl_timing(args.data_name, 'Train-' + filename, epoch, timing)
+    return results
+
+
+def save_memory_metric(args, filename, epoch, ask_agent, rec_agent):
+    """Print the replay memory accounting of both agents and save it to the training log"""
+    lines = (format_memory_stats('Ask', ask_agent.memory.memory_stats()) +
+             format_memory_stats('Rec', rec_agent.memory.memory_stats()))
+    print('\n'.join(lines))
+    save_rl_memory(args.data_name, 'Train-' + filename, epoch, lines)
+
+
+def replay_memories(args, ask_agent, rec_agent):
+    """Replay memories saved with the checkpoint bundles (--save_replay) for a full resume"""
+    if not args.save_replay:
+        return None
+    return {'ask': ask_agent.memory, 'rec': rec_agent.memory}
 
+
+def option_critic_pipeline(args, kg, dataset, filename):
+    
+    # Prepare the Environment
+    set_random_seed(args.seed)
+    env = VariableRecommendEnv(kg, dataset,
+                               args.data_name, args.embed, seed=args.seed, max_turn=args.max_turn,
+                               cand_feature_num=args.cand_feature_num, cand_item_num=args.cand_item_num,
+                               attr_num=args.attr_num, mode='train',
+                               entropy_way=args.entropy_method)
+    ask_agent, rec_agent, value_net = build_agents(args, kg, env)
     decay_step = 0
+    # load parameters
+    if args.load_rl_epoch != 0:
+        bundle = load_agents(args, filename, ask_agent, rec_agent, value_net)
+        if bundle is not None:
+            decay_step = bundle['extra'].get('decay_step', 0)
+    checkpoints = CheckpointManager(args.data_name, filename, keep=args.checkpoint_keep)
+
+    # the test env is built at the first evaluation, then reused
+    evaluator = None
+    async_evaluator = start_async_evaluator(args, kg, dataset, filename, ask_agent, rec_agent)
+    profiler = profile_window(args, 'Train-' + filename)
     for epoch in range(1 + args.load_rl_epoch, args.max_epoch + 1):
         tt = time.time()
         start = tt
         print("\nEpoch: {}, Total: {}".format(epoch, args.max_epoch))
-        HDCG_item, total_reward = 0., 0.
-        AvgT_list = []
-        Suc_Turn_list = []
-        rec_step_list = []
-        ask_step_list = []
-        HDCG_attribute_list = []
-
-        rec_loss = []
-        ask_loss = []
-        rec_state_infer_loss = []
-        ask_state_infer_loss = []
-        if args.block_print:
-            blockPrint()
+        stats = new_epoch_stats()
+        timer.reset()
+
+        def optimize(option):
+            with profiler.unit('optimize'):
+                optimize_agents(args, ask_agent, rec_agent, option, stats)
+
         for episode in tqdm(range(args.sample_times), desc='sampling'):
-            print('\n================Epoch:{} Episode:{}===================='.format(epoch, episode))
-            state, cand, action_space = env.reset()
-            epi_reward = 0
-            done = 0
-            for t in range(1, args.max_turn+1):  # Turn
-                '''
-                Over Option: Select Ask / Rec
-                '''
-                env.cur_conver_step = 1
-                if done:
-                    break
-                decay_step += 1
-                option = choose_option(ask_agent, rec_agent, state, cand, args.option_strategy, decay_step)
-
-                '''
-                Intra Option: Select features / items
-                '''
-                # ASK
-                if option == 1:
-                    print("\n————————Turn: ", t, "  Option: ASK————————")
-                    termination = False
-                    ask_score = []
-                    while not termination and not done:
-                        # Select Action
-                        chosen_feature = ask_agent.select_action(state, cand["feature"], action_space["feature"])
-                        # Env Interaction
-                        next_state, next_cand, action_space, reward, done = env.step(chosen_feature.item(), None, mode="train")
-                        # Reward Collection
-                        epi_reward += reward
-                        ask_score.append(reward)
-
-                        # Whether Termination
-                        next_state_emb = ask_agent.gcn_net([next_state])
-                        term_score = ask_agent.termination_net(next_state_emb).item()
-                        print("Termination Score:", term_score)
-                        if term_score >= 0.5 or next_cand["feature"] == [] or env.cur_conver_step > args.max_ask_step:
-                            termination = True
-
-                        # reward
-                        if (termination or done) and t == env.max_turn:
-                            reward += env.reward_dict["quit"]
-                        reward_ = torch.tensor([reward], device=args.device, dtype=torch.float)
-
-                        # Push memory
-                        ask_agent.memory.push(state, chosen_feature.cpu(), next_state, reward_.cpu(),
-                                              next_cand["item"], next_cand["feature"])
-                        state = next_state
-                        cand = next_cand
-
-                        # After Done
-                        if done or (termination and t == env.max_turn):
-                            AvgT_list.append(t)
-                            total_reward += epi_reward
-                            break
-
-                    # calculate HDCG Attribute
-                    for i in range(len(ask_score)):
-                        if ask_score[i] > 0:
-                            HDCG_attribute_list.append(calculate_hdcg_attribute(t, i))
-                    # Optimize
-                    loss, loss_state = ask_agent.optimize_model(args.batch_size, args.gamma, rec_agent, args.term_reg)
-                    if loss is not None:
-                        ask_loss.append(loss)
-                        ask_state_infer_loss.append(loss_state)
-                    
-                    loss, loss_state = rec_agent.optimize_model(args.batch_size, args.gamma, ask_agent, args.term_reg)
-                    if loss is not None:
-                        rec_loss.append(loss)
-                        rec_state_infer_loss.append(loss_state)
-
-                # RECOMMEND
-                elif option == 0:
-                    print("\n————————Turn: ", t, "  Option: REC————————")
-                    termination = False
-                    items = []
-                    while not termination and not done:
-                        # Select Action
-                        chosen_item = rec_agent.select_action(state, cand["item"], action_space["item"])
-                        items.append(chosen_item.item())
-
-                        # Env Interaction
-                        next_state, next_cand, action_space, reward, done = env.step(None, items, mode="train")
-
-                        # Reward Collection
-                        epi_reward += reward
-
-                        # Whether Termination
-                        next_state_emb = rec_agent.gcn_net([next_state])
-                        term_score = rec_agent.termination_net(next_state_emb).item()
-                        print("Termination Score:", term_score)
-                        if term_score >= 0.5 or env.cur_conver_step > args.max_rec_step:
-                            termination = True
-
-                        # reward
-                        if (termination or done) and t == env.max_turn and reward < 0:
-                            reward += env.reward_dict["quit"]
-                        reward_ = torch.tensor([reward], device=args.device, dtype=torch.float)
-
-                        # Push memory
-                        if done:
-                            next_state = None
-                        rec_agent.memory.push(state, torch.tensor(chosen_item).cpu(), next_state, reward_.cpu(),
-                                              next_cand["item"], next_cand["feature"])
-                        state = next_state
-                        cand = next_cand
-
-                        # After Done
-                        if done or (termination and t == args.max_turn):
-                            # every episode update the target model to be same with model
-                            if reward == env.reward_dict["rec_acc"]:  # recommend successfully
-                                Suc_Turn_list.append(t)
-                                HDCG_item += calculate_hdcg_item(t, done)
-
-                            AvgT_list.append(t)
-                            total_reward += epi_reward
-                            break
-                    # Optimize
-                    loss, loss_state = rec_agent.optimize_model(args.batch_size, args.gamma, ask_agent, args.term_reg)
-                    if loss is not None:
-                        rec_loss.append(loss)
-                        rec_state_infer_loss.append(loss_state)
-
-                    loss, loss_state = ask_agent.optimize_model(args.batch_size, args.gamma, rec_agent, args.term_reg)
-                    if loss is not None:
-                        ask_loss.append(loss)
-                        ask_state_infer_loss.append(loss_state)
-
-                if option == 1:
-                    ask_step_list.append(env.cur_conver_step - 1)
-                else:
-                    rec_step_list.append(env.cur_conver_step - 1)
-
-                env.cur_conver_turn += 1
-
-        enablePrint()  # Enable print function
-
-        # Analysis
-        stl = np.array(Suc_Turn_list)
-        SR5 = len(stl[stl <= 5]) / args.sample_times
-        SR10 = len(stl[stl <= 10]) / args.sample_times
-        SR15 = len(stl[stl <= 15]) / args.sample_times
-        Avg_REC_Turn = len(rec_step_list) / args.sample_times
-        Avg_ASK_Turn = len(ask_step_list) / args.sample_times
-        Avg_Turn = statistics.mean(AvgT_list)
-        Avg_REC_Step = statistics.mean(rec_step_list)
-        Avg_ASK_Step = statistics.mean(ask_step_list)
-        HDCG_attribute = statistics.mean(HDCG_attribute_list) if len(HDCG_attribute_list) else 0
-        print('\nSample Times:{}'.format(args.sample_times))
-        print('Recommend loss : {}'.format(statistics.mean(rec_loss)))
-        print('Recommend State Infer loss : {}'.format(statistics.mean(rec_state_infer_loss)))
-        print('Ask loss : {}'.format(statistics.mean(ask_loss)))
-        print('Ask State Infer loss : {}'.format(statistics.mean(ask_state_infer_loss)))
-        print('SR5:{}\nSR10:{}\nSR15:{}\nHDCG_item:{}\nHDCG_attribute:{}\nrewards:{}\n'.format(
-            SR5, SR10, SR15, HDCG_item / args.sample_times, HDCG_attribute, total_reward / args.sample_times))
-        print('Avg_Turn:{}\nAvg_REC_Turn:{}\nAvg_ASK_Turn:{}\nAvg_REC_STEP:{}\nAvg_ASK_STEP:{}'.format(
-            Avg_Turn, Avg_REC_Turn, Avg_ASK_Turn, Avg_REC_Step, Avg_ASK_Step))
-
-        results = [SR5, SR10, SR15, Avg_Turn, Avg_REC_Turn, Avg_ASK_Turn, Avg_REC_Step, Avg_ASK_Step, HDCG_item / args.sample_times]
-        save_rl_mtric(args.data_name, 'Train-' + filename, epoch, results, time.time() - start, mode='train')
+            log.debug('episode', '\n================Epoch:{} Episode:{}====================', epoch, episode)
+            with timer.phase('episode'), profiler.unit('episode'):
+                decay_step = sample_episode(args, env, ask_agent, rec_agent, decay_step, stats, optimize=optimize)
+
+        save_epoch_metric(args, filename, epoch, stats, time.time() - start)
+        save_memory_metric(args, filename, epoch, ask_agent, rec_agent)
         if epoch % args.save_epoch_num == 0:
-            ask_agent.save_model(data_name=args.data_name, filename=filename, epoch_user=epoch)
-            rec_agent.save_model(data_name=args.data_name, filename=filename, epoch_user=epoch)
-            value_net.save_value_net(data_name=args.data_name, filename=filename, epoch_user=epoch)
+            checkpoints.save(epoch, ask_agent, rec_agent, value_net, extra={'decay_step': decay_step},
+                             memories=replay_memories(args, ask_agent, rec_agent))
         if epoch % args.eval_epoch_num == 0:
-            _ = rl_evaluate(args, kg, dataset, filename, epoch, ask_agent, rec_agent)
+            if async_evaluator is not None:
+                async_evaluator.submit(epoch, ask_agent, rec_agent)
+            else:
+                if evaluator is None:
+                    evaluator = Evaluator(args, kg, dataset)
+                _ = rl_evaluate(args, kg, dataset, filename, epoch, ask_agent, rec_agent, evaluator=evaluator)
+    profiler.close()
+    checkpoints.close()
+    if async_evaluator is not None:
+        async_evaluator.close()
     # print(test_performance)
 
 
@@ -341,9 +420,27 @@ def set_arguments():
     # Evaluate Setting
     parser.add_argument('--eval_user_size', '-eval_user_size', type=int, default=100, help='user size of evaluation in training or testing.')
     parser.add_argument('--load_rl_epoch', type=int, default=0, help='the epoch of loading rl model')
+    parser.add_argument('--checkpoint_keep', type=int, default=0, help='number of latest checkpoint bundles kept, 0 keeps all.')
+    parser.add_argument('--save_replay', type=int, default=0, help='also save the replay memories with the checkpoint bundles, for a full resume.')
+    parser.add_argument('--eval_workers', type=int, default=1, help='number of processes for evaluation (CPU only).')
+    parser.add_argument('--shared_data', type=int, default=0, help='workers attach KG / embeddings / interactions from shared memory.')
+    parser.add_argument('--shared_data_keep', type=int, default=0, help='keep the shared data publication after the run, for the next runs.')
+    parser.add_argument('--async_eval', type=int, default=0, help='evaluate agent snapshots in a background process (CPU only).')
+    parser.add_argument('--infer_precision', type=str, default='fp32', choices=['fp32', 'int8', 'bf16'], help='evaluate.py: run the networks with dynamic int8 quantization or bf16 autocast.')
+    parser.add_argument('--compare_precision', type=int, default=0, help='evaluate.py: compare SR / hDCG and decision latency of fp32, int8 and bf16.')
+    parser.add_argument('--export_decision', type=int, default=0, help='evaluate.py: export the TorchScript decision graph (int8 with --infer_precision int8) and check it.')
+    parser.add_argument('--policy_bundle', type=int, default=0, help='evaluate.py: load the single-file policy bundle of the epoch, written on first use.')
+    parser.add_argument('--async_eval_pending', type=int, default=1, help='max snapshots waiting for async evaluation, older ones are dropped (0: no limit).')
     
     # GPU Resource Setting
-    parser.add_argument('--block_print', '-block_print', type=int, default=1, help='Block Print or Not.')
+    parser.add_argument('--block_print', '-block_print', type=int, default=1, help='Block the per-step output or not (when --log_level is not set).')
+    parser.add_argument('--log_level', type=str, default=None, choices=list(LEVELS), help='debug prints every turn / step, info only the per-epoch output.')
+    parser.add_argument('--log_trace', type=str, default='', help='append the emitted log events to this JSONL file.')
+    parser.add_argument('--timing', type=int, default=0, help='log a per-phase timing breakdown of every epoch / evaluation.')
+    parser.add_argument('--profile', type=str, default='none', choices=PROFILERS, help='profile a window of episodes / optimize steps.')
+    parser.add_argument('--profile_unit', type=str, default='episode', choices=PROFILE_UNITS, help='unit of the profiled window.')
+    parser.add_argument('--profile_warmup', type=int, default=5, help='units run before profiling.')
+    parser.add_argument('--profile_active', type=int, default=10, help='units profiled.')
     parser.add_argument('--seed', '-seed', type=int, default=1, help='random seed.')
     parser.add_argument('--gpu', type=str, default='0', help='gpu device.')
     
@@ -355,16 +452,28 @@ def set_arguments():
     parser.add_argument('--alpha', type=float, default=1, help='TD alpha.')
     parser.add_argument('--hidden_size', type=int, default=100, help='number of samples')
     parser.add_argument('--memory_size', type=int, default=50000, help='size of memory ')
+    parser.add_argument('--memory_max_bytes', type=int, default=0, help='byte budget of each replay memory, the oldest transitions are evicted above it (0: no limit).')
     parser.add_argument('--option_strategy', type=int, default=0, help='{"0": softmax, "1": max}')
     parser.add_argument('--term_reg', type=float, default=0, help='termination regularization')
 
+    # Actor-Learner Setting
+    parser.add_argument('--num_actors', type=int, default=0, help='number of actor processes, 0 to interleave sampling and learning.')
+    parser.add_argument('--sync_interval', type=int, default=100, help='learner updates between two actor weight syncs')
+    parser.add_argument('--replay_ratio', type=float, default=0.5, help='max learner updates per received transition')
+
     # Graph and Embedding
     parser.add_argument('--entropy_method', type=str, default='weight_entropy',
                         help='entropy_method is one of {entropy, weight entropy}')
     parser.add_argument('--fix_emb', action='store_false', help='fix embedding or not')
+    parser.add_argument('--pretrained_emb', type=int, default=0,
+                        help='initialize the encoder embedding from --embed, shares the embedding store when fixed')
     parser.add_argument('--embed', type=str, default='transe', help='pretrained embeddings')
     parser.add_argument('--seq', type=str, default='transformer', help='sequential learning method')
     parser.add_argument('--gcn', action='store_false', help='use GCN or not')
 
     args = parser.parse_args()
+    if args.log_level is None:
+        args.log_level = 'info' if args.block_print else 'debug'
+    configure_logging(args.log_level, args.log_trace or None)
+    timer.enabled = bool(args.timing)
     return args
@@ -0,0 +1,148 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from graph.gcn import GraphEncoder, StateTransitionProb
+from utils.utils import CHECKPOINT_DIR
+from utils.timing import timer
+from rl.rl_evaluate import rl_evaluate, Evaluator
+
+INFER_PRECISIONS = ['fp32', 'int8', 'bf16']
+# phases of a single decision of the evaluation loop, timed by rl_evaluate
+DECISION_PHASES = ['choose_option', 'select_action', 'termination']
+# rl_evaluate results compared across precisions: SR@5, SR@10, SR@15, AvgT, hDCG
+COMPARED_METRICS = [('SR5', 0), ('SR10', 1), ('SR15', 2), ('AvgT', 3), ('hDCG', 8)]
+
+
+class Autocast(nn.Module):
+    """
+    Run the wrapped module under CPU bf16 autocast, its output cast back to float32
+    (every tensor of a tuple output, e.g. the (output, h_n) of an RNN)
+    """
+    def __init__(self, module):
+        super(Autocast, self).__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            output = self.module(*args, **kwargs)
+        if isinstance(output, tuple):
+            return tuple(o.float() if torch.is_tensor(o) else o for o in output)
+        return output.float()
+
+
+def convert_module(module, precision):
+    """
+    Eval-mode inference copy of a network: int8 replaces its nn.Linear layers (the transformer
+    feed-forward included) by dynamically quantized ones, bf16 runs the dense layers under autocast.
+    The sparse GCN propagation and the embedding table stay in float32.
+    """
+    module = copy.deepcopy(module).eval()
+    if precision == 'int8':
+        return torch.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+    if precision == 'bf16':
+        if isinstance(module, (GraphEncoder, StateTransitionProb)):
+            for name, child in list(module.named_children()):
+                if isinstance(child, (nn.Linear, nn.RNNBase, nn.TransformerEncoder)):
+                    setattr(module, name, Autocast(child))
+            return module
+        return Autocast(module)
+    return module
+
+
+def inference_agents(ask_agent, rec_agent, precision):
+    """
+    Copies of both agents for evaluation only, with their gcn, value, policy, termination and state
+    inference networks converted to precision; the shared gcn / value nets stay shared.
+    The training agents are not modified.
+    :return: ask_agent, rec_agent
+    """
+    gcn_net = convert_module(ask_agent.gcn_net, precision)
+    value_net = convert_module(ask_agent.value_net, precision)
+    agents = []
+    for agent in (ask_agent, rec_agent):
+        inference = copy.copy(agent)
+        inference.gcn_net = gcn_net
+        inference.value_net = value_net
+        inference.policy_net = convert_module(agent.policy_net, precision)
+        inference.termination_net = convert_module(agent.termination_net, precision)
+        # the inferrer holds the gcn as a submodule: convert its own layers only, then share the converted gcn
+        state_inferrer = copy.copy(agent.state_inferrer)
+        state_inferrer._modules = dict(state_inferrer._modules, gcn=None)
+        inference.state_inferrer = convert_module(state_inferrer, precision)
+        inference.state_inferrer.gcn = gcn_net
+        agents.append(inference)
+    return agents[0], agents[1]
+
+
+def decision_latency():
+    """
+    :return: {phase: (calls, mean, p99)} in seconds of the decision phases timed by the last rl_evaluate,
+             the busiest path of every phase
+    """
+    phases, _ = timer.summary()
+    latency = {}
+    for path, s in phases.items():
+        name = path.rsplit('/', 1)[-1]
+        if name in DECISION_PHASES and (name not in latency or s['count'] > latency[name][0]):
+            latency[name] = (s['count'], s['mean'], s['p99'])
+    return latency
+
+
+@torch.no_grad()
+def compare_precisions(args, kg, dataset, filename, ask_agent, rec_agent, precisions=('int8', 'bf16'),
+                       tolerance=0.02):
+    """
+    Evaluate the float32 agents (in eval mode) and their converted copies on the same test tuples,
+    and compare the SR@k / hDCG metrics and the per-decision latency. Every precision writes its own
+    Evaluate-epoch-* log (filename suffixed by the precision); the comparison is appended to
+    Quantize-<filename>.txt
+    :param tolerance: max absolute SR / hDCG difference to the float32 agents
+    :return: {precision: (results, latency)}, True if every precision is within tolerance
+    """
+    if args.eval_workers > 1:
+        print('Precision comparison times the decisions in this process, evaluating serially')
+        args = copy.copy(args)
+        args.eval_workers = 1
+    enabled = timer.enabled
+    timer.enabled = True
+    evaluator = Evaluator(args, kg, dataset)
+    comparison = {}
+    try:
+        for precision in ['fp32'] + [p for p in precisions if p != 'fp32']:
+            print('\nEvaluating in {}'.format(precision))
+            ask, rec = inference_agents(ask_agent, rec_agent, precision)
+            results = rl_evaluate(args, kg, dataset, filename + '-' + precision, args.load_rl_epoch, ask, rec,
+                                  evaluator=evaluator)
+            comparison[precision] = (results, decision_latency())
+    finally:
+        timer.enabled = enabled
+
+    reference, reference_latency = comparison['fp32']
+    passed = True
+    lines = []
+    for precision, (results, latency) in comparison.items():
+        deltas = []
+        for name, i in COMPARED_METRICS:
+            delta = results[i] - reference[i]
+            if name != 'AvgT' and abs(delta) > tolerance:
+                passed = False
+            deltas.append('{} {:.4f} ({:+.4f})'.format(name, results[i], delta))
+        lines.append('{}: {}'.format(precision, ', '.join(deltas)))
+        for phase in DECISION_PHASES:
+            if phase not in latency:
+                continue
+            calls, mean, p99 = latency[phase]
+            speedup = reference_latency[phase][1] / mean if phase in reference_latency and mean else 0
+            lines.append('  {}: calls {}, mean {:.3f}ms, p99 {:.3f}ms, x{:.2f} vs fp32'.format(
+                phase, calls, 1000 * mean, 1000 * p99, speedup))
+    lines.append('within tolerance {}: {}'.format(tolerance, passed))
+    print('\n'.join(lines))
+
+    path = CHECKPOINT_DIR[args.data_name] + '/log/Quantize-' + filename + '.txt'
+    with open(path, 'a') as f:
+        f.write('***EPOCH:{}***\n'.format(args.load_rl_epoch))
+        for line in lines:
+            f.write(line + '\n')
+    return comparison, passed
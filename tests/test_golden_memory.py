@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip('torch')
+
+import numpy as np
+
+from benchmark.golden_trajectories import memory_trace, compare
+from rl.rl_memory import ReplayMemoryPER, transition_nbytes
+
+
+def test_memory_trace_on_accounted_memory():
+    trace = memory_trace(ReplayMemoryPER, seed=0)
+    assert len(trace) == 30
+    for expected, actual in zip(trace, memory_trace(ReplayMemoryPER, seed=0)):
+        assert compare(expected, actual, rtol=0, atol=0) is None
+
+
+def test_placeholder_transitions_count_no_state_bytes():
+    memory = ReplayMemoryPER(4)
+    for i in range(6):
+        memory.push(i, 0, None, 0, [], [])
+    assert len(memory) == 4
+    assert not memory._state_refs
+    assert memory.nbytes == sum(transition_nbytes(memory.tree.data[slot]) for slot in memory.live_slots())
+    assert memory.memory_stats()['entries'] == 4
+    assert np.all(memory._sizes > 0)
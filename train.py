@@ -3,6 +3,7 @@ import torch
 
 from rl.agent.ask_agent import FeatureDict
 from rl.rl_option_critic import set_arguments, option_critic_pipeline
+from rl.rl_actor_learner import actor_learner_pipeline
 from utils.utils import load_kg, load_dataset
 
 if __name__ == '__main__':
@@ -28,4 +29,7 @@ if __name__ == '__main__':
     # train
     filename = 'train-datasets-{}-rl-cand_feature_num-{}-cand_item_num-{}-embed-{}-seq-{}-gcn-{}'.format(
         args.data_name, args.cand_feature_num, args.cand_item_num, args.embed, args.seq, args.gcn)
-    option_critic_pipeline(args, kg, dataset, filename)
+    if args.num_actors > 0:
+        actor_learner_pipeline(args, kg, dataset, filename)
+    else:
+        option_critic_pipeline(args, kg, dataset, filename)
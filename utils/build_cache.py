@@ -0,0 +1,102 @@
+import hashlib
+import inspect
+import json
+import os
+import time
+
+# Bumped when the manifest layout changes, invalidating every recorded stage
+BUILD_CACHE_VERSION = 1
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def project_path(path):
+    """Resolve a './datasets/...' path against the project root, whatever the working directory"""
+    return os.path.normpath(os.path.join(PROJECT_ROOT, path))
+
+
+def hash_paths(paths, chunk_size=1 << 20):
+    """
+    Content hash of files and directories (recursively, in sorted order, relative names included)
+    Missing paths hash as missing, so creating them invalidates the stage
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        path = project_path(path)
+        if os.path.isdir(path):
+            files = sorted(os.path.join(d, name) for d, _, names in os.walk(path) for name in names)
+        else:
+            files = [path]
+        for file in files:
+            h.update(os.path.relpath(file, PROJECT_ROOT).encode('utf-8'))
+            if not os.path.isfile(file):
+                h.update(b'\0missing')
+                continue
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_sources(objects):
+    """Code version of a stage: hash of the source files of the given modules / classes / functions"""
+    files = sorted({inspect.getsourcefile(obj) for obj in objects})
+    return hash_paths(files)
+
+
+class BuildCache(object):
+    """
+    Staged build of the processed data of one dataset. Every stage records in <processed>/build_manifest.json
+    the content hash of its inputs and of its code; a stage whose hashes are unchanged and whose outputs
+    exist is skipped.
+
+    """
+    def __init__(self, processed_dir, force=False):
+        self.manifest_file = os.path.join(project_path(processed_dir), 'build_manifest.json')
+        self.force = force
+        self.manifest = {'version': BUILD_CACHE_VERSION, 'stages': {}}
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == BUILD_CACHE_VERSION:
+                self.manifest = manifest
+        self.timings = []
+
+    def run(self, stage, inputs, code, outputs, build, params=None):
+        """
+        :param inputs: files / directories read by the stage
+        :param code: modules / classes whose source defines the stage
+        :param outputs: files / directories written by the stage
+        :param build: callable running the stage
+        :param params: json serializable options of the stage
+        :return: True if the stage was built, False if skipped
+        """
+        start = time.time()
+        record = {'inputs': hash_paths(inputs), 'code': hash_sources(code), 'params': params}
+        previous = self.manifest['stages'].get(stage, {})
+        unchanged = all(previous.get(key) == value for key, value in record.items())
+        if not self.force and unchanged and all(os.path.exists(project_path(p)) for p in outputs):
+            spend = time.time() - start
+            self.timings.append((stage, 'skipped', spend))
+            print('Stage {}: unchanged, skipped ({:.2f}s)'.format(stage, spend))
+            return False
+        build()
+        spend = time.time() - start
+        record['seconds'] = spend
+        self.manifest['stages'][stage] = record
+        self.save()
+        self.timings.append((stage, 'built', spend))
+        print('Stage {}: built ({:.2f}s)'.format(stage, spend))
+        return True
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.manifest_file)):
+            os.makedirs(os.path.dirname(self.manifest_file))
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_file, self.manifest_file)
+
+    def summary(self):
+        for stage, status, spend in self.timings:
+            print('{:<24s} {:<8s} {:8.2f}s'.format(stage, status, spend))
+        print('{:<24s} {:<8s} {:8.2f}s'.format('total', '', sum(t[2] for t in self.timings)))
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+
+from utils.kg_format import save_arrays, load_arrays, has_arrays
+
+
+def embeds_to_table(ui_emb, feature_emb, dtype='float32'):
+    """
+    Lay out user, item, feature and padding rows contiguously, in the entity id order of GraphEncoder
+    :return: np.array [(U+I+F+1) x D]
+    """
+    ui_rows, feature_rows = len(ui_emb), len(feature_emb)
+    table = np.zeros((ui_rows + feature_rows + 1, np.shape(ui_emb)[1]), dtype=dtype)
+    table[:ui_rows] = ui_emb
+    table[ui_rows:ui_rows + feature_rows] = feature_emb
+    return table
+
+
+def table_to_embeds(table, ui_rows):
+    """Views of the table in the load_embed layout, no copy"""
+    return {'ui_emb': table[:ui_rows], 'feature_emb': table[ui_rows:-1], 'table': table}
+
+
+def save_embed_store(path, embeds, dtype='float32'):
+    """
+    :param embeds: {'ui_emb': np.array, 'feature_emb': np.array} as pickled in embeds/<embed>.pkl
+    :param dtype: float32 or float16
+    """
+    table = embeds_to_table(embeds['ui_emb'], embeds['feature_emb'], dtype=dtype)
+    save_arrays(path, {'table': table}, {'ui_rows': len(embeds['ui_emb']), 'feature_rows': len(embeds['feature_emb']),
+                                         'dtype': dtype})
+
+
+def load_embed_store(path, mmap=True):
+    """
+    :return: embeds dict with 'ui_emb' / 'feature_emb' views and the whole 'table' (padding row last)
+    """
+    arrays, meta = load_arrays(path, mmap=mmap)
+    return table_to_embeds(arrays['table'], meta['ui_rows'])
+
+
+def has_embed_store(path):
+    return has_arrays(path)
+
+
+def embed_store_path(processed_dir, embed):
+    return os.path.join(processed_dir, 'embeds', embed)
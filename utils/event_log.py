@@ -0,0 +1,95 @@
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+# Process-wide settings, inherited by forked workers
+_config = {'level': INFO, 'trace_fd': None}
+_loggers = {}
+
+
+def _to_json(value):
+    if torch.is_tensor(value):
+        return value.tolist()
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+
+class EventLogger(object):
+    """
+    Levelled logger of named events. The message is a str.format template that is only formatted
+    when the event is emitted, and keyword fields are only serialized into the JSONL trace.
+    A disabled level costs one attribute check: call sites whose arguments are costly to build
+    (tensor values, set differences) test debug_enabled before calling debug().
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.apply_config()
+
+    def apply_config(self):
+        self.level = _config['level']
+        self.debug_enabled = self.level <= DEBUG
+        self.info_enabled = self.level <= INFO
+
+    def log(self, level, event, msg='', *args, **fields):
+        if level < self.level:
+            return
+        text = msg.format(*args) if args else msg
+        if text:
+            print(text)
+        trace_fd = _config['trace_fd']
+        if trace_fd is not None:
+            record = {'time': time.time(), 'pid': os.getpid(), 'logger': self.name,
+                      'level': LEVEL_NAMES[level], 'event': event}
+            if text:
+                record['msg'] = text
+            record.update(fields)
+            # a single O_APPEND write per line: lines of forked workers do not interleave
+            os.write(trace_fd, (json.dumps(record, default=_to_json) + '\n').encode('utf-8'))
+
+    def debug(self, event, msg='', *args, **fields):
+        if self.debug_enabled:
+            self.log(DEBUG, event, msg, *args, **fields)
+
+    def info(self, event, msg='', *args, **fields):
+        if self.info_enabled:
+            self.log(INFO, event, msg, *args, **fields)
+
+    def warning(self, event, msg='', *args, **fields):
+        self.log(WARNING, event, msg, *args, **fields)
+
+
+def get_logger(name):
+    if name not in _loggers:
+        _loggers[name] = EventLogger(name)
+    return _loggers[name]
+
+
+def configure_logging(level='info', trace_file=None):
+    """
+    :param level: one of LEVELS, events below it are neither printed nor traced
+    :param trace_file: append every emitted event as one JSON line to this file (None: no trace)
+    """
+    _config['level'] = LEVELS[level]
+    if _config['trace_fd'] is not None:
+        os.close(_config['trace_fd'])
+        _config['trace_fd'] = None
+    if trace_file:
+        trace_dir = os.path.dirname(trace_file)
+        if trace_dir and not os.path.isdir(trace_dir):
+            os.makedirs(trace_dir)
+        _config['trace_fd'] = os.open(trace_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    for logger in _loggers.values():
+        logger.apply_config()
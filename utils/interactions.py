@@ -0,0 +1,78 @@
+import json
+import os
+from collections.abc import Mapping
+from itertools import chain
+
+import numpy as np
+
+from utils.utils import RAW_DATA_DIR, PROCESSED_DATA_DIR
+from utils.kg_format import save_arrays, load_arrays, has_arrays
+
+SPLIT_FILES = {'train': 'review_dict_train.json', 'test': 'review_dict_test.json'}
+
+
+class InteractionView(Mapping):
+    """Read-only view of a review_dict_*.json split: user id string -> array of item ids"""
+
+    def __init__(self, users, offsets, items):
+        self.users = users
+        self.offsets = offsets
+        self.items = items
+        self.user_pos = {str(u): i for i, u in enumerate(users.tolist())}
+
+    def __getitem__(self, user_str):
+        pos = self.user_pos[user_str]
+        return self.items[self.offsets[pos]:self.offsets[pos + 1]]
+
+    def __iter__(self):
+        return iter(self.user_pos)
+
+    def __len__(self):
+        return len(self.user_pos)
+
+    def lengths(self):
+        """Number of items per user, in the json key order"""
+        return np.diff(self.offsets)
+
+    def pairs(self):
+        """[[user_id, item_id], ...] in the json order, as built by the per-user loop over the dict"""
+        return np.stack([np.repeat(self.users, self.lengths()), self.items], axis=1)
+
+
+def interactions_to_arrays(ui_dict):
+    """
+    :param ui_dict: {user_str: [item ids]}
+    :return: users, offsets, items as int32 arrays (int64 offsets), in the json key order
+    """
+    users = np.array([int(u) for u in ui_dict.keys()], dtype=np.int32)
+    offsets = np.zeros(len(users) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(items) for items in ui_dict.values()])
+    items = np.fromiter(chain.from_iterable(ui_dict.values()), dtype=np.int32, count=int(offsets[-1]))
+    return users, offsets, items
+
+
+def split_fingerprint(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def load_interactions(data_name, mode):
+    """
+    Load a RL interaction split as an InteractionView over memory-mapped arrays in
+    <processed>/interactions/<mode>/, converted from the json file on first use and whenever
+    the json file changes (size / mtime)
+    """
+    split_file = os.path.join(RAW_DATA_DIR[data_name], 'UI_Interaction_data', SPLIT_FILES[mode])
+    cache_path = os.path.join(PROCESSED_DATA_DIR[data_name], 'interactions', mode)
+    fingerprint = split_fingerprint(split_file)
+    if has_arrays(cache_path):
+        arrays, meta = load_arrays(cache_path)
+        if meta.get('source') == fingerprint:
+            return InteractionView(arrays['users'], arrays['offsets'], arrays['items'])
+    print('{}_data: convert {} to {}'.format(mode, split_file, cache_path))
+    with open(split_file, encoding='utf-8') as f:
+        ui_dict = json.load(f)
+    users, offsets, items = interactions_to_arrays(ui_dict)
+    save_arrays(cache_path, {'users': users, 'offsets': offsets, 'items': items}, {'source': fingerprint})
+    arrays, _ = load_arrays(cache_path)
+    return InteractionView(arrays['users'], arrays['offsets'], arrays['items'])
@@ -0,0 +1,201 @@
+import json
+import os
+import pickle
+from collections import OrderedDict
+from collections.abc import Mapping
+from types import MappingProxyType
+from itertools import chain
+
+import numpy as np
+
+# Version of the on-disk graph layout, bumped on incompatible changes
+KG_FORMAT_VERSION = 1
+# decoded nodes kept per entity view, the least recently used ones are dropped
+NODE_CACHE_SIZE = 8192
+
+
+def save_arrays(path, arrays, meta):
+    """
+    Save numpy arrays as one .npy file each plus a meta.json, so they can be memory-mapped
+    :param arrays: dict of name -> np.array
+    :param meta: json serializable dict
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, array in arrays.items():
+        # write then rename, processes that still map the old file keep a consistent copy
+        tmp_file = os.path.join(path, '{}.npy.tmp{}'.format(name, os.getpid()))
+        with open(tmp_file, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(tmp_file, os.path.join(path, name + '.npy'))
+    meta = dict(meta, arrays=sorted(arrays.keys()))
+    # meta.json is written last: its presence marks a complete directory
+    tmp_file = os.path.join(path, 'meta.json.tmp{}'.format(os.getpid()))
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, os.path.join(path, 'meta.json'))
+
+
+def load_arrays(path, mmap=True):
+    """
+    :return: arrays (read-only memory maps if mmap), meta
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    mmap_mode = 'r' if mmap else None
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in meta['arrays']}
+    return arrays, meta
+
+
+def has_arrays(path):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+class GraphEntityView(Mapping):
+    """
+    Read-only view of G[entity]: eid -> read-only {relation: tuple of neighbor ids}, backed by per-relation
+    CSR arrays. The env reads the same nodes on every step, so the recently decoded nodes are kept, a bounded
+    number of them (NODE_CACHE_SIZE) so that the cache does not grow into a per-process copy of the arrays.
+    """
+
+    def __init__(self, ids, relations, offsets, indices, extras):
+        self.ids = ids
+        self.relations = relations
+        self.offsets = offsets
+        self.indices = indices
+        self.extras = extras
+        self._cache = OrderedDict()  # eid -> decoded node, least recently used first
+        # ids are 0..n-1 for most entities, then the position is the id itself
+        self.contiguous = len(ids) == 0 or (int(ids[0]) == 0 and int(ids[-1]) == len(ids) - 1)
+
+    def position(self, eid):
+        if self.contiguous:
+            if 0 <= eid < len(self.ids):
+                return int(eid)
+        else:
+            pos = int(np.searchsorted(self.ids, eid))
+            if pos < len(self.ids) and self.ids[pos] == eid:
+                return pos
+        raise KeyError(eid)
+
+    def neighbors(self, pos, relation):
+        if relation in self.extras:
+            return self.extras[relation][pos]
+        offsets = self.offsets[relation]
+        return tuple(self.indices[relation][offsets[pos]:offsets[pos + 1]].tolist())
+
+    def __getitem__(self, eid):
+        cache = self._cache
+        node = cache.get(eid)
+        if node is not None:
+            cache.move_to_end(eid)
+            return node
+        pos = self.position(eid)
+        node = MappingProxyType({r: self.neighbors(pos, r) for r in self.relations})
+        cache[eid] = node
+        if len(cache) > NODE_CACHE_SIZE:
+            cache.popitem(last=False)
+        return node
+
+    def __contains__(self, eid):
+        try:
+            self.position(eid)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class CSRGraph(object):
+    """Read-only replacement of the YelpGraph / LastFmGraph / ... objects, backed by per-relation CSR
+    arrays, memory-mapped when loaded from path. G keeps the nested G[entity][eid][relation] interface.
+
+    """
+    def __init__(self, path=None, mmap=True, arrays=None, meta=None, extras=None):
+        self.path = path
+        if path is not None:
+            arrays, meta = load_arrays(path, mmap=mmap)
+            extras = {}
+            if meta.get('extras'):
+                with open(os.path.join(path, 'extras.pkl'), 'rb') as f:
+                    extras = pickle.load(f)
+        if meta.get('version') != KG_FORMAT_VERSION:
+            raise ValueError('{} has graph format version {}, expected {}'.format(
+                path, meta.get('version'), KG_FORMAT_VERSION))
+        self.arrays = arrays
+        self.meta = meta
+        self.extras = extras or {}
+        self.G = dict()
+        for etype, relations in meta['entities'].items():
+            entity_extras = self.extras.get(etype, {})
+            offsets = {r: arrays['{}.{}.offsets'.format(etype, r)] for r in relations if r not in entity_extras}
+            indices = {r: arrays['{}.{}.indices'.format(etype, r)] for r in relations if r not in entity_extras}
+            self.G[etype] = GraphEntityView(arrays[etype + '.ids'], relations, offsets, indices, entity_extras)
+
+    def __deepcopy__(self, memo):
+        # read-only: copies of an env can share the graph
+        return self
+
+    def __reduce__(self):
+        if self.path is not None:
+            # pickled as its path, the receiving process maps the same files
+            return CSRGraph, (self.path,)
+        return CSRGraph, (None, True, self.arrays, self.meta, self.extras)
+
+
+def kg_to_arrays(kg):
+    """
+    Convert the nested dict graph kg.G into per-(entity, relation) CSR arrays
+    :return: arrays, meta, extras (relations with non-integer neighbors, kept as tuples)
+    """
+    arrays = {}
+    extras = {}
+    meta = {'version': KG_FORMAT_VERSION, 'entities': {}}
+    for etype, nodes in kg.G.items():
+        ids = sorted(nodes.keys())
+        relations = []
+        for node in nodes.values():
+            for r in node:
+                if r not in relations:
+                    relations.append(r)
+        arrays[etype + '.ids'] = np.array(ids, dtype=np.int64)
+        for r in relations:
+            neighbors = [tuple(nodes[eid].get(r, ())) for eid in ids]
+            offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(n) for n in neighbors])
+            flat = list(chain.from_iterable(neighbors))
+            if not all(isinstance(x, (int, np.integer)) for x in flat):
+                extras.setdefault(etype, {})[r] = neighbors
+                continue
+            arrays['{}.{}.offsets'.format(etype, r)] = offsets
+            arrays['{}.{}.indices'.format(etype, r)] = np.array(flat, dtype=np.int64)
+        meta['entities'][etype] = relations
+    meta['extras'] = bool(extras)
+    return arrays, meta, extras
+
+
+def save_csr_graph(path, kg):
+    """
+    Save kg in the memory-mapped graph format:
+    <path>/meta.json, <entity>.ids.npy, <entity>.<relation>.offsets.npy / .indices.npy (CSR) and
+    extras.pkl for relations with non-integer neighbors
+    """
+    if isinstance(kg, CSRGraph):
+        arrays, meta, extras = kg.arrays, kg.meta, kg.extras
+    else:
+        arrays, meta, extras = kg_to_arrays(kg)
+    if extras:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'extras.pkl'), 'wb') as f:
+            pickle.dump(extras, f)
+    save_arrays(path, arrays, meta)
+
+
+def load_csr_graph(path):
+    return CSRGraph(path)
@@ -0,0 +1,100 @@
+import contextlib
+import cProfile
+import os
+import pstats
+
+import torch
+
+from utils.utils import CHECKPOINT_DIR
+
+PROFILERS = ['none', 'torch', 'cprofile']
+PROFILE_UNITS = ['episode', 'optimize']
+
+
+class ProfileWindow(object):
+    """
+    Profile a bounded window of a loop: the units (episodes or optimize steps) wrapped in unit() are
+    counted, the first warmup ones run unprofiled, the next active ones are profiled with
+    torch.profiler (CPU ops with shapes and memory, from the start of the first active unit to the
+    end of the last one, every unit marked with record_function) or cProfile (inside the units only).
+    The chrome trace / .prof stats and a summary table are written to log_dir as Profile-<name>.*
+
+    """
+    def __init__(self, mode, log_dir, name, unit='episode', warmup=5, active=10):
+        self.mode = mode
+        self.log_dir = log_dir
+        self.name = name
+        self.unit_name = unit
+        self.warmup = warmup
+        self.active = active
+        self.count = 0
+        self.profiler = None
+        self.done = mode == 'none'
+
+    @contextlib.contextmanager
+    def unit(self, unit_name):
+        """Wrap one unit of the loop; units of another kind than the profiled one are not counted"""
+        if self.done or unit_name != self.unit_name:
+            yield
+            return
+        index = self.count
+        self.count += 1
+        if index < self.warmup:
+            yield
+            return
+        if self.profiler is None:
+            self._start()
+        if self.mode == 'torch':
+            with torch.profiler.record_function(unit_name):
+                yield
+        else:
+            self.profiler.enable()
+            try:
+                yield
+            finally:
+                self.profiler.disable()
+        if index + 1 >= self.warmup + self.active:
+            self.close()
+
+    def _start(self):
+        print('Profiling {} {} {}s with {}'.format(self.active, self.name, self.unit_name, self.mode))
+        if self.mode == 'torch':
+            self.profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                                   record_shapes=True, profile_memory=True)
+            self.profiler.__enter__()
+        else:
+            self.profiler = cProfile.Profile()
+
+    def close(self):
+        """Write the results, also when the loop ended inside the window"""
+        if self.done:
+            return
+        self.done = True
+        if self.profiler is None:
+            print('Profiling {}: the loop ended during the {} warm-up {}s'.format(self.name, self.warmup, self.unit_name))
+            return
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        path = os.path.join(self.log_dir, 'Profile-' + self.name)
+        if self.mode == 'torch':
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(path + '.json')
+            averages = self.profiler.key_averages()
+            with open(path + '.txt', 'w') as f:
+                f.write(averages.table(sort_by='self_cpu_time_total', row_limit=50) + '\n')
+                f.write(averages.table(sort_by='self_cpu_memory_usage', row_limit=20) + '\n')
+            print('Profile saved at {}.json / .txt'.format(path))
+        else:
+            self.profiler.dump_stats(path + '.prof')
+            with open(path + '.txt', 'w') as f:
+                stats = pstats.Stats(self.profiler, stream=f)
+                stats.sort_stats('cumulative').print_stats(50)
+                stats.sort_stats('tottime').print_stats(30)
+            print('Profile saved at {}.prof / .txt'.format(path))
+        self.profiler = None
+
+
+def profile_window(args, name):
+    """ProfileWindow of the --profile* arguments, writing to the checkpoint log directory"""
+    return ProfileWindow(args.profile, CHECKPOINT_DIR[args.data_name] + '/log/', name, unit=args.profile_unit,
+                         warmup=args.profile_warmup, active=args.profile_active)
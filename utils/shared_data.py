@@ -0,0 +1,128 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+from utils.utils import load_embed, RAW_DATA_DIR, PROCESSED_DATA_DIR
+from utils.interactions import InteractionView, load_interactions, split_fingerprint, SPLIT_FILES
+from utils.kg_format import CSRGraph, save_arrays, load_arrays, has_arrays, save_csr_graph
+from utils.embed_store import embeds_to_table, table_to_embeds, embed_store_path, has_embed_store
+
+# Published data lives in RAM-backed storage when available, workers map the same pages
+SHARED_DATA_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+# publications removed at the exit of this process
+_cleanup_paths = set()
+
+
+class SharedData(object):
+    """KG, embeddings and interaction splits attached from a directory written by publish_shared_data
+
+    """
+    def __init__(self, path):
+        self.path = path
+        arrays, meta = load_arrays(os.path.join(path, 'data'))
+        self.kg = CSRGraph(meta['kg_path'])
+        self.embeds = None
+        if meta['embed']:
+            self.embeds = table_to_embeds(arrays['embed_table'], meta['ui_rows'])
+        self.splits = {mode: InteractionView(arrays[mode + '.users'], arrays[mode + '.offsets'], arrays[mode + '.items'])
+                       for mode in meta['splits']}
+
+    def interactions(self, mode):
+        return self.splits[mode]
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return SharedData, (self.path,)
+
+
+def _file_fingerprint(path):
+    return split_fingerprint(path) if os.path.isfile(path) else None
+
+
+def source_fingerprint(data_name, kg, embed):
+    """
+    Version of the data a publication is built from: graph format version and meta.json of the mapped KG
+    (or the legacy kg.pkl), embedding store / pickle and interaction json files (size / mtime)
+    """
+    processed = PROCESSED_DATA_DIR[data_name]
+    if isinstance(kg, CSRGraph) and kg.path is not None:
+        source = {'kg_version': kg.meta.get('version'), 'kg': _file_fingerprint(os.path.join(kg.path, 'meta.json'))}
+    else:
+        source = {'kg_version': None, 'kg': _file_fingerprint(os.path.join(processed, 'kg.pkl'))}
+    if embed:
+        store_path = embed_store_path(processed, embed)
+        if has_embed_store(store_path):
+            source['embed'] = _file_fingerprint(os.path.join(store_path, 'meta.json'))
+        else:
+            source['embed'] = _file_fingerprint(os.path.join(processed, 'embeds', '{}.pkl'.format(embed)))
+    for mode, split_file in sorted(SPLIT_FILES.items()):
+        source[mode] = _file_fingerprint(os.path.join(RAW_DATA_DIR[data_name], 'UI_Interaction_data', split_file))
+    return source
+
+
+def remove_shared_data(path):
+    """Delete a publication; processes that already attached it keep their mappings"""
+    shutil.rmtree(path, ignore_errors=True)
+    _cleanup_paths.discard(path)
+    print('Shared data removed at {}'.format(path))
+
+
+def _remove_at_exit():
+    for path in list(_cleanup_paths):
+        remove_shared_data(path)
+
+
+atexit.register(_remove_at_exit)
+
+
+def publish_shared_data(data_name, kg, embed, path=None, force=False, cleanup=True):
+    """
+    Publish the KG adjacency, the embeddings and the RL interaction splits once, so that worker
+    processes can attach them zero-copy with attach_shared_data instead of unpickling their own copies.
+    An existing publication is reused if it was built from the same data (source_fingerprint) unless
+    force, and republished otherwise.
+    :param cleanup: remove the publication when this process exits
+    :return: path of the published data
+    """
+    if path is None:
+        path = os.path.join(SHARED_DATA_DIR, 'cochpl-{}-{}'.format(data_name, embed))
+    if cleanup:
+        _cleanup_paths.add(path)
+    source = source_fingerprint(data_name, kg, embed)
+    if has_arrays(os.path.join(path, 'data')) and not force:
+        _, meta = load_arrays(os.path.join(path, 'data'))
+        if meta.get('source') == source:
+            print('Shared data already published at {}'.format(path))
+            return path
+        print('Shared data at {} is outdated, republishing'.format(path))
+    if isinstance(kg, CSRGraph):
+        # already memory-mapped from disk, the workers map the same files
+        kg_path = kg.path
+    else:
+        kg_path = os.path.join(path, 'kg')
+        save_csr_graph(kg_path, kg)
+    arrays = {}
+    embeds = load_embed(data_name, embed)
+    ui_rows = 0
+    if embeds:
+        ui_rows = len(embeds['ui_emb'])
+        table = embeds.get('table')
+        arrays['embed_table'] = table if table is not None else embeds_to_table(embeds['ui_emb'], embeds['feature_emb'])
+    splits = ['train', 'test']
+    for mode in splits:
+        ui_view = load_interactions(data_name, mode)
+        arrays[mode + '.users'] = ui_view.users
+        arrays[mode + '.offsets'] = ui_view.offsets
+        arrays[mode + '.items'] = ui_view.items
+    save_arrays(os.path.join(path, 'data'), arrays, {'data_name': data_name, 'embed': bool(embeds), 'ui_rows': ui_rows,
+                                                     'kg_path': os.path.abspath(kg_path),
+                                                     'splits': splits, 'source': source})
+    print('Shared data published at {}'.format(path))
+    return path
+
+
+def attach_shared_data(path):
+    return SharedData(path)
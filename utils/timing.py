@@ -0,0 +1,96 @@
+import time
+from array import array
+from collections import defaultdict
+
+import numpy as np
+
+
+class _NullPhase(object):
+    """Context returned by a disabled PhaseTimer: nothing is measured"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    __slots__ = ('timer', 'name', 'path', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        stack = self.timer.stack
+        self.path = stack[-1] + '/' + self.name if stack else self.name
+        stack.append(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.timer.stack.pop()
+        self.timer.samples[self.path].append(elapsed)
+        return False
+
+
+class PhaseTimer(object):
+    """
+    Hierarchical wall-clock timer: a phase entered inside another one is recorded as 'outer/inner'.
+    Every call of a phase is kept (seconds) until reset(), summary() then gives its count, total,
+    mean, p50 and p99; count() adds plain event counters. Disabled, phase() returns a shared no-op
+    context and count() returns at once.
+
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stack = []
+        self.samples = defaultdict(lambda: array('d'))
+        self.counters = defaultdict(int)
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def reset(self):
+        self.stack = []
+        self.samples.clear()
+        self.counters.clear()
+
+    def summary(self):
+        """
+        :return: {path: {'count', 'total', 'mean', 'p50', 'p99'}} in seconds, sorted by path, and the counters
+        """
+        phases = {}
+        for path in sorted(self.samples):
+            samples = np.frombuffer(self.samples[path], dtype=np.float64)
+            p50, p99 = np.percentile(samples, [50, 99])
+            phases[path] = {'count': len(samples), 'total': float(samples.sum()), 'mean': float(samples.mean()),
+                            'p50': float(p50), 'p99': float(p99)}
+        return phases, dict(self.counters)
+
+    def format_summary(self):
+        phases, counters = self.summary()
+        lines = []
+        for path, s in phases.items():
+            lines.append('{}{}: calls {}, total {:.3f}s, mean {:.3f}ms, p50 {:.3f}ms, p99 {:.3f}ms'.format(
+                '  ' * path.count('/'), path.rsplit('/', 1)[-1], s['count'], s['total'],
+                1000 * s['mean'], 1000 * s['p50'], 1000 * s['p99']))
+        for name in sorted(counters):
+            lines.append('{}: {}'.format(name, counters[name]))
+        return lines
+
+
+# Process-wide timer, wired into the training / evaluation loops and the env; enabled by --timing
+timer = PhaseTimer()
@@ -5,6 +5,9 @@ import torch
 import os
 import sys
 
+from utils.kg_format import save_csr_graph, load_csr_graph, has_arrays
+from utils.embed_store import save_embed_store, load_embed_store, has_embed_store, embed_store_path
+
 # Dataset names
 LAST_FM_STAR = 'LAST_FM_STAR'
 YELP_STAR = 'YELP_STAR'
@@ -52,17 +55,32 @@ def load_dataset(dataset):
 
 
 def save_kg(dataset, kg):
-    kg_file = PROCESSED_DATA_DIR[dataset] + '/kg.pkl'
-    pickle.dump(kg, open(kg_file, 'wb'))
+    kg_dir = PROCESSED_DATA_DIR[dataset] + '/kg'
+    save_csr_graph(kg_dir, kg)
 
 
 def load_kg(dataset):
-    kg_file = PROCESSED_DATA_DIR[dataset] + '/kg.pkl'
+    """
+    Load the memory-mapped graph (processed_data/<dataset>/kg/), fall back to the legacy kg.pkl
+    """
+    kg_dir = PROCESSED_DATA_DIR[dataset] + '/kg'
     print(os.getcwd())
+    if has_arrays(kg_dir):
+        return load_csr_graph(kg_dir)
+    kg_file = PROCESSED_DATA_DIR[dataset] + '/kg.pkl'
+    print('{} not found, loading {} (convert it with graph_init.py --convert_kg)'.format(kg_dir, kg_file))
     kg = pickle.load(open(kg_file, 'rb'))
     return kg
 
 
+def convert_kg(dataset):
+    """Convert a legacy kg.pkl to the memory-mapped graph format"""
+    kg_file = PROCESSED_DATA_DIR[dataset] + '/kg.pkl'
+    kg = pickle.load(open(kg_file, 'rb'))
+    save_kg(dataset, kg)
+    print('Convert {} to {}'.format(kg_file, PROCESSED_DATA_DIR[dataset] + '/kg'))
+
+
 def save_graph(dataset, graph):
     graph_file = PROCESSED_DATA_DIR[dataset] + '/graph.pkl'
     pickle.dump(graph, open(graph_file, 'wb'))
@@ -75,16 +93,46 @@ def load_graph(dataset):
 
 
 def load_embed(dataset, embed):
+    """
+    Load the memory-mapped embedding store (embeds/<embed>/) if converted, else embeds/<embed>.pkl
+    :return: {'ui_emb', 'feature_emb'} (+ 'table': contiguous rows with padding, for the store)
+    """
     if embed:
         path = PROCESSED_DATA_DIR[dataset] + '/embeds/' + '{}.pkl'.format(embed)
     else:
         return None
+    store_path = embed_store_path(PROCESSED_DATA_DIR[dataset], embed)
+    if has_embed_store(store_path):
+        embeds = load_embed_store(store_path)
+        print('{} Embedding store load successfully!'.format(embed))
+        return embeds
     with open(path, 'rb') as f:
         embeds = pickle.load(f)
         print('{} Embedding load successfully!'.format(embed))
         return embeds
 
 
+def convert_embed(dataset, embed, dtype='float32'):
+    """Convert embeds/<embed>.pkl to the memory-mapped embedding store"""
+    path = PROCESSED_DATA_DIR[dataset] + '/embeds/' + '{}.pkl'.format(embed)
+    with open(path, 'rb') as f:
+        embeds = pickle.load(f)
+    store_path = embed_store_path(PROCESSED_DATA_DIR[dataset], embed)
+    save_embed_store(store_path, embeds, dtype=dtype)
+    print('Convert {} to {} ({})'.format(path, store_path, dtype))
+
+
+def embedding_table(env):
+    """
+    User&Feature embedding rows + padding row as a FloatTensor. Shares the memory of the
+    embedding store when the env loaded one (float32), otherwise concatenates a new copy.
+    """
+    if getattr(env, 'embed_table', None) is not None:
+        return torch.from_numpy(env.embed_table).float()
+    return torch.FloatTensor(
+        np.concatenate((env.ui_embeds, env.feature_emb, np.zeros((1, env.ui_embeds.shape[1]))), axis=0))
+
+
 def load_rl_agent(dataset, filename, epoch_user, agent=""):
     model_file = CHECKPOINT_DIR[dataset] + '/model/' + agent + '-' + filename + '-epoch-{}.pkl'.format(epoch_user)
     model_dict = torch.load(model_file)
@@ -138,6 +186,32 @@ def save_rl_mtric(dataset, filename, epoch, results, spend_time, mode='train'):
             # f.write('1000 loss: {}\n'.format(loss_1000))
 
 
+def save_rl_timing(dataset, filename, epoch, lines):
+    """Append the per-phase timing breakdown (PhaseTimer.format_summary) of an epoch to the metric log"""
+    PATH = CHECKPOINT_DIR[dataset] + '/log/' + filename + '.txt'
+    if not os.path.isdir(CHECKPOINT_DIR[dataset] + '/log/'):
+        os.makedirs(CHECKPOINT_DIR[dataset] + '/log/')
+    with open(PATH, 'a') as f:
+        f.write('===========Timing===============\n')
+        f.write('Starting {} user epochs\n'.format(epoch))
+        for line in lines:
+            f.write(line + '\n')
+        f.write('================================\n')
+
+
+def save_rl_memory(dataset, filename, epoch, lines):
+    """Append the replay memory accounting (format_memory_stats) of an epoch to the metric log"""
+    PATH = CHECKPOINT_DIR[dataset] + '/log/' + filename + '.txt'
+    if not os.path.isdir(CHECKPOINT_DIR[dataset] + '/log/'):
+        os.makedirs(CHECKPOINT_DIR[dataset] + '/log/')
+    with open(PATH, 'a') as f:
+        f.write('===========Memory===============\n')
+        f.write('Starting {} user epochs\n'.format(epoch))
+        for line in lines:
+            f.write(line + '\n')
+        f.write('================================\n')
+
+
 def save_rl_model_log(dataset, filename, epoch, epoch_loss, train_len):
     PATH = CHECKPOINT_DIR[dataset] + '/log/' + filename + '.txt'
     if not os.path.isdir(CHECKPOINT_DIR[dataset] + '/log/'):
@@ -160,14 +234,32 @@ def set_random_seed(seed):
         torch.backends.cudnn.benchmark = False
         torch.backends.cudnn.deterministic =True
 
-# Disable
-def blockPrint():
-    sys.stdout = open(os.devnull, 'w')
+def set_episode_seed(seed, episode):
+    # derive an independent seed per episode, so episodes can run in any order or process
+    episode_seed = (seed * 1000003 + episode) % (2 ** 32)
+    random.seed(episode_seed)
+    np.random.seed(episode_seed)
+    torch.manual_seed(episode_seed)
+
+
+def get_rng_states():
+    """Global random states, in plain python types so that they load with torch.load(weights_only=True)"""
+    np_state = np.random.get_state()
+    states = {'random': random.getstate(),
+              'numpy': (np_state[0], np_state[1].tolist(), int(np_state[2]), int(np_state[3]), float(np_state[4])),
+              'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
 
 
-# Restore
-def enablePrint():
-    sys.stdout = sys.__stdout__
+def set_rng_states(states):
+    random.setstate(states['random'])
+    name, keys, pos, has_gauss, cached_gaussian = states['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(states['torch'].cpu())
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in states['cuda']])
 
 
 def set_cuda(args):